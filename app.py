@@ -1,42 +1,112 @@
 # -*- coding: utf-8 -*-
 # 单文件后端：FastAPI + LangGraph + Whisper(ASR) + Ollama(LLM)
-# 功能：WebSocket 接收 10s 音频 → Whisper 转写 → LangGraph 路由/总结 → 推送话题
+# 功能：WebSocket 接收连续音频流 → 按停顿切段 → Whisper 转写 → LangGraph 路由/总结 → 推送话题
 
-import os, json, time, uuid, tempfile, asyncio
-from typing import Dict, Any, List, Optional
+import os, io, re, json, math, time, uuid, base64, bisect, random, hashlib, tempfile, asyncio, threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict, Any, List, Optional, Tuple, NamedTuple
 from dataclasses import dataclass, field
 from datetime import datetime
 
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
 
 import httpx
-from faster_whisper import WhisperModel
-import ffmpeg
-
-from langgraph.graph import StateGraph, START, END
+import numpy as np
+# faster_whisper / langgraph / ffmpeg 较重，在首次使用（或后台预热）时再导入
 
 # ---------------------
 # 配置与全局对象
 # ---------------------
 OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
 OLLAMA_MODEL = os.getenv("OLLAMA_MODEL", "qwen2.5:3b-instruct")
+OLLAMA_CONCURRENCY = int(os.getenv("OLLAMA_CONCURRENCY", "2"))                  # 同时在途的 LLM 请求数
+OLLAMA_TIMEOUT_S = float(os.getenv("OLLAMA_TIMEOUT_S", "40"))
+OLLAMA_RETRIES = int(os.getenv("OLLAMA_RETRIES", "2"))                          # 瞬时错误的重试次数
+OLLAMA_BREAKER_FAILURES = int(os.getenv("OLLAMA_BREAKER_FAILURES", "3"))        # 连续失败几次后熔断
+OLLAMA_BREAKER_COOLDOWN_S = float(os.getenv("OLLAMA_BREAKER_COOLDOWN_S", "15")) # 熔断后多久放行一次探测
+OLLAMA_STREAM_JSON = os.getenv("OLLAMA_STREAM_JSON", "1") != "0"               # 流式生成，首个 JSON 对象闭合即停止
+OLLAMA_JSON_ATTEMPTS = int(os.getenv("OLLAMA_JSON_ATTEMPTS", "2"))              # 输出不是合法 JSON 时最多生成几次
+OLLAMA_JSON_SCHEMA = os.getenv("OLLAMA_JSON_SCHEMA", "1") != "0"               # 用 JSON Schema 约束解码（需 Ollama ≥ 0.5）
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")                      # 模型在 Ollama 中常驻时长（-1 = 永久）
+OLLAMA_NUM_CTX = int(os.getenv("OLLAMA_NUM_CTX", "4096"))                      # 上下文长度；各请求保持一致以免模型重载，0 = 模型默认
+OLLAMA_EMBED_MODEL = os.getenv("OLLAMA_EMBED_MODEL", "nomic-embed-text")        # 快速路由用的嵌入模型
+ROUTER_EMBED = os.getenv("ROUTER_EMBED", "1") != "0"                            # 嵌入快速路由：明确延续当前话题时跳过 LLM 路由
+ROUTER_EMBED_MIN_SIM = float(os.getenv("ROUTER_EMBED_MIN_SIM", "0.65"))         # 最相近话题的余弦相似度下限
+ROUTER_EMBED_MARGIN = float(os.getenv("ROUTER_EMBED_MARGIN", "0.08"))           # 与第二相近话题至少拉开的差距
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "512"))                        # LLM 结果缓存条数；0 = 关闭
+LLM_CACHE_TTL_S = float(os.getenv("LLM_CACHE_TTL_S", "86400"))                 # 缓存有效期（秒）
+LLM_CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.3"))  # 温度高于此值的调用不缓存
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "")                                # 持久化文件（JSONL）；留空只存内存
+ROUTER_BATCH_MAX = int(os.getenv("ROUTER_BATCH_MAX", "6"))                      # 一次批量路由最多合并几句话
+SESSION_MAX = int(os.getenv("SESSION_MAX", "64"))                                # 内存中最多保留几个会话（房间）
+SESSION_IDLE_S = float(os.getenv("SESSION_IDLE_S", "1800"))                     # 无连接空闲多久后淘汰
+SESSION_SPILL_DIR = os.getenv("SESSION_SPILL_DIR", os.path.join(tempfile.gettempdir(), "topic-sessions"))  # 淘汰时溢写目录；留空则直接丢弃
+SESSION_MAX_TOPICS = int(os.getenv("SESSION_MAX_TOPICS", "200"))                # 单会话话题上限（超出丢弃最久未更新的）
+SESSION_MAX_POINTS = int(os.getenv("SESSION_MAX_POINTS", "200"))                # 单话题要点上限
+DEDUP_FUZZY = os.getenv("DEDUP_FUZZY", "1") != "0"                             # 合并近似重复话题；0 = 只合并同名（忽略大小写与词尾变化）
+DEDUP_MIN_SIM = float(os.getenv("DEDUP_MIN_SIM", "0.6"))                        # 近似话题的合并阈值（0~1）
+DEDUP_LABEL_WEIGHT = float(os.getenv("DEDUP_LABEL_WEIGHT", "0.5"))              # 相似度中标签所占权重，其余给关键词
+DEDUP_EMBED_MIN_SIM = float(os.getenv("DEDUP_EMBED_MIN_SIM", "0.9"))            # 话题质心余弦达到该值也算近似重复（需 ROUTER_EMBED）；0 = 只看字面
+DEDUP_LSH_BANDS = int(os.getenv("DEDUP_LSH_BANDS", "20"))                       # MinHash 分段数（每段 3 行）；越多候选召回越高、查询越慢
+COMPRESS_EVERY_POINTS = int(os.getenv("COMPRESS_EVERY_POINTS", "3"))            # 话题攒够几个新要点就后台压缩
+COMPRESS_IDLE_S = float(os.getenv("COMPRESS_IDLE_S", "4"))                      # 否则空闲多少秒后压缩
 MAX_POINTS_PER_TOPIC = int(os.getenv("MAX_POINTS_PER_TOPIC", "8"))
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "base")                # base 对原型足够；可改 small/medium 提升质量
+WHISPER_COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "int8")
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "1") != "0"          # 启动后在后台预加载并预热 Whisper / Ollama
+ASR_SAMPLE_RATE = 16000  # Whisper 输入采样率
+STREAM_PAUSE_MS = int(os.getenv("STREAM_PAUSE_MS", "600"))                # 停顿多久算一句话结束
+STREAM_MAX_SEGMENT_S = float(os.getenv("STREAM_MAX_SEGMENT_S", "12"))     # 单段最长时长（无停顿时强制切分）
+STREAM_ENERGY_THRESHOLD = float(os.getenv("STREAM_ENERGY_THRESHOLD", "0.01"))  # 语音帧 RMS 下限
+ASR_VAD = os.getenv("ASR_VAD", "energy")                                   # ASR 前置语音门限：energy | silero | off
+ASR_VAD_MIN_SPEECH_MS = int(os.getenv("ASR_VAD_MIN_SPEECH_MS", "300"))      # 语音少于该时长的段直接丢弃
+STREAM_PARTIALS = os.getenv("STREAM_PARTIALS", "1") != "0"                  # 是否推送流式中间字幕
+STREAM_PARTIAL_INTERVAL_S = float(os.getenv("STREAM_PARTIAL_INTERVAL_S", "1.0"))  # 中间字幕重解码间隔
+ASR_LANGUAGE = os.getenv("ASR_LANGUAGE") or None                               # 固定识别语言（如 zh / en）；留空则自动检测后锁定
+ASR_LANGUAGE_LOCK_PROB = float(os.getenv("ASR_LANGUAGE_LOCK_PROB", "0.8"))     # 检测置信度达到该值后锁定会话语言
+ASR_PROMPT_CHARS = int(os.getenv("ASR_PROMPT_CHARS", "200"))                   # 上一段结尾作为 initial_prompt 的字符数
+ASR_BATCH_SIZE = int(os.getenv("ASR_BATCH_SIZE", "8"))           # 跨会话微批：单批最多几段
+ASR_BATCH_WAIT_MS = int(os.getenv("ASR_BATCH_WAIT_MS", "50"))    # 凑批最多等待多久
+ASR_WORKERS = int(os.getenv("ASR_WORKERS", "0"))                 # ASR 工作进程数；0 = 在本进程的单个线程中推理
+ASR_CPU_THREADS = int(os.getenv("ASR_CPU_THREADS", "0"))         # 每个模型实例的 CTranslate2 线程数；0 = 库默认
+ASR_SESSION_QUEUE = int(os.getenv("ASR_SESSION_QUEUE", "4"))     # 每个会话最多积压几段待转写
+ASR_QUEUE_POLICY = os.getenv("ASR_QUEUE_POLICY", "drop_oldest")  # 积压溢出策略：drop_oldest | merge
+ASR_BUSY_BACKLOG = int(os.getenv("ASR_BUSY_BACKLOG", "0"))       # 全局积压超过多少段视为繁忙；0 = 自动
 STATIC_INDEX_PATH = os.path.join(os.path.dirname(__file__), "static", "index.html")  # Main SPA entry
 CANVAS_STORAGE_PATH = os.path.join(os.path.dirname(__file__), "canvas_history.json")  # Canvas history file
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")          # memory（单进程）| sqlite（同机多 worker 共享）
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", os.path.join(os.path.dirname(__file__), "state.sqlite3"))  # sqlite 后端的数据库文件
+STATE_POLL_S = float(os.getenv("STATE_POLL_S", "0.5"))        # 轮询其他 worker 变更事件的间隔
+CANVAS_DB_PATH = os.getenv("CANVAS_DB_PATH", os.path.join(os.path.dirname(__file__), "canvas_history.sqlite3"))  # memory 后端的画布历史库
+CANVAS_CACHE_SIZE = int(os.getenv("CANVAS_CACHE_SIZE", "32"))  # 内存中缓存几个已打开画布的正文
+CANVAS_FLUSH_S = float(os.getenv("CANVAS_FLUSH_S", "1.0"))     # 画布 / 位置变更延迟写入的合并间隔；0 = 立即写入
+CANVAS_PAGE_SIZE = int(os.getenv("CANVAS_PAGE_SIZE", "30"))    # /canvas/history 每页默认条数（上限 500）
 
-# Whisper 模型（延迟加载）
+# Whisper 模型（延迟加载；服务启动时由后台预热任务提前加载）
 _ASR = None
+_ASR_LOCK = threading.Lock()
 def load_asr():
     global _ASR
     if _ASR is None:
-        # base 对原型足够；可改 small/medium 提升质量
-        _ASR = WhisperModel("base", compute_type="int8")
+        with _ASR_LOCK:
+            if _ASR is None:
+                from faster_whisper import WhisperModel
+                _ASR = WhisperModel(WHISPER_MODEL, compute_type=WHISPER_COMPUTE_TYPE, cpu_threads=ASR_CPU_THREADS)
+                mark_warm("asr")
     return _ASR
 
+def warm_asr():
+    """加载模型并跑一次 1 秒静音的转写，让首个用户不再等待"""
+    model = load_asr()
+    segments, _ = model.transcribe(np.zeros(ASR_SAMPLE_RATE, dtype=np.float32), language="en", vad_filter=False)
+    list(segments)
+
 # ---------------------
 # 数据模型（UI 返回）
 # ---------------------
@@ -53,10 +123,29 @@ class TopicPayload(BaseModel):
 class TopicsEnvelope(BaseModel):
     event: str = "topics"
     topics: List[TopicPayload]
+    version: int = 0      # 对应的 store 版本（增量更新的基线）
+
+class TopicsPatchEnvelope(BaseModel):
+    event: str = "topics_patch"
+    version: int                                          # 应用后的 store 版本（单调递增）
+    base_version: int                                     # 客户端应持有的版本；不一致时请求 resync
+    upserts: List[TopicPayload] = []                      # 新增/变更的话题（最近更新的在前）
+    removed: List[str] = []                               # 已删除（含被合并）的话题 id
 
 class TranscriptEnvelope(BaseModel):
     event: str = "transcript"
     text: str
+    final: bool = True
+
+class PartialTranscriptEnvelope(BaseModel):
+    event: str = "partial"
+    committed: str        # 已稳定的前缀（只增不改）
+    tentative: str = ""   # 仍可能变化的尾部
+
+class BusyEnvelope(BaseModel):
+    event: str = "busy"
+    busy: bool = True     # False 表示已恢复
+    dropped: int = 0      # 本会话累计丢弃/合并的段数
 
 # ---------------------
 # 内存话题结构（极简）
@@ -72,19 +161,194 @@ class Topic:
 
 @dataclass
 class MemoryStore:
+    """话题存储：变更统一走 add/touch/remove/clear/load，维护最近更新顺序、每话题版本号，
+    并按话题缓存路由快照行与推送载荷，只有变脏的话题才重新序列化"""
     topics: Dict[str, Topic] = field(default_factory=dict)
-    def as_payload(self, max_points=8) -> List[TopicPayload]:
-        items = []
-        for t in self.topics.values():
-            items.append(TopicPayload(
+    version: int = 0                      # 每次变更 +1，供路由结果做乐观并发校验
+    last_create_version: int = 0          # 最近一次新建话题时的版本
+    aliases: Dict[str, str] = field(default_factory=dict)  # 被合并掉的话题 id → 保留的 id
+    topic_versions: Dict[str, int] = field(default_factory=dict)  # 话题 id → 最后一次变更时的 store 版本
+    _recency: "OrderedDict[str, None]" = field(default_factory=OrderedDict)  # 最久未更新 → 最近更新
+    _rows: Dict[str, Tuple[int, str]] = field(default_factory=dict)           # 路由快照行缓存 (版本, json)
+    _payloads: Dict[Tuple[str, int], Tuple[int, TopicPayload, str]] = field(default_factory=dict)
+    _views: Dict[Any, Tuple[int, Any]] = field(default_factory=dict)         # 整体快照/载荷缓存，按 store 版本失效
+    
+    def bump(self) -> int:
+        self.version += 1
+        return self.version
+    
+    def add(self, topic: Topic) -> Topic:
+        self.topics[topic.id] = topic
+        self.last_create_version = self.touch(topic.id)
+        return topic
+    
+    def touch(self, tid: str) -> int:
+        """话题被修改后调用：版本 +1，移到最近更新的一端"""
+        version = self.bump()
+        self.topic_versions[tid] = version
+        self._recency[tid] = None
+        self._recency.move_to_end(tid)
+        return version
+    
+    def remove(self, tid: str, alias_to: Optional[str] = None):
+        self.topics.pop(tid, None)
+        self.topic_versions.pop(tid, None)
+        self._recency.pop(tid, None)
+        self._rows.pop(tid, None)
+        for key in [k for k in self._payloads if k[0] == tid]:
+            self._payloads.pop(key, None)
+        if alias_to:
+            self.aliases[tid] = alias_to
+        self.bump()
+    
+    def clear(self):
+        self.topics.clear()
+        self.aliases.clear()
+        self.topic_versions.clear()
+        self._recency.clear()
+        self._rows.clear()
+        self._payloads.clear()
+        self._views.clear()
+        self.bump()
+    
+    def load(self, topics: List[Topic]):
+        """整体替换（载入画布）：按 last_updated 建立最近更新顺序"""
+        self.clear()
+        for t in sorted(topics, key=lambda t: t.last_updated):
+            self.topics[t.id] = t
+            self.touch(t.id)
+    
+    def reindex(self):
+        """直接改动过 topics 字典（批量去重等）后重建索引并让缓存失效"""
+        for tid in list(self._recency):
+            if tid not in self.topics:
+                self.remove(tid)
+        for t in sorted(self.topics.values(), key=lambda t: t.last_updated):
+            self.touch(t.id)
+    
+    def resolve(self, tid: str) -> str:
+        """沿合并别名找到当前仍存在的话题 id"""
+        seen = set()
+        while tid not in self.topics and tid in self.aliases and tid not in seen:
+            seen.add(tid)
+            tid = self.aliases[tid]
+        return tid
+    
+    def recent(self, limit: Optional[int] = None) -> List[Topic]:
+        """最近更新的在前"""
+        if len(self._recency) != len(self.topics):
+            self.reindex()  # 兜底：有人绕过 API 增删了话题
+        out = []
+        for tid in reversed(self._recency):
+            if limit is not None and len(out) >= limit:
+                break
+            out.append(self.topics[tid])
+        return out
+    
+    def _cached_view(self, key, build):
+        hit = self._views.get(key)
+        if hit is not None and hit[0] == self.version and len(self._recency) == len(self.topics):
+            return hit[1]
+        value = build()
+        self._views[key] = (self.version, value)
+        return value
+    
+    def snapshot_json(self, max_topics: int = 12) -> str:
+        """路由快照：最近 max_topics 个话题；每行按话题版本缓存"""
+        def build():
+            rows = []
+            for t in self.recent(max_topics):
+                ver = self.topic_versions.get(t.id, 0)
+                hit = self._rows.get(t.id)
+                if hit is None or hit[0] != ver:
+                    hit = (ver, json.dumps({
+                        "id": t.id, 
+                        "label": t.label,
+                        "summary": t.summary,  # 加入摘要，帮助理解话题内涵
+                        "keyphrases": t.keyphrases[:5],
+                        "recent_points": t.points[-3:]
+                    }, ensure_ascii=False))
+                    self._rows[t.id] = hit
+                rows.append(hit[1])
+            return "[" + ", ".join(rows) + "]"
+        return self._cached_view(("snapshot", max_topics), build)
+    
+    def _payload(self, t: Topic, max_points: int) -> Tuple[TopicPayload, str]:
+        ver = self.topic_versions.get(t.id, 0)
+        hit = self._payloads.get((t.id, max_points))
+        if hit is None or hit[0] != ver:
+            item = TopicPayload(
                 id=t.id, label=t.label, summary=t.summary, keyphrases=t.keyphrases[:5],
                 points=[Point(text=p) for p in t.points[-max_points:]]
-            ))
+            )
+            hit = (ver, item, item.model_dump_json())
+            self._payloads[(t.id, max_points)] = hit
+        return hit[1], hit[2]
+    
+    def as_payload(self, max_points=8) -> List[TopicPayload]:
         # 新的在前
-        items.sort(key=lambda x: self.topics[x.id].last_updated, reverse=True)
-        return items
+        return self._cached_view(("payload", max_points),
+                                 lambda: [self._payload(t, max_points)[0] for t in self.recent()])
+    
+    def payload_json(self, max_points=8) -> str:
+        """等价于 TopicsEnvelope(topics=as_payload()).model_dump_json()，由每话题缓存的 JSON 片段拼接"""
+        def build():
+            parts = [self._payload(t, max_points)[1] for t in self.recent()]
+            return '{"event":"topics","topics":[' + ",".join(parts) + '],"version":' + str(self.version) + "}"
+        return self._cached_view(("payload_json", max_points), build)
 
-store = MemoryStore()
+class TopicSync:
+    """按会话记录已推送给客户端的话题版本：之后只推送变更（topics_patch），客户端发现版本断档时请求全量 resync"""
+    def __init__(self, store: MemoryStore, max_points: int = MAX_POINTS_PER_TOPIC):
+        self.store = store
+        self.max_points = max_points
+        self.sent: Dict[str, int] = {}   # 客户端持有的话题 → 版本
+        self.version = 0                 # 客户端持有的 store 版本
+    
+    def mark(self):
+        """视为对方已持有当前全部话题"""
+        self.sent = {tid: self.store.topic_versions.get(tid, 0) for tid in self.store.topics}
+        self.version = self.store.version
+    
+    def mark_topics(self, ids: List[str], removed: List[str] = ()):
+        """只把这些话题视为对方已持有；其他话题尚未同步的变更保留，下次 changes() 照常返回"""
+        for tid in removed:
+            self.sent.pop(tid, None)
+        for tid in ids:
+            if tid in self.store.topics:
+                self.sent[tid] = self.store.topic_versions.get(tid, 0)
+    
+    def full(self) -> str:
+        self.mark()
+        return self.store.payload_json(self.max_points)
+    
+    def changes(self) -> Tuple[List[Topic], List[str]]:
+        """自上次以来变更与删除的话题，并推进基线"""
+        upserts = []
+        for t in self.store.recent():
+            ver = self.store.topic_versions.get(t.id, 0)
+            if ver <= self.version:
+                break  # 最近更新顺序：之后的话题都没有变过
+            if self.sent.get(t.id) != ver:
+                upserts.append(t)
+        removed = [tid for tid in self.sent if tid not in self.store.topics]
+        for tid in removed:
+            self.sent.pop(tid, None)
+        for t in upserts:
+            self.sent[t.id] = self.store.topic_versions.get(t.id, 0)
+        self.version = self.store.version
+        return upserts, removed
+    
+    def patch(self) -> Optional[str]:
+        """自上次推送以来的增量；没有变化时返回 None"""
+        base_version = self.version
+        upserts, removed = self.changes()
+        if not upserts and not removed:
+            return None
+        return TopicsPatchEnvelope(
+            version=self.store.version, base_version=base_version,
+            upserts=[self.store._payload(t, self.max_points)[0] for t in upserts], removed=removed,
+        ).model_dump_json()
 
 # ---------------------
 # Canvas Storage (for history feature)
@@ -97,103 +361,555 @@ class Canvas:
     topics: Dict[str, Topic]
     created_at: str
     positions: Dict[str, dict] = field(default_factory=dict)
+
+def topic_to_dict(t: Topic) -> Dict[str, Any]:
+    return {
+        'id': t.id,
+        'label': t.label,
+        'keyphrases': t.keyphrases,
+        'points': t.points,
+        'summary': t.summary,
+        'last_updated': t.last_updated
+    }
+
+def topic_from_dict(t: Dict[str, Any]) -> Topic:
+    return Topic(
+        id=t['id'],
+        label=t.get('label', 'Topic'),
+        keyphrases=t.get('keyphrases', []),
+        points=t.get('points', []),
+        summary=t.get('summary', ''),
+        last_updated=t.get('last_updated', time.time())
+    )
+
+def canvas_from_dict(item: Dict[str, Any]) -> Canvas:
+    return Canvas(
+        id=item['id'],
+        title=item['title'],
+        summary=item['summary'],
+        topics={tid: topic_from_dict(t) for tid, t in item.get('topics', {}).items()},
+        created_at=item['created_at'],
+        positions=item.get('positions', {})
+    )
+
+# ---------------------
+# 状态后端：会话话题与画布历史的持久化，以及多 worker 之间的变更通知
+# ---------------------
+WORKER_ID = f"{os.getpid()}-{uuid.uuid4().hex[:6]}"  # 区分变更事件来自哪个 worker
+
+class SQLiteDatabase:
+    """一个 WAL 模式的 SQLite 连接：读写互不阻塞，写入走 BEGIN IMMEDIATE 事务，多进程争用时由 busy timeout 排队"""
+    def __init__(self, path: str, schema: str):
+        import sqlite3
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(schema)
     
-class CanvasStore:
-    def __init__(self, storage_path: str):
-        self.storage_path = storage_path
-        self.canvases: List[Canvas] = []
-        self._load()
+    def query(self, sql: str, args: tuple = ()) -> List[tuple]:
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
     
-    def _load(self):
-        """Load canvases from file"""
-        if os.path.exists(self.storage_path):
+    def write(self, fn):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
             try:
-                with open(self.storage_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    self.canvases = []
-                    for item in data:
-                        topics = {}
-                        for tid, t in item.get('topics', {}).items():
-                            topics[tid] = Topic(
-                                id=t['id'],
-                                label=t.get('label', 'Topic'),
-                                keyphrases=t.get('keyphrases', []),
-                                points=t.get('points', []),
-                                summary=t.get('summary', ''),
-                                last_updated=t.get('last_updated', time.time())
-                            )
-                        self.canvases.append(Canvas(
-                            id=item['id'],
-                            title=item['title'],
-                            summary=item['summary'],
-                            topics=topics,
-                            created_at=item['created_at'],
-                            positions=item.get('positions', {})
-                        ))
-            except Exception as e:
-                print(f"[canvas] load error: {e}")
-                self.canvases = []
+                result = fn(self.conn)
+                self.conn.execute("COMMIT")
+                return result
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# 画布历史表：列表字段单独成列（列出历史不读话题正文），话题与位置各自一列，按主键读写单个画布
+CANVAS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS canvases (
+    id TEXT PRIMARY KEY, title TEXT NOT NULL, summary TEXT NOT NULL, created_at TEXT NOT NULL,
+    topic_count INTEGER NOT NULL, positions TEXT NOT NULL, topics TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS canvases_created_at ON canvases (created_at);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+"""
+CANVAS_SUMMARY_COLUMNS = ("id", "title", "summary", "created_at", "topic_count")
+
+class StateBackend:
+    """存储接口。memory：单进程（话题在内存，淘汰的会话溢写到目录）；
+    sqlite：同机多 worker 共享一个 WAL 数据库，话题按条写入，变更事件表供其他 worker 轮询。
+    画布历史在两种后端下都存 SQLite 表（memory 用单独的 CANVAS_DB_PATH），首次打开时导入旧的 JSON 文件"""
+    name = "base"
+    shared = False       # 话题写入后端、其他 worker 可见（需要轮询变更事件）
+    
+    def __init__(self, canvas_db: SQLiteDatabase, legacy_json: str = CANVAS_STORAGE_PATH):
+        self.stats: Dict[str, int] = {"topic_writes": 0, "canvas_writes": 0, "events_published": 0, "events_received": 0}
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="state")  # 单线程写入器：按提交顺序执行
+        self.canvas_db = canvas_db
+        self._migrate_json(legacy_json)
+    
+    # 会话话题
+    def load_topics(self, sid: str, ids: Optional[List[str]] = None) -> List[Topic]:
+        return []
+    
+    def save_topics(self, sid: str, rows: List[Dict[str, Any]], removed: List[str]):
+        """写入变更的话题（rows 为 topic_to_dict 快照）并发布变更事件"""
+    
+    def release(self, sid: str, topics: List[Topic]) -> bool:
+        """会话被淘汰出内存；返回是否留存到了磁盘"""
+        return False
+    
+    def stored_sessions(self) -> int:
+        return 0
+    
+    # 画布历史
+    def _migrate_json(self, path: str):
+        """旧版 canvas_history.json 一次性导入（只在表为空且未导入过时）；原文件保留不动"""
+        if not path or not os.path.exists(path):
+            return
+        def tx(db):
+            if db.execute("SELECT 1 FROM meta WHERE key = 'migrated_json'").fetchone():
+                return 0
+            with open(path, 'r', encoding='utf-8') as f:
+                canvases = [canvas_from_dict(item) for item in json.load(f)]
+            if not db.execute("SELECT 1 FROM canvases LIMIT 1").fetchone():
+                self._upsert_canvases(db, canvases)
+            db.execute("INSERT INTO meta (key, value) VALUES ('migrated_json', ?)", (path,))
+            return len(canvases)
+        try:
+            count = self.canvas_db.write(tx)
+            if count:
+                print(f"[canvas] migrated {count} canvases from {path}")
+        except Exception as e:
+            print(f"[canvas] migration from {path} failed: {e}")
+    
+    @staticmethod
+    def _upsert_canvases(db, canvases: List[Canvas]):
+        db.executemany(
+            "INSERT OR REPLACE INTO canvases (id, title, summary, created_at, topic_count, positions, topics) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(c.id, c.title, c.summary, c.created_at, len(c.topics), json.dumps(c.positions, ensure_ascii=False),
+              json.dumps({tid: topic_to_dict(t) for tid, t in c.topics.items()}, ensure_ascii=False))
+             for c in canvases])
+    
+    def _canvas_changed(self, db, ids: List[str], removed: List[str]):
+        """同一事务内的变更钩子（共享后端据此通知其他 worker）"""
+    
+    def canvas_summaries(self, ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+        """列表字段（不含话题正文），按 created_at 从旧到新"""
+        cols = ", ".join(CANVAS_SUMMARY_COLUMNS)
+        if ids is None:
+            rows = self.canvas_db.query(f"SELECT {cols} FROM canvases ORDER BY created_at, id")
+        else:
+            marks = ",".join("?" * len(ids))
+            rows = self.canvas_db.query(f"SELECT {cols} FROM canvases WHERE id IN ({marks}) ORDER BY created_at, id", tuple(ids))
+        return [dict(zip(CANVAS_SUMMARY_COLUMNS, r)) for r in rows]
+    
+    def get_canvas(self, canvas_id: str) -> Optional[Canvas]:
+        rows = self.canvas_db.query(
+            "SELECT id, title, summary, created_at, positions, topics FROM canvases WHERE id = ?", (canvas_id,))
+        if not rows:
+            return None
+        cid, title, summary, created_at, positions, topics = rows[0]
+        return Canvas(id=cid, title=title, summary=summary, created_at=created_at, positions=json.loads(positions),
+                      topics={tid: topic_from_dict(t) for tid, t in json.loads(topics).items()})
+    
+    def write_canvases(self, upserts: List[Canvas] = (), positions: Optional[Dict[str, Dict[str, dict]]] = None,
+                       deleted: List[str] = ()):
+        """一个事务内写入整行画布、只改位置列的画布与删除；事务提交即原子生效"""
+        positions = positions or {}
+        def tx(db):
+            self._upsert_canvases(db, list(upserts))
+            db.executemany("UPDATE canvases SET positions = ? WHERE id = ?",
+                           [(json.dumps(pos, ensure_ascii=False), cid) for cid, pos in positions.items()])
+            db.executemany("DELETE FROM canvases WHERE id = ?", [(cid,) for cid in deleted])
+            self._canvas_changed(db, [c.id for c in upserts] + list(positions), list(deleted))
+        self.canvas_db.write(tx)
+        self.stats["canvas_writes"] += len(upserts) + len(positions) + len(deleted)
+    
+    # 变更通知
+    def poll(self) -> List[Dict[str, Any]]:
+        """其他 worker 发布的新事件：{"session", "kind", "ids", "removed"}"""
+        return []
+    
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.canvas_db.close()
+
+class MemoryBackend(StateBackend):
+    """单进程：话题只在内存；淘汰的会话写到 spill_dir/{sid}.json，下次访问时恢复；画布历史存本地 SQLite 文件"""
+    name = "memory"
     
-    def _save(self):
-        """Save canvases to file"""
+    def __init__(self, canvas_db_path: str = CANVAS_DB_PATH, spill_dir: str = SESSION_SPILL_DIR):
+        super().__init__(SQLiteDatabase(canvas_db_path, CANVAS_SCHEMA))
+        self.spill_dir = spill_dir or None
+    
+    def _spill_path(self, sid: str) -> str:
+        return os.path.join(self.spill_dir, f"{sid}.json")
+    
+    def load_topics(self, sid: str, ids: Optional[List[str]] = None) -> List[Topic]:
+        if not self.spill_dir or not os.path.exists(self._spill_path(sid)):
+            return []
+        try:
+            path = self._spill_path(sid)
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            os.remove(path)
+            return [topic_from_dict(t) for t in data.get("topics", [])]
+        except Exception as e:
+            print(f"[state] failed to restore {sid}: {e}")
+            return []
+    
+    def release(self, sid: str, topics: List[Topic]) -> bool:
+        if not self.spill_dir or not topics:
+            return False
         try:
-            data = []
-            for canvas in self.canvases:
-                topics_data = {}
-                for tid, t in canvas.topics.items():
-                    topics_data[tid] = {
-                        'id': t.id,
-                        'label': t.label,
-                        'keyphrases': t.keyphrases,
-                        'points': t.points,
-                        'summary': t.summary,
-                        'last_updated': t.last_updated
-                    }
-                data.append({
-                    'id': canvas.id,
-                    'title': canvas.title,
-                    'summary': canvas.summary,
-                    'topics': topics_data,
-                    'created_at': canvas.created_at,
-                    'positions': canvas.positions
-                })
-            with open(self.storage_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.makedirs(self.spill_dir, exist_ok=True)
+            path = self._spill_path(sid)
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump({"id": sid, "topics": [topic_to_dict(t) for t in topics]}, f, ensure_ascii=False)
+            os.replace(path + ".tmp", path)
+            return True
         except Exception as e:
-            print(f"[canvas] save error: {e}")
+            print(f"[state] failed to spill {sid}: {e}")
+            return False
+    
+    def stored_sessions(self) -> int:
+        if not self.spill_dir or not os.path.isdir(self.spill_dir):
+            return 0
+        return sum(1 for name in os.listdir(self.spill_dir) if name.endswith(".json"))
+
+class SQLiteBackend(StateBackend):
+    """同机多 worker：话题按 (session, id) 一行存在 WAL 数据库里（画布历史同库），
+    每次写入在同一事务里追加一条 events 记录；各 worker 轮询 events 把其他 worker 的变更应用到自己内存中的会话"""
+    name = "sqlite"
+    shared = True
+    SCHEMA = CANVAS_SCHEMA + """
+    CREATE TABLE IF NOT EXISTS topics (
+        session TEXT NOT NULL, id TEXT NOT NULL, data TEXT NOT NULL, last_updated REAL NOT NULL,
+        PRIMARY KEY (session, id));
+    CREATE TABLE IF NOT EXISTS events (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT, origin TEXT NOT NULL, session TEXT NOT NULL,
+        kind TEXT NOT NULL, ids TEXT NOT NULL, removed TEXT NOT NULL, ts REAL NOT NULL);
+    """
+    
+    def __init__(self, path: str = STATE_DB_PATH, events_ttl_s: float = 600.0):
+        self.db = SQLiteDatabase(path, self.SCHEMA)
+        self.events_ttl_s = events_ttl_s
+        self._seq = self.db.query("SELECT COALESCE(MAX(seq), 0) FROM events")[0][0]
+        self._pruned_at = 0.0
+        super().__init__(self.db)
+    
+    def _publish(self, db, sid: str, kind: str, ids: List[str], removed: List[str]):
+        db.execute("INSERT INTO events (origin, session, kind, ids, removed, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                   (WORKER_ID, sid, kind, json.dumps(ids), json.dumps(removed), time.time()))
+        self.stats["events_published"] += 1
+    
+    def _canvas_changed(self, db, ids: List[str], removed: List[str]):
+        self._publish(db, "", "canvas", ids, removed)
+    
+    def load_topics(self, sid: str, ids: Optional[List[str]] = None) -> List[Topic]:
+        if ids is None:
+            rows = self.db.query("SELECT data FROM topics WHERE session = ? ORDER BY last_updated", (sid,))
+        else:
+            marks = ",".join("?" * len(ids))
+            rows = self.db.query(f"SELECT data FROM topics WHERE session = ? AND id IN ({marks})", (sid, *ids))
+        return [topic_from_dict(json.loads(r[0])) for r in rows]
+    
+    def save_topics(self, sid: str, rows: List[Dict[str, Any]], removed: List[str]):
+        def tx(db):
+            db.executemany("INSERT OR REPLACE INTO topics (session, id, data, last_updated) VALUES (?, ?, ?, ?)",
+                           [(sid, r["id"], json.dumps(r, ensure_ascii=False), r["last_updated"]) for r in rows])
+            db.executemany("DELETE FROM topics WHERE session = ? AND id = ?", [(sid, tid) for tid in removed])
+            self._publish(db, sid, "topics", [r["id"] for r in rows], removed)
+        self.db.write(tx)
+        self.stats["topic_writes"] += len(rows) + len(removed)
+    
+    def stored_sessions(self) -> int:
+        return self.db.query("SELECT COUNT(DISTINCT session) FROM topics")[0][0]
+    
+    def poll(self) -> List[Dict[str, Any]]:
+        rows = self.db.query(
+            "SELECT seq, origin, session, kind, ids, removed FROM events WHERE seq > ? ORDER BY seq", (self._seq,))
+        if time.time() - self._pruned_at > self.events_ttl_s / 2:
+            self._pruned_at = time.time()
+            self.db.write(lambda db: db.execute("DELETE FROM events WHERE ts < ?", (time.time() - self.events_ttl_s,)))
+        events = []
+        for seq, origin, sid, kind, ids, removed in rows:
+            self._seq = seq
+            if origin != WORKER_ID:
+                events.append({"session": sid, "kind": kind, "ids": json.loads(ids), "removed": json.loads(removed)})
+        self.stats["events_received"] += len(events)
+        return events
+
+_STATE_BACKEND: Optional[StateBackend] = None
+_STATE_LOCK = threading.Lock()
+def get_state_backend() -> StateBackend:
+    global _STATE_BACKEND
+    if _STATE_BACKEND is None:
+        with _STATE_LOCK:
+            if _STATE_BACKEND is None:
+                _STATE_BACKEND = SQLiteBackend() if STATE_BACKEND == "sqlite" else MemoryBackend()
+                print(f"[state] backend: {_STATE_BACKEND.name} (worker {WORKER_ID})")
+    return _STATE_BACKEND
+
+class CanvasStore:
+    """画布历史：内存里只保留列表字段的索引（id → 摘要，按 created_at 排列），
+    画布正文（话题、位置）在首次打开时从后端读取并放进有界 LRU 缓存；增删改在内存中合并后由后台线程只写被改的行。
+    另有按 (created_at, id) 排序的键列表，分页按游标二分定位。
+    索引、键列表与缓存由 _lock 保护：同步接口在线程池中执行，与事件循环上的调用、后端轮询同时读写"""
+    def __init__(self, backend: StateBackend, cache_size: int = CANVAS_CACHE_SIZE, flush_s: float = CANVAS_FLUSH_S):
+        self.backend = backend
+        self.cache_size = max(1, cache_size)
+        self.flush_s = flush_s
+        self._index: Dict[str, Dict[str, Any]] = {s['id']: s for s in backend.canvas_summaries()}  # 旧 → 新
+        self._order: List[Tuple[str, str]] = [(s['created_at'], cid) for cid, s in self._index.items()]
+        self._cache: "OrderedDict[str, Canvas]" = OrderedDict()
+        self._lock = threading.RLock()   # _index / _order / _cache
+        self._pending: Dict[str, Tuple[str, Optional[Canvas]]] = {}  # id → (canvas | positions | delete, 画布)
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closing = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self.stats: Dict[str, int] = {"flushes": 0, "written": 0, "coalesced": 0, "errors": 0}
+        self._watchers: List[Any] = []   # fn(canvas_id)：画布内容变了（不含位置）
+    
+    def __len__(self) -> int:
+        return len(self._index)
+    
+    def ids(self) -> List[str]:
+        """新 → 旧"""
+        with self._lock:
+            return [cid for _, cid in reversed(self._order)]
+    
+    @staticmethod
+    def encode_cursor(key: Tuple[str, str]) -> str:
+        return base64.urlsafe_b64encode(json.dumps(list(key)).encode("utf-8")).decode("ascii")
+    
+    @staticmethod
+    def decode_cursor(cursor: str) -> Tuple[str, str]:
+        created_at, cid = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return str(created_at), str(cid)
+    
+    def page(self, limit: int, cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """新 → 旧的一页摘要：cursor 之后（更旧）的 limit 条，以及下一页的游标（没有更多时为 None）"""
+        key = self.decode_cursor(cursor) if cursor else None
+        with self._lock:
+            end = bisect.bisect_left(self._order, key) if key else len(self._order)
+            start = max(0, end - limit)
+            keys = self._order[start:end][::-1]
+            items = [dict(self._index[cid]) for _, cid in keys]
+        return items, (self.encode_cursor(keys[-1]) if start > 0 and keys else None)
+    
+    def _unorder(self, cid: str):
+        summary = self._index.get(cid)
+        if summary is not None:
+            i = bisect.bisect_left(self._order, (summary['created_at'], cid))
+            if i < len(self._order) and self._order[i][1] == cid:
+                self._order.pop(i)
+    
+    def _remember(self, canvas: Canvas):
+        self._cache[canvas.id] = canvas
+        self._cache.move_to_end(canvas.id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+    
+    @staticmethod
+    def _summary(canvas: Canvas) -> Dict[str, Any]:
+        return {
+            'id': canvas.id,
+            'title': canvas.title,
+            'summary': canvas.summary,
+            'created_at': canvas.created_at,
+            'topic_count': len(canvas.topics)
+        }
     
     def add(self, canvas: Canvas):
         """Add a canvas to history"""
-        self.canvases.insert(0, canvas)  # Most recent first
-        self._save()
+        with self._lock:
+            self._unorder(canvas.id)
+            self._index.pop(canvas.id, None)
+            self._index[canvas.id] = self._summary(canvas)  # Most recent last in the index
+            bisect.insort(self._order, (canvas.created_at, canvas.id))
+            self._remember(canvas)
+        self._defer(canvas.id, "canvas", canvas)
+    
+    def update(self, *canvases: Canvas):
+        """Persist changes made to canvases in place (dedup)"""
+        for canvas in canvases:
+            with self._lock:
+                if canvas.id in self._index:
+                    self._index[canvas.id] = self._summary(canvas)
+            self._defer(canvas.id, "canvas", canvas)
+    
+    def set_positions(self, canvas: Canvas, positions: Dict[str, dict]):
+        """整体替换位置"""
+        canvas.positions = positions
+        self._defer(canvas.id, "positions", canvas)
+    
+    def patch_positions(self, canvas: Canvas, moved: Dict[str, dict], removed: List[str] = ()) -> Dict[str, dict]:
+        """只合并移动过的节点（按 ripple/map/keywords 分项覆盖）；换成新字典，后台写入读到的总是完整快照"""
+        positions = dict(canvas.positions) if isinstance(canvas.positions, dict) else {}
+        for tid, entry in moved.items():
+            positions[tid] = {**positions.get(tid, {}), **entry}
+        for tid in removed:
+            positions.pop(tid, None)
+        canvas.positions = positions
+        self._defer(canvas.id, "positions", canvas)
+        return positions
     
     def delete(self, canvas_id: str) -> bool:
         """Delete a canvas from history"""
-        for idx, canvas in enumerate(self.canvases):
-            if canvas.id == canvas_id:
-                self.canvases.pop(idx)
-                self._save()
-                return True
-        return False
+        with self._lock:
+            if canvas_id not in self._index:
+                return False
+            self._unorder(canvas_id)
+            self._index.pop(canvas_id, None)
+            self._cache.pop(canvas_id, None)
+        self._defer(canvas_id, "delete", None)
+        return True
+    
+    def watch(self, fn):
+        self._watchers.append(fn)
+    
+    def _changed(self, cid: str):
+        for fn in list(self._watchers):
+            fn(cid)
+    
+    # 延迟写入：变更先在内存中合并，由后台线程按 flush_s 间隔（或关闭时）批量写入后端
+    def _defer(self, cid: str, kind: str, canvas: Optional[Canvas]):
+        if kind != "positions":
+            self._changed(cid)
+        with self._pending_lock:
+            prev = self._pending.get(cid)
+            if prev is not None:
+                self.stats["coalesced"] += 1
+                if kind == "positions" and prev[0] == "canvas":
+                    kind = "canvas"  # 整行写入已包含位置
+            self._pending[cid] = (kind, canvas)
+            if self.flush_s > 0 and self._flusher is None:  # 与入队同一把锁：并发调用只会启动一个写入线程
+                self._flusher = threading.Thread(target=self._flush_loop, name="canvas-flush", daemon=True)
+                self._flusher.start()
+        if self.flush_s <= 0:
+            self.flush()
+    
+    def _flush_loop(self):
+        while not self._closing.wait(self.flush_s):
+            self.flush()
+    
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            upserts = [c for kind, c in pending.values() if kind == "canvas"]
+            positions = {cid: c.positions for cid, (kind, c) in pending.items() if kind == "positions"}
+            deleted = [cid for cid, (kind, _) in pending.items() if kind == "delete"]
+            try:
+                self.backend.write_canvases(upserts, positions, deleted)
+                self.stats["flushes"] += 1
+                self.stats["written"] += len(pending)
+            except Exception as e:
+                print(f"[canvas] write-behind flush failed, will retry: {e}")
+                with self._pending_lock:
+                    for cid, item in pending.items():
+                        self._pending.setdefault(cid, item)  # 期间的新变更优先
+                self.stats["errors"] += 1
+                return 0
+            return len(pending)
+    
+    def close(self):
+        """停止后台线程并写完剩余变更（服务关闭时调用）"""
+        self._closing.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=5)
+        self.flush()
+    
+    def apply_remote(self, ids: List[str], removed: List[str], summaries: List[Dict[str, Any]]):
+        """其他 worker 增删改了画布：刷新这些画布的索引项，丢弃缓存的正文。
+        summaries 由调用方先在后端线程中读好（canvas_summaries），这里只改内存结构"""
+        with self._lock:
+            with self._pending_lock:
+                local = set(self._pending)
+            ids = [cid for cid in ids if cid not in local]  # 本进程还有未写入的变更，以本地为准
+            index = dict(self._index)
+            for cid in ids + [cid for cid in removed if cid not in local]:
+                self._cache.pop(cid, None)
+                index.pop(cid, None)
+            index.update((s['id'], s) for s in summaries if s['id'] in ids)
+            index = dict(sorted(index.items(), key=lambda kv: (kv[1]['created_at'], kv[0])))
+            self._index, self._order = index, [(s['created_at'], cid) for cid, s in index.items()]
+        for cid in ids + [cid for cid in removed if cid not in local]:
+            self._changed(cid)
+    
+    def summary(self, canvas_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            item = self._index.get(canvas_id)
+            return dict(item) if item is not None else None
     
     def get_list(self) -> List[dict]:
         """Get list of canvases (id, title, summary, created_at)"""
-        return [{
-            'id': c.id,
-            'title': c.title,
-            'summary': c.summary,
-            'created_at': c.created_at,
-            'topic_count': len(c.topics)
-        } for c in self.canvases]
+        with self._lock:
+            return [dict(self._index[cid]) for cid in reversed(self._index)]
     
     def get_by_id(self, canvas_id: str) -> Optional[Canvas]:
-        """Get a specific canvas by ID"""
-        for c in self.canvases:
-            if c.id == canvas_id:
-                return c
-        return None
+        """Get a specific canvas by ID（后端读取不持锁）"""
+        with self._lock:
+            if canvas_id not in self._index:
+                return None
+            canvas = self._lookup(canvas_id)
+        if canvas is None:
+            canvas = self.backend.get_canvas(canvas_id)
+        with self._lock:
+            if canvas_id not in self._index:
+                return None  # 读取期间被删除
+            if canvas is None:
+                self._unorder(canvas_id)
+                self._index.pop(canvas_id, None)
+                return None
+            cached = self._cache.get(canvas_id)
+            if cached is not None:
+                canvas = cached  # 读取期间别处已放进缓存（可能更新过），以缓存为准
+            self._remember(canvas)
+        return canvas
+    
+    def _lookup(self, canvas_id: str) -> Optional[Canvas]:
+        """缓存中或尚未写入后端的画布（调用方持有 _lock）"""
+        canvas = self._cache.get(canvas_id)
+        if canvas is None:
+            with self._pending_lock:
+                canvas = (self._pending.get(canvas_id) or (None, None))[1]
+        return canvas
+    
+    def peek(self, canvas_id: str) -> Optional[Canvas]:
+        """读取画布正文但不放进缓存（导出、维护任务）"""
+        with self._lock:
+            if canvas_id not in self._index:
+                return None
+            canvas = self._lookup(canvas_id)
+        return canvas or self.backend.get_canvas(canvas_id)
+    
+    def iter_canvases(self):
+        """逐个读取全部画布（维护任务用），不占满缓存"""
+        for cid in self.ids():
+            canvas = self.peek(cid)
+            if canvas is not None:
+                yield canvas
 
-canvas_store = CanvasStore(CANVAS_STORAGE_PATH)
+# 画布历史（首次访问或后台预热时才读取列表索引）
+_CANVAS_STORE: Optional[CanvasStore] = None
+_CANVAS_LOCK = threading.Lock()
+def get_canvas_store() -> CanvasStore:
+    global _CANVAS_STORE
+    if _CANVAS_STORE is None:
+        with _CANVAS_LOCK:
+            if _CANVAS_STORE is None:
+                _CANVAS_STORE = CanvasStore(get_state_backend())
+                mark_warm("canvas")
+    return _CANVAS_STORE
 
 # ---------------------
 # 工具函数
@@ -221,19 +937,50 @@ def one_line_json(s: str) -> str:
     return m.group(0) if m else "{}"
 
 # ---------------------
-# ASR：webm/opus → wav → Whisper
+# ASR：webm/opus → PCM(float32) → Whisper
 # ---------------------
-def webm_to_wav_bytes(webm_bytes: bytes, target_sr: int = 16000) -> bytes:
-    """将 WebM 音频转换为 WAV 格式"""
-    # 检查输入数据
+def check_webm_bytes(webm_bytes: bytes):
+    """基础校验：长度与 EBML 魔术字节"""
     if not webm_bytes or len(webm_bytes) < 100:
         raise Exception(f"WebM data too small: {len(webm_bytes)} bytes")
     
     # 检查 WebM 魔术字节（应该以 0x1A 0x45 0xDF 0xA3 开头）
-    if len(webm_bytes) >= 4:
-        header = webm_bytes[:4]
-        if header != b'\x1a\x45\xdf\xa3':
-            print(f"[webm] Warning: invalid WebM header: {header.hex()}")
+    header = webm_bytes[:4]
+    if header != b'\x1a\x45\xdf\xa3':
+        print(f"[webm] Warning: invalid WebM header: {header.hex()}")
+
+def decode_webm_pcm(webm_bytes: bytes, target_sr: int = ASR_SAMPLE_RATE) -> np.ndarray:
+    """内存解码：WebM/Opus → 单声道 float32 PCM（PyAV，无子进程、无临时文件）"""
+    import av  # faster-whisper 自带依赖
+    check_webm_bytes(webm_bytes)
+    
+    # 先把解码帧攒进 FIFO，再一次性重采样，避免逐帧调用的开销
+    fifo = av.audio.fifo.AudioFifo()
+    with av.open(io.BytesIO(webm_bytes), mode="r", metadata_errors="ignore") as container:
+        frames = container.decode(audio=0)
+        while True:
+            try:
+                frame = next(frames)
+            except StopIteration:
+                break
+            except av.error.InvalidDataError:
+                continue  # 跳过损坏帧
+            except av.error.EOFError:
+                break  # 末尾截断：保留已解码部分
+            frame.pts = None
+            fifo.write(frame)
+    
+    if fifo.samples == 0:
+        return np.zeros(0, dtype=np.float32)
+    resampler = av.audio.resampler.AudioResampler(format="flt", layout="mono", rate=target_sr)
+    chunks = [out.to_ndarray()[0] for out in resampler.resample(fifo.read())]
+    chunks += [out.to_ndarray()[0] for out in resampler.resample(None)]
+    return np.concatenate(chunks).astype(np.float32, copy=False)
+
+def webm_to_wav_bytes(webm_bytes: bytes, target_sr: int = ASR_SAMPLE_RATE) -> bytes:
+    """将 WebM 音频转换为 WAV 格式（ffmpeg 子进程，兜底路径）"""
+    import ffmpeg
+    check_webm_bytes(webm_bytes)
     
     # 使用更安全的临时文件命名，避免并发冲突
     in_fd, in_path = tempfile.mkstemp(suffix=".webm", prefix="audio_in_")
@@ -273,162 +1020,1238 @@ def webm_to_wav_bytes(webm_bytes: bytes, target_sr: int = 16000) -> bytes:
             except: 
                 pass
 
-def transcribe_chunk(webm_bytes: bytes) -> str:
-    """转写音频块"""
-    try:
-        # 转换格式
-        wav_bytes = webm_to_wav_bytes(webm_bytes)
-        
-        # 写入临时文件供 Whisper 使用
-        wav_fd, wav_path = tempfile.mkstemp(suffix=".wav", prefix="whisper_")
-        try:
-            os.write(wav_fd, wav_bytes)
-            os.close(wav_fd)
-            
-            # Whisper 转写
-            model = load_asr()
-            segments, _ = model.transcribe(
-                wav_path, vad_filter=True,
-                vad_parameters=dict(min_silence_duration_ms=500)
-            )
-            text = " ".join(s.text.strip() for s in segments)
-            return text.strip()
-        finally:
-            try: 
-                os.remove(wav_path)
-            except: 
-                pass
-    except Exception as e:
-        print(f"[asr] transcription error: {e}")
-        return ""
+def ffmpeg_decode_pcm(webm_bytes: bytes, target_sr: int = ASR_SAMPLE_RATE) -> np.ndarray:
+    """兜底解码：ffmpeg 转 WAV 后在内存中读取为 float32"""
+    import soundfile as sf
+    wav_bytes = webm_to_wav_bytes(webm_bytes, target_sr)
+    audio, _ = sf.read(io.BytesIO(wav_bytes), dtype="float32")
+    return audio
+
+class AsrResult(NamedTuple):
+    text: str
+    language: Optional[str] = None
+    language_probability: float = 0.0
+
+def transcribe_pcm(audio: np.ndarray, language: Optional[str] = None, prompt: Optional[str] = None) -> AsrResult:
+    """直接把 16kHz float32 数组交给 Whisper；language 已知时跳过语种检测"""
+    if audio.size == 0:
+        return AsrResult("", language)
+    model = load_asr()
+    segments, info = model.transcribe(
+        audio, vad_filter=True, language=language, initial_prompt=prompt or None,
+        vad_parameters=dict(min_silence_duration_ms=500)
+    )
+    text = " ".join(s.text.strip() for s in segments)
+    return AsrResult(text.strip(), info.language, info.language_probability)
 
 # ---------------------
-# LLM（Ollama）与提示词
+# 流式音频：每个 WebSocket 一个长连接解码器，服务端按停顿切段
 # ---------------------
-async def ollama_generate(prompt: str, temperature: float = 0.1, max_tokens: int = 128) -> str:
-    async with httpx.AsyncClient(timeout=40) as client:
-        r = await client.post(f"{OLLAMA_URL}/api/generate", json={
-            "model": OLLAMA_MODEL, "prompt": prompt, "stream": False,
-            "options": {"temperature": temperature, "num_predict": max_tokens}
-        })
-        r.raise_for_status()
-        return r.json().get("response", "").strip()
+EBML_MAGIC = b'\x1a\x45\xdf\xa3'
 
-def router_prompt(utter: str, snapshot: str) -> str:
-    # 话题路由 agent：平衡模式（智能分类）
-    return f"""
-You are a smart Topic Router. 
-Decide if the utterance belongs to an existing topic or starts a NEW one.
+class ByteFifo:
+    """线程安全的字节管道：WebSocket 写入，解码线程阻塞读取（不可 seek）"""
+    def __init__(self):
+        self._buf = bytearray()
+        self._cond = threading.Condition()
+        self._closed = False
+    
+    def write(self, data: bytes):
+        with self._cond:
+            self._buf += data
+            self._cond.notify_all()
+    
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+    
+    def read(self, n: int = -1) -> bytes:
+        with self._cond:
+            while not self._buf and not self._closed:
+                self._cond.wait()
+            if n < 0 or n > len(self._buf):
+                n = len(self._buf)
+            out = bytes(self._buf[:n])
+            del self._buf[:n]
+            return out
 
-Snapshot(existing_topics): {snapshot}
+class SpeechSegmenter:
+    """按停顿切分连续 PCM：帧能量检测 + 最长时长兜底"""
+    def __init__(self, sample_rate: int = ASR_SAMPLE_RATE, frame_ms: int = 30,
+                 pause_ms: int = STREAM_PAUSE_MS, max_segment_s: float = STREAM_MAX_SEGMENT_S,
+                 threshold: float = STREAM_ENERGY_THRESHOLD, min_speech_ms: int = 300, preroll_ms: int = 200):
+        self.frame_len = sample_rate * frame_ms // 1000
+        self.pause_frames = max(1, pause_ms // frame_ms)
+        self.max_frames = max(1, int(max_segment_s * 1000) // frame_ms)
+        self.min_speech_frames = max(1, min_speech_ms // frame_ms)
+        self.threshold = threshold
+        self._rest = np.zeros(0, dtype=np.float32)          # 不足一帧的尾巴
+        self.pad_frames = max(1, preroll_ms // frame_ms)
+        self._preroll = deque(maxlen=self.pad_frames)       # 语音开始前的少量静音，避免吞字
+        self._frames: List[np.ndarray] = []                 # 当前段（滚动缓冲）
+        self._speech_frames = 0
+        self._silence_run = 0
+        self.segment_index = 0                              # 每开始一段 +1，用于丢弃过期的中间结果
+    
+    def feed(self, pcm: np.ndarray) -> List[np.ndarray]:
+        """送入任意长度 PCM，返回本次切出的完整语音段"""
+        segments = []
+        data = np.concatenate([self._rest, pcm]) if self._rest.size else pcm
+        n_full = data.size // self.frame_len
+        for i in range(n_full):
+            frame = data[i * self.frame_len:(i + 1) * self.frame_len]
+            seg = self._push_frame(frame)
+            if seg is not None:
+                segments.append(seg)
+        self._rest = data[n_full * self.frame_len:].copy()
+        return segments
+    
+    def _push_frame(self, frame: np.ndarray) -> Optional[np.ndarray]:
+        voiced = float(np.sqrt(np.mean(frame * frame))) >= self.threshold
+        if not self._frames:
+            if not voiced:
+                self._preroll.append(frame)
+                return None
+            self._frames.extend(self._preroll)
+            self._preroll.clear()
+            self.segment_index += 1
+        self._frames.append(frame)
+        if voiced:
+            self._speech_frames += 1
+            self._silence_run = 0
+        else:
+            self._silence_run += 1
+        if self._silence_run >= self.pause_frames or len(self._frames) >= self.max_frames:
+            return self._cut()
+        return None
+    
+    def _cut(self) -> Optional[np.ndarray]:
+        """结束当前段；语音太短（咳嗽、点击声）直接丢弃"""
+        frames, speech = self._frames, self._speech_frames
+        # 只保留一小段结尾静音
+        if self._silence_run > self.pad_frames:
+            frames = frames[:len(frames) - (self._silence_run - self.pad_frames)]
+        self._frames = []
+        self._speech_frames = 0
+        self._silence_run = 0
+        if speech < self.min_speech_frames or not frames:
+            return None
+        return np.concatenate(frames)
+    
+    def open_segment(self) -> Optional[Tuple[int, np.ndarray]]:
+        """当前尚未结束的语音段（用于中间字幕），语音不足时返回 None"""
+        if not self._frames or self._speech_frames < self.min_speech_frames:
+            return None
+        return self.segment_index, np.concatenate(self._frames)
+    
+    def flush(self) -> Optional[np.ndarray]:
+        """流结束：把未完成的段也交出去"""
+        if self._frames and self._rest.size:
+            self._frames.append(self._rest)
+        self._rest = np.zeros(0, dtype=np.float32)
+        return self._cut() if self._frames else None
 
-Utterance: \"\"\"{utter}\"\"\"
+class AudioStream:
+    """单个 WebSocket 的长连接解码器：WebM 字节流 → 16kHz PCM → 语音段"""
+    def __init__(self, on_segment):
+        self.on_segment = on_segment    # 在解码线程中回调，需自行处理线程安全
+        self._fifo: Optional[ByteFifo] = None
+        self._thread: Optional[threading.Thread] = None
+        self._segmenter: Optional[SpeechSegmenter] = None
+        self._lock = threading.Lock()   # 保护分段器：解码线程写，事件循环读中间结果
+        self._failed = False
+    
+    def open_segment(self) -> Optional[Tuple[int, np.ndarray]]:
+        with self._lock:
+            return self._segmenter.open_segment() if self._segmenter else None
+    
+    def feed(self, data: bytes):
+        # 新的 EBML 头 = 新的 WebM 流（客户端重启录音器，或旧版客户端每块都是完整文件）
+        if data[:4] == EBML_MAGIC:
+            self._start()
+        if self._fifo is None or self._failed:
+            print(f"[stream] dropping {len(data)} bytes without WebM header")
+            return
+        self._fifo.write(data)
+    
+    def close(self):
+        """结束输入并等待解码线程把剩余音频切完（阻塞，需在线程池中调用）"""
+        thread = self._thread
+        self._end_input()
+        if thread is not None:
+            thread.join(timeout=5)
+    
+    def _end_input(self):
+        if self._fifo is not None:
+            self._fifo.close()
+        self._fifo = None
+        self._thread = None
+    
+    def _start(self):
+        # 旧流的解码线程读到 EOF 后会自行切出最后一段并退出
+        self._end_input()
+        self._failed = False
+        self._fifo = ByteFifo()
+        with self._lock:
+            self._segmenter = SpeechSegmenter()
+        self._thread = threading.Thread(target=self._run, args=(self._fifo, self._segmenter), daemon=True)
+        self._thread.start()
+    
+    def _run(self, fifo: ByteFifo, segmenter: SpeechSegmenter):
+        import av
+        resampler = av.audio.resampler.AudioResampler(format="flt", layout="mono", rate=ASR_SAMPLE_RATE)
+        try:
+            with av.open(fifo, mode="r", format="webm", metadata_errors="ignore") as container:
+                frames = container.decode(audio=0)
+                while True:
+                    try:
+                        frame = next(frames)
+                    except StopIteration:
+                        break
+                    except av.error.InvalidDataError:
+                        continue
+                    except av.error.EOFError:
+                        break
+                    frame.pts = None
+                    for out in resampler.resample(frame):
+                        with self._lock:
+                            segs = segmenter.feed(out.to_ndarray()[0])
+                        for seg in segs:
+                            self.on_segment(seg)
+        except Exception as e:
+            self._failed = True
+            print(f"[stream] decoder stopped: {e}")
+        with self._lock:
+            tail = segmenter.flush()
+        if tail is not None:
+            self.on_segment(tail)
 
-RULES:
-1. **MERGE** if the utterance continues the same general theme or adds detail to an existing topic.
-   - Example: "Visiting Dali" -> merges into "Travel Plan".
-   - Example: "Ticket prices are high" -> merges into "Travel Plan" (related aspect).
+# 全部会话累计的门限统计（/stats/asr）
+GATE_TOTALS: Dict[str, float] = {"segments": 0, "skipped": 0, "seconds": 0.0, "skipped_seconds": 0.0}
 
-2. **CREATE NEW** if the utterance shifts to a DISTINCTLY DIFFERENT subject or a new standalone idea.
-   - Example: "By the way, I'm buying a new camera" -> NEW topic "Photography Gear".
-   - Example: "This reminds me of a writing project" -> NEW topic "Creative Writing".
+class VoiceGate:
+    """ASR 前置语音门限：静音/近静音的段在进入队列前丢弃，并按会话统计省下的工作量"""
+    def __init__(self, mode: str = ASR_VAD, min_speech_ms: int = ASR_VAD_MIN_SPEECH_MS,
+                 threshold: float = STREAM_ENERGY_THRESHOLD, frame_ms: int = 30):
+        self.mode = mode
+        self.min_speech_ms = min_speech_ms
+        self.threshold = threshold
+        self.frame_len = ASR_SAMPLE_RATE * frame_ms // 1000
+        self.stats: Dict[str, float] = {"segments": 0, "skipped": 0, "seconds": 0.0, "skipped_seconds": 0.0}
+    
+    def speech_ms(self, audio: np.ndarray) -> float:
+        """估计段内语音时长（毫秒）"""
+        if self.mode == "silero":
+            from faster_whisper.vad import get_speech_timestamps, VadOptions
+            chunks = get_speech_timestamps(audio, VadOptions(min_silence_duration_ms=300))
+            return sum(c["end"] - c["start"] for c in chunks) * 1000 / ASR_SAMPLE_RATE
+        # energy：帧 RMS 高于阈值，且明显高于本段底噪（10% 分位数，上限为阈值本身，避免持续人声被当成底噪）
+        n = audio.size // self.frame_len
+        if n == 0:
+            return 0.0
+        frames = audio[:n * self.frame_len].reshape(n, self.frame_len)
+        rms = np.sqrt(np.mean(frames * frames, axis=1))
+        floor = min(float(np.percentile(rms, 10)), self.threshold)
+        voiced = int(np.count_nonzero(rms >= max(self.threshold, floor * 2.5)))
+        return voiced * self.frame_len * 1000 / ASR_SAMPLE_RATE
+    
+    def admit(self, audio: np.ndarray) -> bool:
+        """返回 True 表示该段值得送去转写"""
+        seconds = audio.size / ASR_SAMPLE_RATE
+        ok = self.mode == "off" or self.speech_ms(audio) >= self.min_speech_ms
+        for stats in (self.stats, GATE_TOTALS):
+            stats["segments"] += 1
+            stats["seconds"] += seconds
+            if not ok:
+                stats["skipped"] += 1
+                stats["skipped_seconds"] += seconds
+        return ok
 
-3. **LABELING**:
-   - New labels MUST be specific English phrases (1-3 words) such as "Travel Plan", "Camera Gear", "Creative Project".
-   - NEVER use generic names like "Topic" or "General".
-   - If the utterance fits an EXISTING label or clearly overlaps existing keywords/summary, prefer MERGE/APPEND instead of creating another topic with the same label.
+# 中文/日文按字切分，其余按空格切词；保留前导空白以便原样拼回
+_TEXT_UNIT_RE = re.compile(r"\s*(?:[\u3040-\u30ff\u3400-\u9fff]|[^\s\u3040-\u30ff\u3400-\u9fff]+)")
 
-Return ONE JSON object:
-- To append: {{"action":"append_point","topic_id":"<id>","text":"<short point>"}}
-- To create: {{"action":"create_topic","text":"<short point>"}}
-"""
+def text_units(text: str) -> List[str]:
+    return _TEXT_UNIT_RE.findall(text or "")
 
-def compress_prompt(points: str, cur_label: str) -> str:
-    # 话题压缩：关键词 + ≤25词总结 + 修正单词标签
-    return f"""
-Compress topic info from recent points.
+def _unit_key(unit: str) -> str:
+    return unit.strip().lower().strip(".,!?;:，。！？；：、")
 
-Recent points:
-{points}
+class LocalAgreement:
+    """LocalAgreement-2：连续两次解码结果的公共前缀视为稳定；已提交部分只增不改"""
+    def __init__(self):
+        self.committed: List[str] = []
+        self._prev: List[str] = []
+    
+    def update(self, hypothesis: str) -> Tuple[str, str]:
+        """送入最新一次解码结果，返回 (已提交文本, 暂定文本)"""
+        units = text_units(hypothesis)
+        n = 0
+        while n < min(len(units), len(self._prev)) and _unit_key(units[n]) == _unit_key(self._prev[n]):
+            n += 1
+        # 只有与已提交部分一致时才推进，避免已显示的字幕被改写
+        k = len(self.committed)
+        if n > k and [_unit_key(u) for u in units[:k]] == [_unit_key(u) for u in self.committed]:
+            self.committed = units[:n]
+        self._prev = units
+        tentative = units[len(self.committed):]
+        return "".join(self.committed).strip(), "".join(tentative)
 
-Current label: {cur_label}
+def strip_seam_overlap(prev_text: str, text: str, max_units: int = 8, min_units: int = 2) -> str:
+    """去掉新段开头与上一段结尾重复的词（切段边界两侧常被各识别一次）"""
+    prev, cur = text_units(prev_text), text_units(text)
+    prev_keys = [_unit_key(u) for u in prev[-max_units:]]
+    cur_keys = [_unit_key(u) for u in cur[:max_units]]
+    for k in range(min(len(prev_keys), len(cur_keys)), min_units - 1, -1):
+        if prev_keys[-k:] == cur_keys[:k]:
+            return "".join(cur[k:]).strip()
+    return text
 
-Return JSON:
-{{
-  "keyphrases": ["k1","k2","k3"],
-  "summary": "<Short English summary, max 15 words>",
-  "label": "<SpecificEnglishLabel (1-3 words)>"
-}}
+class AsrSessionState:
+    """会话级解码状态：语言在首个高置信度结果后锁定；上一段结尾作为 initial_prompt；去掉段间重叠"""
+    def __init__(self, language: Optional[str] = ASR_LANGUAGE, lock_prob: float = ASR_LANGUAGE_LOCK_PROB,
+                 prompt_chars: int = ASR_PROMPT_CHARS):
+        self.language = language
+        self.lock_prob = lock_prob
+        self.prompt_chars = prompt_chars
+        self.tail = ""
+    
+    @property
+    def prompt(self) -> Optional[str]:
+        return self.tail[-self.prompt_chars:] if self.tail and self.prompt_chars > 0 else None
+    
+    def accept(self, result: AsrResult) -> str:
+        """接收一段最终结果：必要时锁定语言，返回去重后的文本并更新上下文"""
+        if self.language is None and result.language and result.language_probability >= self.lock_prob:
+            self.language = result.language
+            print(f"[asr] session language locked: {self.language} ({result.language_probability:.2f})")
+        text = strip_seam_overlap(self.tail, result.text)
+        if text:
+            self.tail = (self.tail + " " + text).strip()[-max(self.prompt_chars, 64) * 2:]  # 去重叠至少要看上一段结尾；ASR_PROMPT_CHARS=0 也不无限增长
+        return text
 
-IMPORTANT:
-- Label MUST be specific English (e.g. "Travel Plan", "Photography"), NOT "Topic".
-- Summary MUST be in English.
-- Only JSON.
-"""
+# ---------------------
+# ASR 调度：收集所有会话的待转写段，攒成微批一次推理
+# ---------------------
+def whisper_batch_decode(model, audios: List[np.ndarray], languages: List[Optional[str]],
+                         prompts: List[Optional[str]]) -> List[Optional[AsrResult]]:
+    """多段音频（各 ≤30s）共用一次 encoder + generate 批推理；已锁定语言的段不再检测。
 
-def normalize_keyphrases(klist: List[str]) -> List[str]:
-    """Deduplicate keyphrases case-insensitively, keep order, trim length."""
-    seen = set()
-    result = []
-    for k in klist:
-        if not isinstance(k, str):
-            continue
-        trimmed = k.strip()
-        if not trimmed:
+    批推理只跑一次 beam search，没有 faster-whisper 的温度回退。压缩比超过
+    compression_ratio_threshold（2.4，多为重复循环）或平均 log-prob 低于
+    log_prob_threshold（-1.0）的段返回 None，由调用方用 transcribe_pcm 单独重解码。
+    """
+    import ctranslate2
+    from faster_whisper.tokenizer import Tokenizer
+    from faster_whisper.transcribe import get_compression_ratio, get_suppressed_tokens
+    
+    fe = model.feature_extractor
+    feats = [fe(a, padding=True)[:, :fe.nb_max_frames] for a in audios]
+    batch = np.ascontiguousarray(np.stack(feats), dtype=np.float32)
+    encoder_output = model.model.encode(ctranslate2.StorageView.from_array(batch))
+    
+    multilingual = model.model.is_multilingual
+    langs: List[Tuple[str, float]] = [(lang, 1.0) if lang else ("en", 1.0) for lang in languages]
+    if multilingual and any(lang is None for lang in languages):
+        # 每段取概率最高的语言，形如 ("<|zh|>", 0.97)
+        detected = model.model.detect_language(encoder_output)
+        langs = [(lang, 1.0) if lang else (res[0][0][2:-2], res[0][1]) for lang, res in zip(languages, detected)]
+    tokenizers = [Tokenizer(model.hf_tokenizer, multilingual, task="transcribe", language=lang) for lang, _ in langs]
+    prompt_tokens = []
+    for tok, prompt in zip(tokenizers, prompts):
+        previous = tok.encode(" " + prompt.strip()) if prompt else []
+        prompt_tokens.append(model.get_prompt(tok, previous, without_timestamps=True))
+    # generate 一批只接受一组 suppress_tokens；这些都是特殊 token 与标点 id，与语言无关，各段相同
+    suppress = get_suppressed_tokens(tokenizers[0], [-1])
+    assert all(get_suppressed_tokens(tok, [-1]) == suppress for tok in tokenizers[1:])
+    
+    results = model.model.generate(
+        encoder_output, prompt_tokens,
+        beam_size=5, max_length=model.max_length,
+        return_scores=True, return_no_speech_prob=True,
+        suppress_blank=True, suppress_tokens=suppress,
+    )
+    out: List[Optional[AsrResult]] = []
+    for res, tok, (lang, prob) in zip(results, tokenizers, langs):
+        tokens = res.sequences_ids[0]
+        avg_logprob = res.scores[0] * len(tokens) / (len(tokens) + 1)
+        # 与 Whisper 相同的静音判定：no_speech 高且置信度低
+        if res.no_speech_prob > 0.6 and avg_logprob < -1.0:
+            out.append(AsrResult("", lang, prob))
             continue
-        key = trimmed.lower()
-        if key in seen:
+        text = tok.decode(tokens).strip()
+        if get_compression_ratio(text) > 2.4 or avg_logprob < -1.0:
+            out.append(None)  # 疑似重复循环 / 低置信度：交给 transcribe_pcm 的温度回退
             continue
-        seen.add(key)
-        result.append(trimmed[:30])
-    return result[:5]
+        out.append(AsrResult(text, lang, prob))
+    return out
 
-def normalize_topic_inplace(topic: "Topic"):
-    """Normalize label/keyphrases on a Topic instance."""
-    topic.label = normalize_label(topic.label)
-    topic.keyphrases = normalize_keyphrases(topic.keyphrases)
+def transcribe_batch(audios: List[np.ndarray], languages: Optional[List[Optional[str]]] = None,
+                     prompts: Optional[List[Optional[str]]] = None) -> List[AsrResult]:
+    """批量转写；单段或超过 30s 的段走常规 transcribe（带 VAD）"""
+    languages = languages or [None] * len(audios)
+    prompts = prompts or [None] * len(audios)
+    model = load_asr()
+    max_samples = model.feature_extractor.n_samples
+    results: List[Optional[AsrResult]] = [None] * len(audios)
+    batchable = [i for i, a in enumerate(audios) if 0 < a.size <= max_samples]
+    if len(batchable) > 1:
+        try:
+            decoded = whisper_batch_decode(model, [audios[i] for i in batchable],
+                                           [languages[i] for i in batchable], [prompts[i] for i in batchable])
+            for i, res in zip(batchable, decoded):
+                results[i] = res  # None：未通过质量检查，下面单独重解码
+        except Exception as e:
+            print(f"[asr] batch decode failed, decoding one by one: {e}")
+    return [res if res is not None else transcribe_pcm(a, lang, prompt)
+            for res, a, lang, prompt in zip(results, audios, languages, prompts)]
 
-def sanitize_positions(payload: Dict[str, Any]) -> Dict[str, dict]:
-    """Keep only numeric x/y/size for ripple/map/keywords."""
-    if not isinstance(payload, dict):
-        return {}
-    cleaned = {}
-    for tid, entry in payload.items():
-        if not isinstance(entry, dict):
-            continue
-        out = {}
-        rp = entry.get("ripple") or entry
-        if isinstance(rp, dict) and all(k in rp for k in ("x", "y")):
-            try:
-                rx = float(rp["x"]); ry = float(rp["y"])
-                rsize = float(rp["size"]) if "size" in rp else None
-                out["ripple"] = {"x": rx, "y": ry}
-                if rsize is not None:
-                    out["ripple"]["size"] = rsize
-            except Exception:
-                pass
-        mp = entry.get("map")
-        if isinstance(mp, dict) and all(k in mp for k in ("x", "y")):
-            try:
-                out["map"] = {"x": float(mp["x"]), "y": float(mp["y"])}
-            except Exception:
-                pass
-        kw = entry.get("keywords")
-        if isinstance(kw, dict):
-            kw_out = {}
-            for kk, kv in kw.items():
-                if isinstance(kv, dict) and all(k in kv for k in ("x", "y")):
-                    try:
-                        kw_out[kk] = {"x": float(kv["x"]), "y": float(kv["y"])}
-                    except Exception:
-                        pass
-            if kw_out:
-                out["keywords"] = kw_out
-        if out:
-            cleaned[tid] = out
-    return cleaned
+def pack_shared_pcm(audios: List[np.ndarray]):
+    """把一批 PCM 连续写入一块共享内存，返回 (shm, 每段长度)"""
+    from multiprocessing import shared_memory
+    lengths = [int(a.size) for a in audios]
+    shm = shared_memory.SharedMemory(create=True, size=max(4, sum(lengths) * 4))
+    buf = np.ndarray((sum(lengths),), dtype=np.float32, buffer=shm.buf)
+    offset = 0
+    for a, n in zip(audios, lengths):
+        buf[offset:offset + n] = a
+        offset += n
+    del buf
+    return shm, lengths
 
-def merge_topics_in_map(topics: Dict[str, "Topic"], keep_id: str, drop_id: str) -> str:
+def _asr_worker_init(cpu_threads: int):
+    """工作进程初始化：固定线程数并预加载模型"""
+    global ASR_CPU_THREADS
+    ASR_CPU_THREADS = cpu_threads
+    load_asr()
+
+def _asr_worker_run(shm_name: str, lengths: List[int], languages: List[Optional[str]],
+                    prompts: List[Optional[str]]) -> List[AsrResult]:
+    """工作进程：从共享内存取出这一批 PCM 并转写"""
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        buf = np.ndarray((sum(lengths),), dtype=np.float32, buffer=shm.buf)
+        audios, offset = [], 0
+        for n in lengths:
+            audios.append(buf[offset:offset + n].copy())
+            offset += n
+        del buf
+    finally:
+        shm.close()
+    return transcribe_batch(audios, languages, prompts)
+
+@dataclass
+class AsrJob:
+    audio: np.ndarray
+    future: asyncio.Future
+    language: Optional[str] = None
+    prompt: Optional[str] = None
+
+class AsrScheduler:
+    """跨会话微批调度：最多 max_batch 段或等待 max_wait_ms 后一起推理，结果按 future 回到各自的连接。
+    workers > 0 时每批交给独立的工作进程（各自加载模型），否则在专用线程中推理。"""
+    def __init__(self, max_batch: int = ASR_BATCH_SIZE, max_wait_ms: int = ASR_BATCH_WAIT_MS,
+                 workers: int = ASR_WORKERS, cpu_threads: int = ASR_CPU_THREADS, busy_backlog: int = ASR_BUSY_BACKLOG):
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self.workers = max(0, workers)
+        self.cpu_threads = cpu_threads
+        self.concurrency = max(1, self.workers)
+        self.busy_backlog = busy_backlog or self.max_batch * self.concurrency * 2
+        self.stats = {"batches": 0, "segments": 0, "max_batch": 0}
+        self.in_flight = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._task: Optional[asyncio.Task] = None
+        self._pool = None
+    
+    @property
+    def backlog(self) -> int:
+        """排队 + 推理中的段数"""
+        return (self._queue.qsize() if self._queue else 0) + self.in_flight
+    
+    @property
+    def saturated(self) -> bool:
+        return self.backlog >= self.busy_backlog
+    
+    async def transcribe(self, audio: np.ndarray, language: Optional[str] = None,
+                         prompt: Optional[str] = None) -> AsrResult:
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put(AsrJob(audio=audio, future=fut, language=language, prompt=prompt))
+        return await fut
+    
+    def _ensure_started(self):
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._slots = asyncio.Semaphore(self.concurrency)
+            self._task = asyncio.create_task(self._run())
+    
+    def _executor(self):
+        if self._pool is None:
+            if self.workers > 0:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # spawn：不继承事件循环/线程状态，每个进程独立加载模型
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_asr_worker_init, initargs=(self.cpu_threads,))
+            else:
+                from concurrent.futures import ThreadPoolExecutor
+                self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="asr")
+        return self._pool
+    
+    async def warm(self):
+        """预热：在每个推理进程/线程里各加载一次模型并跑一次转写"""
+        loop = asyncio.get_running_loop()
+        executor = self._executor()
+        await asyncio.gather(*[loop.run_in_executor(executor, warm_asr) for _ in range(self.concurrency)])
+    
+    def shutdown(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+    
+    async def _collect(self) -> List[AsrJob]:
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                # 时间到了也顺手带上已在排队的
+                while len(batch) < self.max_batch and not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                continue
+        return batch
+    
+    async def _run(self):
+        while True:
+            # 有空闲的工作进程才开始凑下一批，排队期间新到的段自然并入
+            await self._slots.acquire()
+            batch = await self._collect()
+            self.in_flight += len(batch)
+            asyncio.create_task(self._process(batch))
+    
+    async def _process(self, batch: List[AsrJob]):
+        loop = asyncio.get_running_loop()
+        audios = [j.audio for j in batch]
+        languages = [j.language for j in batch]
+        prompts = [j.prompt for j in batch]
+        t0 = time.time()
+        try:
+            if self.workers > 0:
+                shm, lengths = pack_shared_pcm(audios)
+                try:
+                    results = await loop.run_in_executor(
+                        self._executor(), _asr_worker_run, shm.name, lengths, languages, prompts)
+                finally:
+                    shm.close()
+                    shm.unlink()
+            else:
+                results = await loop.run_in_executor(self._executor(), transcribe_batch, audios, languages, prompts)
+            mark_warm("asr")  # 工作进程里的模型不经过本进程的 load_asr
+        except Exception as e:
+            from concurrent.futures.process import BrokenProcessPool
+            print(f"[asr] batch error: {e}")
+            if isinstance(e, BrokenProcessPool):
+                self._pool = None  # 工作进程崩溃：下一批重建进程池
+            results = [AsrResult("") for _ in batch]
+        finally:
+            self.in_flight -= len(batch)
+            self._slots.release()
+        self.stats["batches"] += 1
+        self.stats["segments"] += len(batch)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        print(f"[asr] batch of {len(batch)} in {time.time()-t0:.2f}s")
+        for job, res in zip(batch, results):
+            if not job.future.done():
+                job.future.set_result(res)
+
+class SegmentQueue:
+    """会话级有界队列：积压超过上限时丢弃最旧的段（drop_oldest），或把最旧的两段拼成一段（merge）"""
+    def __init__(self, maxsize: int = ASR_SESSION_QUEUE, policy: str = ASR_QUEUE_POLICY,
+                 max_merge_samples: int = 30 * ASR_SAMPLE_RATE):
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.max_merge_samples = max_merge_samples
+        self.dropped = 0
+        self._items: deque = deque()
+        self._ready = asyncio.Event()
+    
+    def __len__(self) -> int:
+        return len(self._items)
+    
+    def put(self, seg: np.ndarray) -> bool:
+        """入队；返回 False 表示发生了溢出（已按策略丢弃或合并）"""
+        self._items.append(seg)
+        self._ready.set()
+        if len(self._items) <= self.maxsize:
+            return True
+        self.dropped += 1
+        if (self.policy == "merge" and len(self._items) >= 2
+                and self._items[0].size + self._items[1].size <= self.max_merge_samples):
+            first = self._items.popleft()
+            second = self._items.popleft()
+            self._items.appendleft(np.concatenate([first, second]))
+        else:
+            self._items.popleft()
+        return False
+    
+    async def get(self) -> np.ndarray:
+        while not self._items:
+            self._ready.clear()
+            await self._ready.wait()
+        return self._items.popleft()
+
+asr_scheduler = AsrScheduler()
+
+# ---------------------
+# LLM（Ollama）与提示词
+# ---------------------
+class LLMUnavailable(Exception):
+    """熔断打开：Ollama 不可用时快速失败，不再等待超时"""
+
+class LLMMalformedOutput(ValueError):
+    """多次重试后模型输出仍不是合法 JSON 对象"""
+
+class LLMStreamError(Exception):
+    """Ollama 在流式响应中途返回 {"error": ...}（如推理进程崩溃、显存不足）：按服务端故障处理"""
+
+class JsonObjectScanner:
+    """增量扫描流式输出：跟踪括号深度与字符串/转义状态，第一个顶层 {...} 闭合时给出其文本"""
+    def __init__(self):
+        self.text = ""
+        self.result: Optional[str] = None
+        self._start = -1
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+    
+    def feed(self, chunk: str) -> Optional[str]:
+        if self.result is not None:
+            return self.result
+        offset = len(self.text)
+        self.text += chunk
+        for i in range(offset, len(self.text)):
+            ch = self.text[i]
+            if self._depth == 0:
+                if ch == "{":
+                    self._start, self._depth = i, 1
+                continue
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == "{":
+                self._depth += 1
+            elif ch == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    self.result = self.text[self._start:i + 1]
+                    return self.result
+        return None
+
+class CircuitBreaker:
+    """连续失败 max_failures 次后打开；冷却期过后放行一次探测请求（半开），成功即关闭"""
+    def __init__(self, max_failures: int = OLLAMA_BREAKER_FAILURES, cooldown_s: float = OLLAMA_BREAKER_COOLDOWN_S):
+        self.max_failures = max(1, max_failures)
+        self.cooldown_s = cooldown_s
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probing = False
+    
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown_s else "open"
+    
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+    
+    def release_probe(self):
+        """探测请求没有以成功 / 瞬时错误收场（非瞬时错误、被取消）：同样算一次失败，免得半开状态卡住"""
+        if self._probing:
+            self.record_failure()
+    
+    def record_failure(self):
+        self.failures += 1
+        self._probing = False
+        if self.failures >= self.max_failures:
+            if self.opened_at is None:
+                print(f"[llm] circuit open after {self.failures} failures")
+            self.opened_at = time.monotonic()
+
+class LLMCache:
+    """按内容寻址的 LLM 结果缓存：key = hash(模型, 选项, 规范化提示词)；LRU + TTL，可选追加写入的 JSONL 持久化"""
+    def __init__(self, max_entries: int = LLM_CACHE_SIZE, ttl_s: float = LLM_CACHE_TTL_S, path: str = LLM_CACHE_PATH,
+                 flush_s: float = 1.0):
+        self.max_entries = max(0, max_entries)
+        self.ttl_s = ttl_s
+        self.path = path or None
+        self.flush_s = flush_s
+        self._entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()  # key → (写入时间, 值)
+        self._appended = 0
+        self._pending: List[str] = []    # 待追加的 JSONL 行
+        self._rewrite = False            # True：_pending 是全量快照，整文件重写
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closing = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        self.stats: Dict[str, int] = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+        if self.path and self.max_entries:
+            self._load()
+    
+    @staticmethod
+    def key(model: str, options: Dict[str, Any], prompt: str, kind: str = "text") -> str:
+        normalized = re.sub(r"\s+", " ", prompt).strip()  # 空白差异不影响命中
+        meta = json.dumps({"model": model, "options": options, "kind": kind}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(f"{meta}\n{normalized}".encode("utf-8")).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        item = self._entries.get(key)
+        if item is None:
+            self.stats["misses"] += 1
+            return None
+        if time.time() - item[0] > self.ttl_s:
+            self._entries.pop(key, None)
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(key)
+        self.stats["hits"] += 1
+        return item[1]
+    
+    def put(self, key: str, value: str):
+        if not self.max_entries:
+            return
+        ts = time.time()
+        self._entries[key] = (ts, value)
+        self._entries.move_to_end(key)
+        self.stats["stores"] += 1
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats["evictions"] += 1
+        if self.path:
+            self._enqueue(key, ts, value)
+    
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        now = time.time()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    self._appended += 1
+                    try:
+                        row = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # 进程中断留下的半行
+                    if now - row.get("ts", 0) <= self.ttl_s:
+                        self._entries[row["key"]] = (row["ts"], row["value"])
+                        self._entries.move_to_end(row["key"])
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            print(f"[llm] cache loaded {len(self._entries)} entries from {self.path}")
+        except Exception as e:
+            print(f"[llm] failed to load cache: {e}")
+    
+    @staticmethod
+    def _row(key: str, ts: float, value: str) -> str:
+        return json.dumps({"key": key, "ts": ts, "value": value}, ensure_ascii=False) + "\n"
+    
+    # 延迟写入：put 只在内存中排队（事件循环上不碰文件），由后台线程按 flush_s 间隔批量追加
+    def _enqueue(self, key: str, ts: float, value: str):
+        with self._pending_lock:
+            self._appended += 1
+            if self._appended > 2 * self.max_entries:
+                # 追加日志超过上限两倍：改为用当前条目的快照整文件重写一次
+                self._pending = [self._row(k, t, v) for k, (t, v) in self._entries.items()]
+                self._rewrite = True
+                self._appended = len(self._entries)
+            else:
+                self._pending.append(self._row(key, ts, value))
+            if self.flush_s > 0 and self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="llm-cache-flush", daemon=True)
+                self._flusher.start()
+        if self.flush_s <= 0:
+            self.flush()
+    
+    def _flush_loop(self):
+        while not self._closing.wait(self.flush_s):
+            self.flush()
+    
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._pending_lock:
+                lines, rewrite = self._pending, self._rewrite
+                self._pending, self._rewrite = [], False
+            if not lines and not rewrite:
+                return 0
+            try:
+                if rewrite:
+                    tmp = self.path + ".tmp"
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        f.writelines(lines)
+                    os.replace(tmp, self.path)
+                else:
+                    with open(self.path, "a", encoding="utf-8") as f:
+                        f.writelines(lines)
+            except Exception as e:
+                print(f"[llm] failed to persist {len(lines)} cache entries: {e}")
+                return 0
+            return len(lines)
+    
+    def close(self):
+        """停止后台线程并写完剩余条目（服务关闭时调用）"""
+        self._closing.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=5)
+        if self.path:
+            self.flush()
+    
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats, "entries": len(self._entries), "persistent": bool(self.path),
+            "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else None,
+        }
+
+class OllamaClient:
+    """长连接 Ollama 客户端：keep-alive 连接池 + 并发上限 + 抖动退避重试 + 熔断 + 调用统计"""
+    def __init__(self, base_url: str = OLLAMA_URL, model: str = OLLAMA_MODEL, concurrency: int = OLLAMA_CONCURRENCY,
+                 timeout_s: float = OLLAMA_TIMEOUT_S, retries: int = OLLAMA_RETRIES):
+        self.base_url = base_url
+        self.model = model
+        self.concurrency = max(1, concurrency)
+        self.timeout_s = timeout_s
+        self.retries = max(0, retries)
+        self.breaker = CircuitBreaker()
+        self.cache = LLMCache()
+        self.stats: Dict[str, float] = {
+            "calls": 0, "failures": 0, "retries": 0, "rejected": 0, "early_stops": 0, "malformed": 0, "bad_lines": 0,
+            "prompt_tokens": 0, "completion_tokens": 0, "latency_s": 0.0,
+        }
+        self.recent_latency: deque = deque(maxlen=200)
+        self._client: Optional[httpx.AsyncClient] = None
+        self._sem: Optional[asyncio.Semaphore] = None
+    
+    def _ensure_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, timeout=self.timeout_s,
+                limits=httpx.Limits(max_connections=self.concurrency * 2,
+                                    max_keepalive_connections=self.concurrency, keepalive_expiry=120))
+            self._sem = asyncio.Semaphore(self.concurrency)
+        return self._client
+    
+    async def start(self):
+        self._ensure_client()
+    
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        await asyncio.get_running_loop().run_in_executor(None, self.cache.close)  # 写完排队的缓存条目
+    
+    @staticmethod
+    def _is_transient(e: Exception) -> bool:
+        if isinstance(e, (httpx.TransportError, LLMStreamError)):
+            return True  # 连接失败、超时、连接被重置、流中途报错
+        if isinstance(e, httpx.HTTPStatusError):
+            return e.response.status_code >= 500 or e.response.status_code == 429
+        return False
+    
+    def _body(self, prompt: str, temperature: float, max_tokens: int, stream: bool,
+              format: Any = None) -> Dict[str, Any]:
+        body = {
+            "model": self.model, "prompt": prompt, "stream": stream,
+            "options": {"temperature": temperature, "num_predict": max_tokens}
+        }
+        if OLLAMA_NUM_CTX > 0:
+            body["options"]["num_ctx"] = OLLAMA_NUM_CTX
+        if OLLAMA_KEEP_ALIVE:
+            body["keep_alive"] = int(OLLAMA_KEEP_ALIVE) if OLLAMA_KEEP_ALIVE.lstrip("-").isdigit() else OLLAMA_KEEP_ALIVE
+        if format is not None:
+            body["format"] = format
+        return body
+    
+    async def _call(self, attempt_once) -> Any:
+        """统一的熔断 / 限流 / 重试外壳；attempt_once(client) 返回 (结果, Ollama 统计字段)"""
+        if not self.breaker.allow():
+            self.stats["rejected"] += 1
+            raise LLMUnavailable("Ollama circuit open")
+        probe = self.breaker.state != "closed"  # 半开状态下放行的探测请求
+        client = self._ensure_client()
+        attempt = 0
+        try:
+            while True:
+                t0 = time.time()
+                try:
+                    async with self._sem:
+                        result, data = await attempt_once(client)
+                except Exception as e:
+                    if self._is_transient(e) and attempt < self.retries:
+                        attempt += 1
+                        self.stats["retries"] += 1
+                        await asyncio.sleep(0.25 * (2 ** attempt) * random.uniform(0.5, 1.5))
+                        continue
+                    self.stats["failures"] += 1
+                    if self._is_transient(e):
+                        self.breaker.record_failure()
+                    raise
+                self.breaker.record_success()
+                mark_warm("llm")
+                self._record(time.time() - t0, data)
+                return result
+        finally:
+            if probe:
+                self.breaker.release_probe()
+    
+    def _cache_key(self, prompt: str, temperature: float, max_tokens: int, format: Any,
+                   kind: str, cache: Optional[bool]) -> Optional[str]:
+        """返回缓存 key；显式 cache=False 或温度过高（非确定性输出）时不缓存"""
+        if cache is None:
+            cache = temperature <= LLM_CACHE_MAX_TEMPERATURE
+        if not cache or not self.cache.max_entries:
+            return None
+        options = {"temperature": temperature, "num_predict": max_tokens, "num_ctx": OLLAMA_NUM_CTX, "format": format}
+        return self.cache.key(self.model, options, prompt, kind)
+    
+    async def generate(self, prompt: str, temperature: float = 0.1, max_tokens: int = 128,
+                       format: Any = None, cache: Optional[bool] = None) -> str:
+        key = self._cache_key(prompt, temperature, max_tokens, format, "text", cache)
+        if key is not None:
+            hit = self.cache.get(key)
+            if hit is not None:
+                return hit
+        body = self._body(prompt, temperature, max_tokens, stream=False, format=format)
+        async def once(client: httpx.AsyncClient):
+            r = await client.post("/api/generate", json=body)
+            r.raise_for_status()
+            data = r.json()
+            return data.get("response", "").strip(), data
+        text = await self._call(once)
+        if key is not None:
+            self.cache.put(key, text)
+        return text
+    
+    async def _stream_first_object(self, prompt: str, temperature: float, max_tokens: int,
+                                   format: Any = None) -> str:
+        """流式生成，扫描到第一个完整的顶层 JSON 对象即断开连接（Ollama 随之停止生成）"""
+        body = self._body(prompt, temperature, max_tokens, stream=True, format=format)
+        async def once(client: httpx.AsyncClient):
+            scanner = JsonObjectScanner()
+            data: Dict[str, Any] = {}
+            tokens = 0
+            async with client.stream("POST", "/api/generate", json=body) as r:
+                r.raise_for_status()
+                async for line in r.aiter_lines():
+                    if not line.strip():
+                        continue
+                    try:
+                        chunk = json.loads(line)
+                    except ValueError:
+                        self.stats["bad_lines"] += 1  # 截断 / 损坏的一行：跳过，不当作传输失败
+                        continue
+                    if not isinstance(chunk, dict):
+                        self.stats["bad_lines"] += 1
+                        continue
+                    if chunk.get("error"):
+                        raise LLMStreamError(str(chunk["error"]))
+                    tokens += 1
+                    closed = scanner.feed(chunk.get("response", "")) is not None
+                    if chunk.get("done"):
+                        data = chunk
+                        break
+                    if closed:
+                        self.stats["early_stops"] += 1
+                        break
+            # 提前断开时拿不到 Ollama 的最终统计，用收到的分片数近似生成 token 数
+            data.setdefault("eval_count", tokens)
+            return (scanner.result or scanner.text), data
+        return await self._call(once)
+    
+    async def generate_json(self, prompt: str, temperature: float = 0.1, max_tokens: int = 128,
+                            schema: Optional[Dict[str, Any]] = None, cache: Optional[bool] = None,
+                            attempts: int = OLLAMA_JSON_ATTEMPTS) -> Dict[str, Any]:
+        """生成并解析一个 JSON 对象；输出不合法时在客户端内部重试，调用方只拿到 dict（缓存命中时为新副本）"""
+        format = (schema or "json") if OLLAMA_JSON_SCHEMA else None
+        key = self._cache_key(prompt, temperature, max_tokens, format, "json", cache)
+        if key is not None:
+            hit = self.cache.get(key)
+            if hit is not None:
+                return json.loads(hit)
+        for attempt in range(max(1, attempts)):
+            if OLLAMA_STREAM_JSON:
+                raw = await self._stream_first_object(prompt, temperature, max_tokens, format=format)
+            else:
+                raw = await self.generate(prompt, temperature=temperature, max_tokens=max_tokens,
+                                          format=format, cache=False)
+            try:
+                data = json.loads(one_line_json(raw))
+                if isinstance(data, dict) and data:
+                    if key is not None:
+                        self.cache.put(key, json.dumps(data, ensure_ascii=False))
+                    return data
+            except json.JSONDecodeError:
+                pass
+            self.stats["malformed"] += 1
+            print(f"[llm] malformed JSON (attempt {attempt + 1}): {raw[:120]!r}")
+        raise LLMMalformedOutput(f"no JSON object after {max(1, attempts)} attempts")
+    
+    async def embed(self, texts: List[str], model: str = OLLAMA_EMBED_MODEL) -> np.ndarray:
+        """/api/embed 批量嵌入，返回按行 L2 归一化的矩阵"""
+        body = {"model": model, "input": texts}
+        if OLLAMA_KEEP_ALIVE:
+            body["keep_alive"] = self._body("", 0.0, 0, stream=False)["keep_alive"]
+        async def once(client: httpx.AsyncClient):
+            r = await client.post("/api/embed", json=body)
+            r.raise_for_status()
+            data = r.json()
+            return data.get("embeddings") or [], data
+        vecs = np.asarray(await self._call(once), dtype=np.float32)
+        if vecs.ndim != 2 or vecs.shape[0] != len(texts):
+            raise ValueError(f"unexpected embedding shape {vecs.shape} for {len(texts)} inputs")
+        return vecs / np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-8)
+    
+    def _record(self, latency: float, data: Dict[str, Any]):
+        self.stats["calls"] += 1
+        self.stats["latency_s"] += latency
+        self.stats["prompt_tokens"] += data.get("prompt_eval_count", 0) or 0
+        self.stats["completion_tokens"] += data.get("eval_count", 0) or 0
+        self.recent_latency.append(latency)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        lat = sorted(self.recent_latency)
+        def pct(q: float) -> Optional[float]:
+            return round(lat[min(len(lat) - 1, int(len(lat) * q))], 3) if lat else None
+        calls = self.stats["calls"]
+        return {
+            **self.stats, "model": self.model, "breaker": self.breaker.state, "cache": self.cache.snapshot(),
+            "avg_latency_s": round(self.stats["latency_s"] / calls, 3) if calls else None,
+            "p50_latency_s": pct(0.5), "p95_latency_s": pct(0.95),
+        }
+
+llm = OllamaClient()
+
+async def ollama_generate(prompt: str, temperature: float = 0.1, max_tokens: int = 128,
+                          cache: Optional[bool] = None) -> str:
+    return await llm.generate(prompt, temperature=temperature, max_tokens=max_tokens, cache=cache)
+
+async def ollama_generate_json(prompt: str, temperature: float = 0.1, max_tokens: int = 128,
+                               schema: Optional[Dict[str, Any]] = None, cache: Optional[bool] = None) -> Dict[str, Any]:
+    return await llm.generate_json(prompt, temperature=temperature, max_tokens=max_tokens, schema=schema, cache=cache)
+
+# 提示词：静态指令在前、易变数据（快照 / 话语 / 要点）在后，Ollama 可复用同一前缀的 KV 缓存
+ROUTER_INSTRUCTIONS = """
+You are a smart Topic Router. 
+Decide if the utterance belongs to an existing topic or starts a NEW one.
+
+RULES:
+1. **MERGE** if the utterance continues the same general theme or adds detail to an existing topic.
+   - Example: "Visiting Dali" -> merges into "Travel Plan".
+   - Example: "Ticket prices are high" -> merges into "Travel Plan" (related aspect).
+
+2. **CREATE NEW** if the utterance shifts to a DISTINCTLY DIFFERENT subject or a new standalone idea.
+   - Example: "By the way, I'm buying a new camera" -> NEW topic "Photography Gear".
+   - Example: "This reminds me of a writing project" -> NEW topic "Creative Writing".
+
+3. **LABELING**:
+   - New labels MUST be specific English phrases (1-3 words) such as "Travel Plan", "Camera Gear", "Creative Project".
+   - NEVER use generic names like "Topic" or "General".
+   - If the utterance fits an EXISTING label or clearly overlaps existing keywords/summary, prefer MERGE/APPEND instead of creating another topic with the same label.
+
+Return ONE JSON object:
+- To append: {"action":"append_point","topic_id":"<id>","text":"<short point>"}
+- To create: {"action":"create_topic","text":"<short point>"}
+"""
+
+COMPRESS_INSTRUCTIONS = """
+Compress topic info from recent points.
+
+Return JSON:
+{
+  "keyphrases": ["k1","k2","k3"],
+  "summary": "<Short English summary, max 15 words>",
+  "label": "<SpecificEnglishLabel (1-3 words)>"
+}
+
+IMPORTANT:
+- Label MUST be specific English (e.g. "Travel Plan", "Photography"), NOT "Topic".
+- Summary MUST be in English.
+- Only JSON.
+"""
+
+CANVAS_SUMMARY_INSTRUCTIONS = """
+You are summarizing a brainstorming session. Given the topics discussed, create a title and brief summary.
+
+Return JSON:
+{
+  "title": "<Short descriptive title, 2-5 words>",
+  "summary": "<Brief summary of main themes, max 20 words>"
+}
+
+IMPORTANT:
+- Title should capture the main theme(s)
+- Be specific and descriptive
+- English only
+- Only JSON output
+"""
+
+# JSON Schema 约束解码（Ollama format）：输出必然是单个合法对象，生成到右括号即结束
+ROUTER_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "action": {"type": "string", "enum": ["append_point", "create_topic"]},
+        "topic_id": {"type": "string"},
+        "text": {"type": "string"},
+    },
+    "required": ["action", "text"],
+}
+COMPRESS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "keyphrases": {"type": "array", "items": {"type": "string"}, "maxItems": 5},
+        "summary": {"type": "string"},
+        "label": {"type": "string"},
+    },
+    "required": ["keyphrases", "summary", "label"],
+}
+CANVAS_SUMMARY_SCHEMA = {
+    "type": "object",
+    "properties": {"title": {"type": "string"}, "summary": {"type": "string"}},
+    "required": ["title", "summary"],
+}
+
+def router_prompt(utter: str, snapshot: str) -> str:
+    # 话题路由 agent：平衡模式（智能分类）
+    return f"""{ROUTER_INSTRUCTIONS}
+Snapshot(existing_topics): {snapshot}
+
+Utterance: \"\"\"{utter}\"\"\"
+"""
+
+ROUTER_BATCH_INSTRUCTIONS = """
+BATCH MODE: several utterances follow, numbered in the order they were spoken.
+Decide each one in order, as if the earlier decisions were already applied.
+If an utterance continues a topic STARTED by an earlier utterance of this batch, append to it with "topic_id":"new<N>", where N is that utterance's number.
+
+Return ONE JSON object with one decision per utterance, in the same order:
+{"decisions":[{"action":"append_point","topic_id":"<id or new<N>>","text":"<short point>"},{"action":"create_topic","text":"<short point>"}]}
+"""
+
+ROUTER_BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {"decisions": {"type": "array", "items": ROUTER_SCHEMA}},
+    "required": ["decisions"],
+}
+
+def router_batch_prompt(utters: List[str], snapshot: str) -> str:
+    # 批量路由：与单句路由共享同一指令前缀，再追加批量说明
+    numbered = "\n".join(f'{i}. \"\"\"{u}\"\"\"' for i, u in enumerate(utters, 1))
+    return f"""{ROUTER_INSTRUCTIONS}{ROUTER_BATCH_INSTRUCTIONS}
+Snapshot(existing_topics): {snapshot}
+
+Utterances:
+{numbered}
+"""
+
+def compress_prompt(points: str, cur_label: str) -> str:
+    # 话题压缩：关键词 + ≤25词总结 + 修正单词标签
+    return f"""{COMPRESS_INSTRUCTIONS}
+Current label: {cur_label}
+
+Recent points:
+{points}
+"""
+
+def normalize_keyphrases(klist: List[str]) -> List[str]:
+    """Deduplicate keyphrases case-insensitively, keep order, trim length."""
+    seen = set()
+    result = []
+    for k in klist:
+        if not isinstance(k, str):
+            continue
+        trimmed = k.strip()
+        if not trimmed:
+            continue
+        key = trimmed.lower()
+        if key in seen:
+            continue
+        seen.add(key)
+        result.append(trimmed[:30])
+    return result[:5]
+
+def normalize_topic_inplace(topic: "Topic"):
+    """Normalize label/keyphrases on a Topic instance."""
+    topic.label = normalize_label(topic.label)
+    topic.keyphrases = normalize_keyphrases(topic.keyphrases)
+
+def sanitize_positions(payload: Dict[str, Any]) -> Dict[str, dict]:
+    """Keep only numeric x/y/size for ripple/map/keywords."""
+    if not isinstance(payload, dict):
+        return {}
+    cleaned = {}
+    for tid, entry in payload.items():
+        if not isinstance(entry, dict):
+            continue
+        out = {}
+        rp = entry.get("ripple") or entry
+        if isinstance(rp, dict) and all(k in rp for k in ("x", "y")):
+            try:
+                rx = float(rp["x"]); ry = float(rp["y"])
+                rsize = float(rp["size"]) if "size" in rp else None
+                out["ripple"] = {"x": rx, "y": ry}
+                if rsize is not None:
+                    out["ripple"]["size"] = rsize
+            except Exception:
+                pass
+        mp = entry.get("map")
+        if isinstance(mp, dict) and all(k in mp for k in ("x", "y")):
+            try:
+                out["map"] = {"x": float(mp["x"]), "y": float(mp["y"])}
+            except Exception:
+                pass
+        kw = entry.get("keywords")
+        if isinstance(kw, dict):
+            kw_out = {}
+            for kk, kv in kw.items():
+                if isinstance(kv, dict) and all(k in kv for k in ("x", "y")):
+                    try:
+                        kw_out[kk] = {"x": float(kv["x"]), "y": float(kv["y"])}
+                    except Exception:
+                        pass
+            if kw_out:
+                out["keywords"] = kw_out
+        if out:
+            cleaned[tid] = out
+    return cleaned
+
+def merge_topics_in_map(topics: Dict[str, "Topic"], keep_id: str, drop_id: str) -> str:
     """Merge drop_id topic into keep_id within a topics dict."""
     if keep_id == drop_id:
         return keep_id
@@ -449,193 +2272,1345 @@ def merge_topics_in_map(topics: Dict[str, "Topic"], keep_id: str, drop_id: str)
     topics.pop(drop_id, None)
     return keep_id
 
-def dedup_topics_map(topics: Dict[str, "Topic"]) -> Dict[str, int]:
-    """Normalize and deduplicate topics by label within a topics dict."""
-    normalized = 0
-    merged = 0
-    # Normalize all topics first
-    for t in topics.values():
-        normalize_topic_inplace(t)
-        normalized += 1
-    # Deduplicate by label (case-insensitive), keep the most recently updated
-    label_map: Dict[str, str] = {}
-    # Sort by last_updated desc so we keep the newest
-    sorted_items = sorted(topics.items(), key=lambda kv: kv[1].last_updated, reverse=True)
-    for tid, t in sorted_items:
-        label_key = (t.label or "").strip().lower()
-        if not label_key:
-            continue
-        if label_key not in label_map:
-            label_map[label_key] = tid
+def dedup_topics_map(topics: Dict[str, "Topic"], min_sim: Optional[float] = None, dry_run: bool = False,
+                     embeddings: Optional["TopicEmbeddingIndex"] = None, normalize: bool = True,
+                     merge=None) -> Dict[str, Any]:
+    """Normalize topics and merge near-duplicates (newest kept); dry_run only reports the pairs.
+    embeddings（会话的路由索引）提供话题质心；画布历史没有质心，只按字面相似度合并。
+    merge(keep_id, drop_id) 默认直接改字典；实时会话用 dedup_store 走 MemoryStore 接口。"""
+    normalized = 0
+    merged = 0
+    pairs: List[Dict[str, Any]] = []
+    if merge is None:
+        merge = lambda keep_id, drop_id: merge_topics_in_map(topics, keep_id, drop_id)
+    if normalize and not dry_run:
+        for t in topics.values():
+            normalize_topic_inplace(t)
+            normalized += 1
+    index = NearDuplicateIndex()
+    for t in topics.values():
+        index.upsert(t)
+    threshold = dedup_threshold(index, min_sim)
+    # Newest first: each topic folds into the closest already-kept topic
+    kept = set()
+    for tid, t in sorted(topics.items(), key=lambda kv: kv[1].last_updated, reverse=True):
+        matches = index.matches(tid, threshold, embeddings if DEDUP_FUZZY else None)
+        best = next(((other, sim) for other, sim in matches if other in kept), None)
+        if best is None:
+            kept.add(tid)
+            continue
+        keep_id, sim = best
+        pairs.append({"keep": keep_id, "drop": tid, "keep_label": topics[keep_id].label,
+                      "drop_label": t.label, "similarity": round(sim, 3)})
+        if dry_run:
+            continue
+        merge(keep_id, tid)
+        index.remove(tid)
+        index.upsert(topics[keep_id])
+        merged += 1
+    return {"normalized": normalized, "merged": merged, "pairs": pairs}
+
+def dedup_store(store: MemoryStore, min_sim: Optional[float] = None, dry_run: bool = False,
+                embeddings: Optional["TopicEmbeddingIndex"] = None) -> Dict[str, Any]:
+    """实时会话的批量去重：只给真正变了的话题加版本（客户端收到增量而不是全量），
+    被合并的 id 留下指向保留话题的别名（在途的路由决策仍能追加到正确的话题）"""
+    normalized = 0
+    if not dry_run:
+        for t in list(store.topics.values()):
+            before = (t.label, list(t.keyphrases))
+            normalize_topic_inplace(t)
+            normalized += 1
+            if (t.label, t.keyphrases) != before:
+                store.touch(t.id)
+    res = dedup_topics_map(store.topics, min_sim, dry_run, embeddings, normalize=False,
+                           merge=lambda keep_id, drop_id: merge_topics(store, keep_id, drop_id))
+    res["normalized"] = normalized
+    return res
+
+def canvas_summary_prompt(topics_info: str) -> str:
+    """Generate a title and summary for the entire canvas"""
+    return f"""{CANVAS_SUMMARY_INSTRUCTIONS}
+Topics in this session:
+{topics_info}
+"""
+
+# ---------------------
+# 嵌入快速路由：话题质心索引，只有模糊的话语才交给 LLM 路由
+# ---------------------
+class EmbeddingCache:
+    """文本 → 向量缓存（所有会话共用），只为未见过的文本调用 /api/embed"""
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._vectors: Dict[str, np.ndarray] = {}  # 插入顺序近似 LRU
+        self.retry_at = 0.0           # 嵌入失败（如模型未拉取）后暂停一段时间，期间直接走 LLM
+    
+    @property
+    def backing_off(self) -> bool:
+        return time.monotonic() < self.retry_at
+    
+    async def vectors(self, texts: List[str]) -> List[np.ndarray]:
+        missing = [x for x in dict.fromkeys(texts) if x not in self._vectors]
+        if missing:
+            if self.backing_off:
+                raise RuntimeError("embedding backoff")
+            try:
+                vecs = await llm.embed(missing)
+            except Exception:
+                self.retry_at = time.monotonic() + 60
+                raise
+            for text, vec in zip(missing, vecs):
+                self._vectors[text] = vec
+            while len(self._vectors) > self.max_entries:
+                self._vectors.pop(next(iter(self._vectors)))
+        return [self._vectors[x] for x in texts]
+
+EMBED_CACHE = EmbeddingCache()
+
+class TopicEmbeddingIndex:
+    """每个话题一个质心（标签+关键词、最近要点的嵌入均值）；在 exec_node 中增量更新"""
+    def __init__(self, min_sim: float = ROUTER_EMBED_MIN_SIM, margin: float = ROUTER_EMBED_MARGIN,
+                 enabled: bool = ROUTER_EMBED, cache: EmbeddingCache = EMBED_CACHE):
+        self.min_sim = min_sim
+        self.margin = margin
+        self.enabled = enabled        # 是否参与路由决策
+        self.fast_path = True         # False 时只维护索引（对比报告用），始终走 LLM
+        self.centroids: Dict[str, np.ndarray] = {}
+        self.cache = cache
+        self.stats: Dict[str, int] = {"fast_hits": 0, "fallbacks": 0, "errors": 0, "updates": 0}
+        self._refreshing: Dict[str, asyncio.Task] = {}   # 话题 → 后台刷新质心的任务
+        self._stale: set = set()                          # 刷新途中又有变更，完成后再刷一次
+    
+    @staticmethod
+    def topic_texts(t: "Topic") -> List[str]:
+        head = t.label if t.label and t.label != "Topic" else ""
+        if t.keyphrases:
+            head = f"{head}: {', '.join(t.keyphrases)}" if head else ", ".join(t.keyphrases)
+        return ([head] if head else []) + t.points[-MAX_POINTS_PER_TOPIC:]
+    
+    async def update(self, t: "Topic"):
+        """只嵌入新增的文本；标签/要点变化后重新求质心"""
+        if not self.enabled or self.cache.backing_off:
+            return
+        texts = self.topic_texts(t)
+        if not texts:
+            return
+        try:
+            vecs = await self.cache.vectors(texts)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"[router] embed update failed: {e}")
+            return
+        c = np.mean(vecs, axis=0)
+        self.centroids[t.id] = c / max(float(np.linalg.norm(c)), 1e-8)
+        self.stats["updates"] += 1
+    
+    def refresh(self, t: "Topic"):
+        """后台刷新质心（嵌入请求要排在路由 / 压缩之后），不拖慢执行结果的推送；同一话题的刷新合并"""
+        if not self.enabled:
+            return
+        if t.id in self._refreshing:
+            self._stale.add(t.id)
+            return
+        self._refreshing[t.id] = asyncio.create_task(self._refresh(t))
+    
+    async def _refresh(self, t: "Topic"):
+        try:
+            while True:
+                await self.update(t)
+                if t.id not in self._stale:
+                    break
+                self._stale.discard(t.id)
+        finally:
+            self._refreshing.pop(t.id, None)
+    
+    async def settle(self):
+        """等在途的质心刷新完成（对比报告、测试脚本用）"""
+        while self._refreshing:
+            await asyncio.gather(*list(self._refreshing.values()), return_exceptions=True)
+    
+    def close(self):
+        for task in self._refreshing.values():
+            task.cancel()
+        self._refreshing.clear()
+        self._stale.clear()
+    
+    def prune(self, topic_ids):
+        for tid in list(self.centroids):
+            if tid not in topic_ids:
+                self.centroids.pop(tid, None)
+    
+    async def score(self, utter: str, topics: Dict[str, "Topic"]) -> List[Tuple[str, float]]:
+        """按相似度降序返回 (topic_id, cos)；只看仍存在的话题，缺质心的（如刚载入的画布）先补上"""
+        self.prune(topics)
+        for tid, t in list(topics.items()):
+            if tid not in self.centroids:
+                await self.update(t)
+        ids = [tid for tid in topics if tid in self.centroids]
+        if not ids:
+            return []
+        (u,) = await self.cache.vectors([utter])
+        sims = np.stack([self.centroids[tid] for tid in ids]) @ u
+        order = np.argsort(-sims)
+        return [(ids[i], float(sims[i])) for i in order]
+    
+    def decide(self, ranked: List[Tuple[str, float]]) -> Optional[str]:
+        """最相近话题足够近且明显领先第二名时返回其 id，否则 None（交给 LLM）"""
+        if not ranked:
+            return None
+        best_id, best = ranked[0]
+        second = ranked[1][1] if len(ranked) > 1 else -1.0
+        if best >= self.min_sim and best - second >= self.margin:
+            return best_id
+        return None
+    
+    async def route(self, utter: str, topics: Dict[str, "Topic"]) -> Optional[Dict[str, Any]]:
+        if not (self.enabled and self.fast_path):
+            return None
+        try:
+            ranked = await self.score(utter, topics)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"[router] embed route failed, using LLM: {e}")
+            ranked = []
+        tid = self.decide(ranked)
+        if tid is None:
+            self.stats["fallbacks"] += 1
+            return None
+        self.stats["fast_hits"] += 1
+        return {"action": "append_point", "topic_id": tid, "text": utter,
+                "via": "embed", "similarity": round(ranked[0][1], 3)}
+
+# ---------------------
+# 话题变更：执行决策 / 合并工具 + 后台去抖压缩（不阻塞路由/执行结果的推送）
+# ---------------------
+def apply_decision(store: MemoryStore, dec: Dict[str, Any]) -> Dict[str, Any]:
+    """按 exec_node 语义把一条路由决策应用到 store；批量决策中的占位引用（new<N>）在此惰性解析"""
+    now = time.time()
+    action = dec.get("action", "")
+    refs: Optional[Dict[str, str]] = dec.get("refs")
+    ref = dec.get("ref") if action == "create_topic" else dec.get("topic_id", "")
+    if refs is not None and isinstance(ref, str) and ref.startswith("new"):
+        if refs.get(ref) in store.topics:
+            # 占位话题已由同批次的另一条决策建好：改为追加
+            action, dec = "append_point", {**dec, "topic_id": refs[ref]}
+        else:
+            # 先于创建者执行（或创建者失败）：由本条决策创建，并登记占位
+            action = "create_topic"
+    else:
+        ref = None
+    if action == "create_topic":
+        tid = str(uuid.uuid4())[:8]
+        p = to_point(dec.get("text", dec.get("utterance","")))
+        store.add(Topic(id=tid, points=[p], last_updated=now))
+        if ref:
+            refs[ref] = tid
+        return {"topic_id": tid, "changed": True}
+    elif action == "append_point":
+        tid = store.resolve(dec.get("topic_id",""))  # 目标若已被合并，跟随别名
+        if tid in store.topics:
+            p = to_point(dec.get("text", dec.get("utterance","")))
+            if not store.topics[tid].points or store.topics[tid].points[-1] != p:
+                store.topics[tid].points.append(p)
+                del store.topics[tid].points[:-SESSION_MAX_POINTS]  # 单话题要点上限
+            store.topics[tid].last_updated = now
+            store.touch(tid)
+            return {"topic_id": tid, "changed": True}
+        # 若 ID 不存在，退化为新建
+        tid = str(uuid.uuid4())[:8]
+        store.add(Topic(id=tid, points=[to_point(dec.get("utterance",""))], last_updated=now))
+        return {"topic_id": tid, "changed": True}
+    elif action == "relabel_topic":
+        tid = dec.get("topic_id",""); new_label = (dec.get("new_label","") or "").strip()
+        if tid in store.topics and new_label:
+            store.topics[tid].label = normalize_label(new_label)
+            store.topics[tid].last_updated = now
+            store.touch(tid)
+            return {"topic_id": tid, "changed": True}
+    # 默认新建
+    tid = str(uuid.uuid4())[:8]
+    store.add(Topic(id=tid, points=[to_point(dec.get("utterance",""))], last_updated=now))
+    return {"topic_id": tid, "changed": True}
+
+_MINHASH_PRIME = 4294967291  # < 2^32，(a·h + b) 在 uint64 内不溢出
+
+def dedup_stem(word: str) -> str:
+    """极简英文词干：plans / planned / planning → plan；其他文字原样返回"""
+    if not word.isascii() or len(word) <= 4:
+        return word
+    for suffix in ("ing", "ed", "s"):
+        if word.endswith(suffix) and not word.endswith("ss") and len(word) - len(suffix) >= 3:
+            word = word[:-len(suffix)]
+            if len(word) > 3 and word[-1] == word[-2] and word[-1] not in "aeiou":
+                word = word[:-1]  # planning → plann → plan
+            break
+    return word
+
+def dedup_features(label: str, keyphrases: List[str]) -> Tuple[frozenset, frozenset]:
+    """标签特征：拉丁文词干化后取字符三元组，中日韩文字取单字 + 二字；关键词特征：词干集合"""
+    grams = set()
+    latin = []
+    for tok in search_tokens(label):
+        if _SEARCH_CJK_RE.match(tok):
+            grams.add(tok)
         else:
-            keep_id = label_map[label_key]
-            merge_topics_in_map(topics, keep_id, tid)
-            merged += 1
-    return {"normalized": normalized, "merged": merged}
+            latin.append(dedup_stem(tok))
+    if latin:
+        padded = f" {' '.join(latin)} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    keys = frozenset(dedup_stem(tok) for k in keyphrases for tok in search_tokens(k))
+    return frozenset(grams), keys
 
-def canvas_summary_prompt(topics_info: str) -> str:
-    """Generate a title and summary for the entire canvas"""
-    return f"""
-You are summarizing a brainstorming session. Given the topics discussed, create a title and brief summary.
+def dedup_threshold(index: "NearDuplicateIndex", min_sim: Optional[float] = None) -> float:
+    """显式阈值优先；关闭近似合并时只认标签特征完全相同"""
+    if min_sim is not None:
+        return min_sim
+    return index.min_sim if DEDUP_FUZZY else 1.0
 
-Topics in this session:
-{topics_info}
+class NearDuplicateIndex:
+    """近似重复话题：标签 + 关键词特征做 MinHash，按 LSH 分桶找候选（不扫描全部话题），候选再算精确 Jaccard。
+    相似度 = max(标签相似度, 标签/关键词加权和)；与话题存储按版本增量同步，只重算变过的话题。
+    字面几乎不重合的同义标签（Trip Plan / Travel Plan）靠路由索引里现成的话题质心补充：余弦达到 embed_min_sim 也算"""
+    def __init__(self, min_sim: float = DEDUP_MIN_SIM, label_weight: float = DEDUP_LABEL_WEIGHT,
+                 bands: int = DEDUP_LSH_BANDS, rows: int = 3, embed_min_sim: float = DEDUP_EMBED_MIN_SIM):
+        self.min_sim = min_sim
+        self.label_weight = label_weight
+        self.embed_min_sim = embed_min_sim
+        self.bands, self.rows = max(1, bands), max(1, rows)
+        rng = np.random.default_rng(7)
+        n = self.bands * self.rows
+        self._a = rng.integers(1, _MINHASH_PRIME, n, dtype=np.uint64)
+        self._b = rng.integers(0, _MINHASH_PRIME, n, dtype=np.uint64)
+        self.features: Dict[str, Tuple[frozenset, frozenset]] = {}   # 话题 → (标签特征, 关键词特征)
+        self.buckets: Dict[Tuple[int, bytes], set] = {}
+        self._keys: Dict[str, List[Tuple[int, bytes]]] = {}          # 话题 → 所在桶
+        self._sync: Optional[TopicSync] = None
+    
+    def _signature(self, feats) -> np.ndarray:
+        hashes = np.array([int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=4).digest(), "little")
+                           for f in feats], dtype=np.uint64)
+        return ((np.outer(hashes, self._a) + self._b) % _MINHASH_PRIME).min(axis=0)
+    
+    def upsert(self, t: "Topic"):
+        self.remove(t.id)
+        label_feats, key_feats = dedup_features(t.label, t.keyphrases)
+        if not label_feats:
+            return  # 还没有标签的话题不参与去重
+        self.features[t.id] = (label_feats, key_feats)
+        sig = self._signature(label_feats | {f"#{k}" for k in key_feats})
+        keys = [(b, sig[b * self.rows:(b + 1) * self.rows].tobytes()) for b in range(self.bands)]
+        for key in keys:
+            self.buckets.setdefault(key, set()).add(t.id)
+        self._keys[t.id] = keys
+    
+    def remove(self, tid: str):
+        self.features.pop(tid, None)
+        for key in self._keys.pop(tid, []):
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket.discard(tid)
+                if not bucket:
+                    del self.buckets[key]
+    
+    def sync(self, store: MemoryStore):
+        """按话题版本增量同步；换了存储则重建"""
+        if self._sync is None or self._sync.store is not store:
+            self.features.clear(); self.buckets.clear(); self._keys.clear()
+            self._sync = TopicSync(store)
+        upserts, removed = self._sync.changes()
+        for tid in removed:
+            self.remove(tid)
+        for t in upserts:
+            self.upsert(t)
+    
+    def similarity(self, a: str, b: str) -> float:
+        (la, ka), (lb, kb) = self.features[a], self.features[b]
+        label_sim = len(la & lb) / len(la | lb)
+        if not ka or not kb:
+            return label_sim
+        key_sim = len(ka & kb) / len(ka | kb)
+        return max(label_sim, self.label_weight * label_sim + (1 - self.label_weight) * key_sim)
+    
+    def candidates(self, tid: str) -> set:
+        out = set()
+        for key in self._keys.get(tid, []):
+            out |= self.buckets.get(key, set())
+        out.discard(tid)
+        return out
+    
+    def embedding_neighbours(self, tid: str, embeddings: Optional["TopicEmbeddingIndex"]) -> List[Tuple[str, float]]:
+        """质心余弦不低于 embed_min_sim 的话题（一次矩阵乘，话题数受 SESSION_MAX_TOPICS 限制）"""
+        if embeddings is None or self.embed_min_sim <= 0 or tid not in embeddings.centroids:
+            return []
+        ids = [other for other in self.features if other != tid and other in embeddings.centroids]
+        if not ids:
+            return []
+        sims = np.stack([embeddings.centroids[other] for other in ids]) @ embeddings.centroids[tid]
+        return [(ids[i], float(sims[i])) for i in np.flatnonzero(sims >= self.embed_min_sim)]
+    
+    def matches(self, tid: str, min_sim: Optional[float] = None,
+                embeddings: Optional["TopicEmbeddingIndex"] = None) -> List[Tuple[str, float]]:
+        """与 tid 相似度不低于阈值的话题，按相似度降序；给了嵌入索引时质心余弦也参与打分"""
+        threshold = self.min_sim if min_sim is None else min_sim
+        scored = {other: self.similarity(tid, other) for other in self.candidates(tid)}
+        for other, cos in self.embedding_neighbours(tid, embeddings):
+            scored[other] = max(scored.get(other, 0.0), cos)
+        return sorted([m for m in scored.items() if m[1] >= threshold], key=lambda m: m[1], reverse=True)
 
-Return JSON:
-{{
-  "title": "<Short descriptive title, 2-5 words>",
-  "summary": "<Brief summary of main themes, max 20 words>"
-}}
+def merge_topics(store: MemoryStore, target_id: str, source_id: str) -> str:
+    """Merge source topic into target and delete source; return kept id"""
+    if target_id == source_id:
+        return target_id
+    if target_id not in store.topics or source_id not in store.topics:
+        return target_id if target_id in store.topics else source_id
+    target = store.topics[target_id]
+    source = store.topics[source_id]
+    # Merge points (preserve order, avoid dup consecutive)
+    for p in source.points:
+        if not target.points or target.points[-1] != p:
+            target.points.append(p)
+    # Merge keyphrases (unique, keep short list)
+    merged_keys = normalize_keyphrases(list(target.keyphrases) + list(source.keyphrases))
+    target.keyphrases = merged_keys
+    # Prefer existing summary; fallback to source if empty
+    if not target.summary and source.summary:
+        target.summary = source.summary
+    target.last_updated = max(target.last_updated, source.last_updated, time.time())
+    # Drop source
+    store.remove(source_id, alias_to=target_id)
+    store.touch(target_id)
+    return target_id
 
-IMPORTANT:
-- Title should capture the main theme(s)
-- Be specific and descriptive
-- English only
-- Only JSON output
-"""
+def dedup_by_label(store: MemoryStore, current_id: str, index: Optional["NearDuplicateIndex"] = None,
+                   embeddings: Optional["TopicEmbeddingIndex"] = None) -> str:
+    """If another topic has the same or a near-duplicate label, merge into the newest one."""
+    if current_id not in store.topics:
+        return current_id
+    if index is None:
+        index = NearDuplicateIndex()
+    index.sync(store)
+    matches = index.matches(current_id, dedup_threshold(index), embeddings if DEDUP_FUZZY else None)
+    if not matches:
+        return current_id
+    tid = matches[0][0]
+    cur = store.topics[current_id]
+    # Keep the most recently updated
+    keep = tid if store.topics[tid].last_updated >= cur.last_updated else current_id
+    drop = current_id if keep == tid else tid
+    return merge_topics(store, keep, drop)
+
+async def compress_topic(session: "Session", tid: str) -> Optional[str]:
+    """压缩单个话题（关键词/总结/修正标签），同名话题随即合并；返回保留的话题 id"""
+    store = session.store
+    if tid not in store.topics:
+        return None
+    t = store.topics[tid]
+    recent = "\n- " + "\n- ".join(t.points[-MAX_POINTS_PER_TOPIC:])
+    data = await ollama_generate_json(compress_prompt(recent, t.label), temperature=0.2, max_tokens=220,
+                                      schema=COMPRESS_SCHEMA)
+    if store.topics.get(tid) is not t:
+        return None  # 压缩期间话题已被合并或清空（清空 / 载入画布后同一 id 可能已是另一个话题）
+    if isinstance(data.get("keyphrases"), list) and data["keyphrases"]:
+        t.keyphrases = normalize_keyphrases(data["keyphrases"])
+    if isinstance(data.get("summary"), str):
+        t.summary = data["summary"].strip()
+    if isinstance(data.get("label"), str) and data["label"].strip():
+        t.label = normalize_label(data["label"])
+    t.last_updated = time.time()
+    store.touch(tid)
+    # 先按新的标签 / 关键词更新质心，近似重复检测会用到
+    await session.index.update(t)
+    if store.topics.get(tid) is not t:
+        return None
+    # Deduplicate topics that ended up with the same or a near-duplicate label
+    version = store.version
+    kept = dedup_by_label(store, tid, session.near_dups, session.index)
+    if store.version != version and kept in store.topics:
+        await session.index.update(store.topics[kept])  # 合并了：按合并后的内容重算质心
+    return kept
+
+class TopicCompressor:
+    """后台压缩：每个话题攒够 every_points 个新要点或空闲 idle_s 秒后跑一次，重复请求合并为一次，
+    总是基于最新要点；完成后通知会话的订阅者推送后续更新"""
+    def __init__(self, session: "Session", every_points: int = COMPRESS_EVERY_POINTS, idle_s: float = COMPRESS_IDLE_S):
+        self.session = session
+        self.every_points = max(1, every_points)
+        self.idle_s = idle_s
+        self.pending: Dict[str, int] = {}                   # 话题 → 上次压缩后的新要点数
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._running: Dict[str, asyncio.Task] = {}
+        self.stats: Dict[str, int] = {"requested": 0, "runs": 0, "coalesced": 0, "errors": 0}
+    
+    def schedule(self, tid: str):
+        self.stats["requested"] += 1
+        self.pending[tid] = self.pending.get(tid, 0) + 1
+        t = self.session.store.topics.get(tid)
+        # 新话题还没有标签：尽快压缩；否则攒够 K 个要点立即跑，不然等空闲 T 秒
+        if (t is not None and t.label == "Topic") or self.pending[tid] >= self.every_points:
+            self._start(tid)
+        else:
+            self._arm(tid)
+    
+    def _arm(self, tid: str):
+        timer = self._timers.pop(tid, None)
+        if timer is not None:
+            timer.cancel()
+        self._timers[tid] = asyncio.get_running_loop().call_later(self.idle_s, self._start, tid)
+    
+    def _start(self, tid: str):
+        timer = self._timers.pop(tid, None)
+        if timer is not None:
+            timer.cancel()
+        if tid in self._running:
+            self.stats["coalesced"] += 1  # 正在压缩：结束后若仍有新要点再跑一次
+            return
+        if self.pending.pop(tid, 0) == 0:
+            return
+        self._running[tid] = asyncio.create_task(self._run(tid))
+    
+    async def _run(self, tid: str):
+        try:
+            self.stats["runs"] += 1
+            kept = await compress_topic(self.session, tid)
+            if kept is not None:
+                await self.session.notify(kept)
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"[compress] {tid} failed: {e}")
+        finally:
+            if self._running.get(tid) is asyncio.current_task():
+                self._running.pop(tid, None)
+        if self.pending.get(tid):
+            if tid not in self.session.store.topics:
+                self.pending.pop(tid, None)
+            elif self.pending[tid] >= self.every_points:
+                self._start(tid)
+            else:
+                self._arm(tid)
+    
+    async def flush(self, topic_ids: Optional[List[str]] = None):
+        """立即压缩所有（或指定）待处理话题并等待完成（演示接口、保存画布、测试脚本用）"""
+        ids = list(topic_ids) if topic_ids is not None else list(set(self.pending) | set(self._running))
+        for tid in ids:
+            if tid in self._running:
+                await asyncio.gather(self._running[tid], return_exceptions=True)
+            if self.pending.get(tid):
+                self._start(tid)
+            if tid in self._running:
+                await asyncio.gather(self._running[tid], return_exceptions=True)
+    
+    def reset(self):
+        """清空话题时丢弃所有待处理的压缩，并取消正在进行的（其结果属于已被清掉的话题）"""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self.pending.clear()
+        for task in self._running.values():
+            task.cancel()
+        self._running.clear()
+    
+    @property
+    def idle(self) -> bool:
+        return not self.pending and not self._running
 
 # ---------------------
-# LangGraph（LLM-only 决策，不用 embedding）
+# LangGraph（嵌入快速路由 + LLM 决策）
 # ---------------------
-def router_snapshot(max_topics: int = 12) -> str:
-    topics = list(store.topics.values())
-    topics.sort(key=lambda t: t.last_updated, reverse=True)
-    rows = []
-    for t in topics[:max_topics]:
-        rows.append({
-            "id": t.id, 
-            "label": t.label,
-            "summary": t.summary,  # 加入摘要，帮助理解话题内涵
-            "keyphrases": t.keyphrases[:5],
-            "recent_points": t.points[-3:]
-        })
-    return json.dumps(rows, ensure_ascii=False)
+def router_snapshot(store: MemoryStore, max_topics: int = 12) -> str:
+    return store.snapshot_json(max_topics)
+
+class RoutingBatcher:
+    """路由调用在途时到达的话语先排队，上一次调用返回后合并成一次批量调用（有序决策列表）；
+    突发语音下 LLM 路由调用次数保持有界"""
+    def __init__(self, store: MemoryStore, max_batch: int = ROUTER_BATCH_MAX):
+        self.store = store
+        self.max_batch = max(1, max_batch)
+        self.waiting: List[Tuple[str, asyncio.Future]] = []
+        self._inflight = False
+        self.settle = None   # async fn()：读快照前等已路由的话语先执行（由会话的流水线提供）
+        self.stats: Dict[str, int] = {"calls": 0, "utterances": 0, "batched_calls": 0, "largest_batch": 0}
+    
+    async def route(self, utter: str) -> Dict[str, Any]:
+        fut = asyncio.get_running_loop().create_future()
+        self.waiting.append((utter, fut))
+        if not self._inflight:
+            self._inflight = True
+            asyncio.create_task(self._drain())
+        return await fut
+    
+    async def _drain(self):
+        try:
+            while self.waiting:
+                if self.settle is not None:
+                    await self.settle()
+                batch, self.waiting = self.waiting[:self.max_batch], self.waiting[self.max_batch:]
+                try:
+                    decisions = await self._route_batch([u for u, _ in batch])
+                except Exception as e:
+                    for _, fut in batch:
+                        if not fut.done():
+                            fut.set_exception(e)
+                    continue
+                for (_, fut), dec in zip(batch, decisions):
+                    if not fut.done():
+                        fut.set_result(dec)
+        finally:
+            self._inflight = False
+    
+    async def _route_batch(self, utters: List[str]) -> List[Dict[str, Any]]:
+        self.stats["calls"] += 1
+        self.stats["utterances"] += len(utters)
+        self.stats["largest_batch"] = max(self.stats["largest_batch"], len(utters))
+        snap = router_snapshot(self.store)
+        batch = {"version": self.store.version}  # 读取快照时的版本；同批次的新建执行后向前推进
+        if len(utters) == 1:
+            try:
+                dec = await ollama_generate_json(router_prompt(utters[0], snap), temperature=0.1, max_tokens=200,
+                                                 schema=ROUTER_SCHEMA)
+            except LLMMalformedOutput:
+                dec = {}  # 与旧行为一致：无法解析时按新话题处理
+            dec["batch"] = batch
+            return [dec]
+        self.stats["batched_calls"] += 1
+        try:
+            data = await ollama_generate_json(router_batch_prompt(utters, snap), temperature=0.1,
+                                              max_tokens=120 * len(utters), schema=ROUTER_BATCH_SCHEMA)
+            decisions = [d if isinstance(d, dict) else {} for d in data.get("decisions") or []]
+        except LLMMalformedOutput:
+            decisions = []
+        decisions = (decisions + [{}] * len(utters))[:len(utters)]  # 少给的按新话题处理
+        refs: Dict[str, str] = {}  # 占位 new<N> → 真实话题 id，由 apply_decision 惰性填充
+        for i, dec in enumerate(decisions, 1):
+            dec["refs"] = refs
+            dec["batch"] = batch
+            if dec.get("action", "create_topic") == "create_topic":
+                dec["ref"] = f"new{i}"
+        return decisions
+
+async def route_utterance(session: "Session", utter: str) -> Dict[str, Any]:
+    """路由阶段：嵌入快速路由，未命中再走（批量）LLM 路由；记录读取快照时的 store 版本
+    （LLM 路由的版本由 RoutingBatcher 在真正读取快照时记入 dec["batch"]）"""
+    store = session.store
+    version = store.version
+    dec = await session.index.route(utter, store.topics)
+    if dec is None:
+        dec = await session.batcher.route(utter)  # 路由调用在途时到达的话语合并为一次 LLM 调用
+    dec["utterance"] = utter
+    dec["store_version"] = version
+    return dec
+
+async def exec_decision(session: "Session", dec: Dict[str, Any]) -> Dict[str, Any]:
+    """执行阶段：修改内存；嵌入质心在后台刷新、压缩交给后台去抖任务，执行结果立即可推送"""
+    store = session.store
+    result = apply_decision(store, dec)
+    session.enforce_caps()
+    tid = result.get("topic_id")
+    if tid in store.topics:
+        session.index.refresh(store.topics[tid])
+        session.compressor.schedule(tid)
+    return result
 
 def build_graph():
+    from langgraph.graph import StateGraph, START, END
     g = StateGraph(dict)
 
-    # 节点1：路由
+    # 节点1：路由（state 可带 "session"，缺省为默认会话）
     async def route_node(state: Dict[str, Any]):
-        utter = to_point(state["utterance"])
-        snap = router_snapshot()
-        resp = await ollama_generate(router_prompt(utter, snap), temperature=0.1, max_tokens=200)
-        dec = json.loads(one_line_json(resp))
-        dec["utterance"] = utter
-        return {"decision": dec}
-
-    # 节点2：执行（修改内存）
+        session = await sessions.acquire(state.get("session"))
+        return {"decision": await route_utterance(session, to_point(state["utterance"])), "session": session.id}
+
+    # 节点2：执行
     async def exec_node(state: Dict[str, Any]):
-        dec = state["decision"]; now = time.time()
-        action = dec.get("action", "")
-        if action == "create_topic":
-            tid = str(uuid.uuid4())[:8]
-            p = to_point(dec.get("text", state["decision"].get("utterance","")))
-            store.topics[tid] = Topic(id=tid, points=[p], last_updated=now)
-            return {"topic_id": tid, "changed": True}
-        elif action == "append_point":
-            tid = dec.get("topic_id","")
+        return await exec_decision(await sessions.acquire(state.get("session")), state["decision"])
+
+    g.add_node("router", route_node)
+    g.add_node("exec", exec_node)
+    g.add_edge(START, "router")
+    g.add_edge("router", "exec")
+    g.add_edge("exec", END)
+    return g.compile()
+
+_GRAPH = None
+def get_graph():
+    """首次使用时编译 LangGraph"""
+    global _GRAPH
+    if _GRAPH is None:
+        _GRAPH = build_graph()
+        mark_warm("graph")
+    return _GRAPH
+
+# 全部会话累计的流水线统计（/stats/router）
+PIPELINE_TOTALS: Dict[str, int] = {"submitted": 0, "applied": 0, "rerouted": 0, "errors": 0}
+
+class UtterancePipeline:
+    """会话内有序流水线：话语按序号编号，路由并发进行（n+1 的路由与 n 的执行/压缩重叠），
+    执行严格按序号应用；路由读到的快照若已过期，新建决策在执行前重新路由一次"""
+    def __init__(self, session: "Session"):
+        self.session = session
+        self.seq = 0
+        self.stats: Dict[str, int] = {k: 0 for k in PIPELINE_TOTALS}
+        self._queue: asyncio.Queue = asyncio.Queue()  # (seq, utter, 路由任务, 提交时间)
+        self._worker: Optional[asyncio.Task] = None
+        self._busy = False
+        self._waiting_on: Optional[asyncio.Future] = None  # 执行线程正在等的路由
+        self._progress = asyncio.Event()
+    
+    def _wait_on(self, fut: Optional[asyncio.Future]):
+        self._waiting_on = fut
+        self._progress.set()
+    
+    def _caught_up(self) -> bool:
+        """已路由完成的话语都已执行：执行线程在等一个未完成的路由（含重新路由），或者空闲"""
+        if self._waiting_on is not None:
+            return not self._waiting_on.done()
+        return not self._busy
+    
+    async def settle(self, timeout: float = 2.0):
+        """批量路由读快照前调用：刚拿到决策的话语先执行，否则它们的新建会让下一批决策全部过期"""
+        await asyncio.sleep(0)  # 让刚拿到结果的路由任务先结束
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while not self._caught_up():
+            self._progress.clear()
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return
+            try:
+                await asyncio.wait_for(self._progress.wait(), remaining)
+            except asyncio.TimeoutError:
+                return
+    
+    def _count(self, key: str):
+        self.stats[key] += 1
+        PIPELINE_TOTALS[key] += 1
+    
+    @property
+    def idle(self) -> bool:
+        return self._queue.empty() and not self._busy
+    
+    def submit(self, text: str) -> int:
+        self.seq += 1
+        self._count("submitted")
+        utter = to_point(text)
+        routing = asyncio.create_task(route_utterance(self.session, utter))
+        self._queue.put_nowait((self.seq, utter, routing, time.time()))
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._apply_in_order())
+        return self.seq
+    
+    def is_stale(self, dec: Dict[str, Any]) -> bool:
+        # 只有“新建”会因快照过期出错（期间可能已有人建了同一话题）；追加目标被合并时由别名解析
+        if dec.get("action", "create_topic") != "create_topic":
+            return False
+        store = self.session.store
+        baseline = dec["batch"]["version"] if "batch" in dec else dec.get("store_version", store.version)
+        return store.last_create_version > baseline
+    
+    async def _apply_in_order(self):
+        while True:
+            seq, utter, routing, t0 = await self._queue.get()
+            self._busy = True
+            try:
+                self._wait_on(routing)
+                dec = await routing
+                self._wait_on(None)
+                stale = self.is_stale(dec)
+                if stale:
+                    self._count("rerouted")
+                    refs, ref = dec.get("refs"), dec.get("ref")
+                    rerouting = asyncio.ensure_future(route_utterance(self.session, utter))
+                    self._wait_on(rerouting)
+                    dec = await rerouting
+                    self._wait_on(None)
+                batch = dec.get("batch")
+                clean = batch is not None and self.session.store.last_create_version <= batch["version"]  # 快照之后没有别处的新建
+                result = await exec_decision(self.session, dec)
+                if clean:
+                    batch["version"] = max(batch["version"], self.session.store.last_create_version)  # 同批次自己的新建不算过期
+                tid = result.get("topic_id")
+                if stale and refs is not None and ref and refs.get(ref) not in self.session.store.topics:
+                    refs[ref] = tid  # 重新路由后仍登记原占位，同批次后续的 append new<N> 跟到这里
+                self._count("applied")
+                print(f"[llm] {self.session.id}#{seq} applied in {time.time()-t0:.2f}s")
+                await self.session.notify(tid)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._count("errors")
+                print(f"[llm] {self.session.id}#{seq} error: {e}")
+            finally:
+                self._busy = False
+                self._wait_on(None)
+    
+    def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+        while not self._queue.empty():
+            self._queue.get_nowait()[2].cancel()
+
+# ---------------------
+# 会话注册表：每个房间独立的话题存储 / 路由 / 压缩 / 流水线；空闲会话 LRU 淘汰或溢写到磁盘
+# ---------------------
+DEFAULT_SESSION = "default"
+
+def normalize_session_id(raw: Optional[str]) -> str:
+    """会话 id 只允许字母数字/-/_（用作文件名）；其他字符串取哈希，空值为默认会话"""
+    raw = (raw or "").strip()
+    if not raw:
+        return DEFAULT_SESSION
+    if re.fullmatch(r"[A-Za-z0-9_-]{1,64}", raw):
+        return raw
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+class Session:
+    """一个房间：话题存储、嵌入索引、批量路由、后台压缩与有序流水线；推送通过订阅者广播到本房间的连接"""
+    def __init__(self, sid: str, max_topics: int = SESSION_MAX_TOPICS):
+        self.id = sid
+        self.max_topics = max_topics
+        self.store = MemoryStore()
+        self.index = TopicEmbeddingIndex()
+        self.batcher = RoutingBatcher(self.store)
+        self.compressor = TopicCompressor(self)
+        self.pipeline = UtterancePipeline(self)
+        self.batcher.settle = self.pipeline.settle
+        self.persisted = TopicSync(self.store)   # 已写入状态后端的话题版本
+        self.near_dups = NearDuplicateIndex()     # 压缩后合并近似重复话题
+        self.connections = 0
+        self.requests = 0                         # 正在处理的 HTTP 请求（演示 / 保存画布等会跨越 LLM 调用）
+        self.last_active = time.time()
+        self._listeners: List[Any] = []   # async fn(topic_id)
+    
+    def subscribe(self, fn):
+        self._listeners.append(fn)
+    
+    def unsubscribe(self, fn):
+        if fn in self._listeners:
+            self._listeners.remove(fn)
+    
+    async def persist(self):
+        """把自上次以来变更 / 删除的话题写入共享后端（单线程写入器，保证按提交顺序落盘）"""
+        backend = get_state_backend()
+        if not backend.shared:
+            return
+        upserts, removed = self.persisted.changes()
+        if not upserts and not removed:
+            return
+        rows = json.loads(json.dumps([topic_to_dict(t) for t in upserts]))  # 写入在线程中进行，先深拷贝一份快照
+        try:
+            await asyncio.get_running_loop().run_in_executor(backend.executor, backend.save_topics, self.id, rows, removed)
+        except Exception as e:
+            print(f"[state] failed to persist {self.id}: {e}")
+    
+    async def notify(self, tid: Optional[str] = None, persist: bool = True):
+        """话题有变更：写入后端（多 worker 时其他 worker 据此同步），再推送给本房间的连接"""
+        self.last_active = time.time()
+        if persist:
+            await self.persist()
+        for fn in list(self._listeners):
+            try:
+                await fn(tid)
+            except Exception as e:
+                print(f"[session] {self.id} listener error: {e}")
+    
+    def enforce_caps(self):
+        """话题数超过上限时丢弃最久未更新的话题"""
+        while len(self.store.topics) > self.max_topics:
+            oldest = self.store.recent()[-1]
+            self.store.remove(oldest.id)
+            print(f"[session] {self.id} over {self.max_topics} topics, dropped {oldest.id} ({oldest.label})")
+            self.index.prune(self.store.topics)
+    
+    @contextmanager
+    def hold(self):
+        """请求处理期间不被淘汰"""
+        self.requests += 1
+        try:
+            yield self
+        finally:
+            self.requests -= 1
+            self.last_active = time.time()
+    
+    @property
+    def idle(self) -> bool:
+        return self.connections == 0 and self.requests == 0 and self.pipeline.idle and self.compressor.idle
+    
+    def approx_bytes(self) -> int:
+        return sum(len(t.label) + len(t.summary) + sum(len(p) for p in t.points) + sum(len(k) for k in t.keyphrases)
+                   for t in self.store.topics.values())
+    
+    def close(self):
+        self.pipeline.close()
+        self.compressor.reset()
+        self.index.close()
+
+class SessionRegistry:
+    """按会话 id 取会话（不存在则新建，或从状态后端恢复）；空闲超过 idle_s 或超出 max_sessions 时按 LRU 淘汰"""
+    def __init__(self, max_sessions: int = SESSION_MAX, idle_s: float = SESSION_IDLE_S):
+        self.max_sessions = max(1, max_sessions)
+        self.idle_s = idle_s
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}   # 正在从后端读取的会话，并发请求共用一次读取
+        self.stats: Dict[str, int] = {"created": 0, "restored": 0, "evicted": 0, "spilled": 0, "remote_updates": 0}
+    
+    def get(self, sid: Optional[str] = None) -> Session:
+        """同步取会话：不在内存时在当前线程读后端（脚本 / 兼容入口）；请求路径用 acquire()"""
+        sid = normalize_session_id(sid)
+        session = self._sessions.get(sid)
+        if session is None:
+            session = self._install(sid, get_state_backend().load_topics(sid))
+        return self._touch(session)
+    
+    async def acquire(self, sid: Optional[str] = None) -> Session:
+        """取会话；不在内存时在后端线程中读取，不阻塞事件循环"""
+        sid = normalize_session_id(sid)
+        session = self._sessions.get(sid)
+        if session is None:
+            loading = self._loading.get(sid)
+            if loading is None:
+                loading = self._loading[sid] = asyncio.ensure_future(self._load(sid))
+            session = await asyncio.shield(loading)
+        return self._touch(session)
+    
+    async def _load(self, sid: str) -> Session:
+        try:
+            backend = get_state_backend()
+            topics = await asyncio.get_running_loop().run_in_executor(backend.executor, backend.load_topics, sid)
+            session = self._sessions.get(sid)  # 读取期间可能已被同步入口建好
+            return session if session is not None else self._install(sid, topics)
+        finally:
+            self._loading.pop(sid, None)
+    
+    def _install(self, sid: str, topics: List[Topic]) -> Session:
+        session = Session(sid)
+        if topics:
+            session.store.load(topics)
+            session.persisted.mark()
+            print(f"[session] restored {sid} with {len(session.store.topics)} topics")
+        self.stats["restored" if topics else "created"] += 1
+        self._sessions[sid] = session
+        self.sweep(keep=sid)
+        return session
+    
+    def _touch(self, session: Session) -> Session:
+        if session.id in self._sessions:
+            self._sessions.move_to_end(session.id)
+        session.last_active = time.time()
+        return session
+    
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+    
+    def evict(self, sid: str):
+        """移出内存；溢写交给后端的单线程执行器（不阻塞事件循环，且排在之后对同一会话的读取之前）"""
+        session = self._sessions.pop(sid, None)
+        if session is None:
+            return
+        session.close()
+        self.stats["evicted"] += 1
+        topics = list(session.store.topics.values())
+        print(f"[session] evicted {sid} ({len(topics)} topics)")
+        backend = get_state_backend()
+        def spilled(fut):
+            if not fut.cancelled() and fut.exception() is None and fut.result():
+                self.stats["spilled"] += 1
+        backend.executor.submit(backend.release, sid, topics).add_done_callback(spilled)
+    
+    def sweep(self, keep: Optional[str] = None):
+        """淘汰空闲超时的会话；总数超限时再按 LRU 淘汰空闲会话（有连接或有在途任务的不动）"""
+        now = time.time()
+        for session in list(self._sessions.values()):
+            if session.id != keep and session.idle and now - session.last_active > self.idle_s:
+                self.evict(session.id)
+        for session in list(self._sessions.values()):
+            if len(self._sessions) <= self.max_sessions:
+                break
+            if session.id != keep and session.idle:
+                self.evict(session.id)
+    
+    async def apply_remote(self, event: Dict[str, Any]):
+        """其他 worker 改了某会话的话题：只更新本进程内存中已有的会话（不在内存的下次访问时从后端读取）"""
+        session = self._sessions.get(event["session"])
+        if session is None:
+            return
+        loop = asyncio.get_running_loop()
+        backend = get_state_backend()
+        topics = await loop.run_in_executor(backend.executor, backend.load_topics, session.id, event["ids"]) if event["ids"] else []
+        store = session.store
+        for tid in event["removed"]:
             if tid in store.topics:
-                p = to_point(dec.get("text", state["decision"].get("utterance","")))
-                if not store.topics[tid].points or store.topics[tid].points[-1] != p:
-                    store.topics[tid].points.append(p)
-                store.topics[tid].last_updated = now
-                return {"topic_id": tid, "changed": True}
-            # 若 ID 不存在，退化为新建
-            tid = str(uuid.uuid4())[:8]
-            store.topics[tid] = Topic(id=tid, points=[to_point(state["decision"].get("utterance",""))], last_updated=now)
-            return {"topic_id": tid, "changed": True}
-        elif action == "relabel_topic":
-            tid = dec.get("topic_id",""); new_label = (dec.get("new_label","") or "").strip()
-            if tid in store.topics and new_label:
-                store.topics[tid].label = normalize_label(new_label)
-                store.topics[tid].last_updated = now
-                return {"topic_id": tid, "changed": True}
-        # 默认新建
-        tid = str(uuid.uuid4())[:8]
-        store.topics[tid] = Topic(id=tid, points=[to_point(state["decision"].get("utterance",""))], last_updated=now)
-        return {"topic_id": tid, "changed": True}
+                store.remove(tid)
+        for t in topics:
+            cur = store.topics.get(t.id)
+            if cur is None:
+                store.add(t)
+            else:
+                cur.label, cur.keyphrases, cur.points = t.label, t.keyphrases, t.points
+                cur.summary, cur.last_updated = t.summary, t.last_updated
+                store.touch(t.id)
+            session.index.centroids.pop(t.id, None)  # 质心在下次路由时按新内容重建
+        session.index.prune(store.topics)
+        session.persisted.mark_topics([t.id for t in topics], event["removed"])  # 来自后端的变更不再写回；本地未写入的保留
+        self.stats["remote_updates"] += 1
+        await session.notify(topics[0].id if topics else None, persist=False)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        backend = get_state_backend()
+        now = time.time()
+        return {
+            **self.stats, "active": len(self._sessions), "on_disk": backend.stored_sessions(),
+            "connected": sum(1 for s in self._sessions.values() if s.connections),
+            "max_sessions": self.max_sessions, "idle_s": self.idle_s,
+            "backend": {"name": backend.name, "worker": WORKER_ID, **backend.stats,
+                        "canvas_write_behind": _CANVAS_STORE.stats if _CANVAS_STORE is not None else None},
+            "sessions": [
+                {"id": s.id, "connections": s.connections, "topics": len(s.store.topics),
+                 "approx_bytes": s.approx_bytes(), "idle_s": round(now - s.last_active, 1)}
+                for s in reversed(self._sessions.values())
+            ],
+        }
 
-    def merge_topics(target_id: str, source_id: str) -> str:
-        """Merge source topic into target and delete source; return kept id"""
-        if target_id == source_id:
-            return target_id
-        if target_id not in store.topics or source_id not in store.topics:
-            return target_id if target_id in store.topics else source_id
-        target = store.topics[target_id]
-        source = store.topics[source_id]
-        # Merge points (preserve order, avoid dup consecutive)
-        for p in source.points:
-            if not target.points or target.points[-1] != p:
-                target.points.append(p)
-        # Merge keyphrases (unique, keep short list)
-        merged_keys = normalize_keyphrases(list(target.keyphrases) + list(source.keyphrases))
-        target.keyphrases = merged_keys
-        # Prefer existing summary; fallback to source if empty
-        if not target.summary and source.summary:
-            target.summary = source.summary
-        target.last_updated = max(target.last_updated, source.last_updated, time.time())
-        # Drop source
-        store.topics.pop(source_id, None)
-        return target_id
+sessions = SessionRegistry()
+
+async def request_session(request: Request) -> Session:
+    """REST 请求的会话：?session= 或 X-Session-Id 头，缺省为默认会话"""
+    return await sessions.acquire(request.query_params.get("session") or request.headers.get("x-session-id"))
+
+async def session_sweeper():
+    while True:
+        await asyncio.sleep(max(5.0, min(60.0, sessions.idle_s / 2)))
+        sessions.sweep()
+
+async def state_poller():
+    """共享后端：轮询其他 worker 的变更事件，同步到本进程内存中的会话与画布历史"""
+    backend = get_state_backend()
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(STATE_POLL_S)
+        try:
+            events = await loop.run_in_executor(backend.executor, backend.poll)
+            for event in events:
+                if event["kind"] == "canvas":
+                    if _CANVAS_STORE is not None:
+                        summaries = await loop.run_in_executor(backend.executor, backend.canvas_summaries, event["ids"]) if event["ids"] else []
+                        _CANVAS_STORE.apply_remote(event["ids"], event["removed"], summaries)
+                else:
+                    await sessions.apply_remote(event)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"[state] poll error: {e}")
+
+def __getattr__(name: str):
+    # 兼容 `from app import graph, canvas_store, store, compressor`（如 test_classification.py）；
+    # store / compressor / topic_index 指向默认会话
+    if name == "graph":
+        return get_graph()
+    if name == "canvas_store":
+        return get_canvas_store()
+    if name == "store":
+        return sessions.get(DEFAULT_SESSION).store
+    if name == "compressor":
+        return sessions.get(DEFAULT_SESSION).compressor
+    if name == "topic_index":
+        return sessions.get(DEFAULT_SESSION).index
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# ---------------------
+# 全文检索：话题标签 / 关键词 / 总结 / 要点的倒排索引（当前会话的实时话题 + 全部画布历史），BM25 排序
+# ---------------------
+_SEARCH_CJK = "\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af"  # 假名、中日韩统一表意文字、韩文
+_SEARCH_TOKEN_RE = re.compile(rf"[{_SEARCH_CJK}]+|[^\W_{_SEARCH_CJK}]+")
+_SEARCH_CJK_RE = re.compile(rf"[{_SEARCH_CJK}]")
+SEARCH_FIELD_WEIGHTS = {"label": 3, "keyphrases": 2, "summary": 1, "points": 1}  # 词频按字段加权
+
+def search_tokens(text: str, query: bool = False) -> List[str]:
+    """拉丁文按词（小写）；中日韩文字没有空格，文档取单字 + 相邻二字，查询取二字（单字查询取单字）"""
+    out = []
+    for run in _SEARCH_TOKEN_RE.findall((text or "").lower()):
+        if not _SEARCH_CJK_RE.match(run):
+            out.append(run)
+        elif len(run) == 1:
+            out.append(run)
+        else:
+            bigrams = [run[i:i + 2] for i in range(len(run) - 1)]
+            out.extend(bigrams if query else list(run) + bigrams)
+    return out
 
-    def dedup_by_label(current_id: str) -> str:
-        """If another topic has the same label (case-insensitive), merge into the newest one."""
-        if current_id not in store.topics:
-            return current_id
-        cur = store.topics[current_id]
-        cur_label = (cur.label or "").strip().lower()
-        if not cur_label:
-            return current_id
-        # Find another topic with same label
-        for tid, t in list(store.topics.items()):
-            if tid == current_id:
+@dataclass
+class SearchDoc:
+    key: Tuple[str, str, str]          # (live | canvas, 会话 id | 画布 id, 话题 id)
+    fields: Dict[str, str]
+    terms: Dict[str, int]              # 词 → 加权词频
+    length: int
+
+class SearchIndex:
+    """倒排索引：词 → {文档: 加权词频}，另有排好序的词表做前缀匹配。
+    实时话题在查询时按话题版本增量同步（新增 / 合并 / 去重 / 清空都只重建变过的话题）；
+    画布历史在增删改时记为脏，下次查询前重建对应画布的文档"""
+    def __init__(self, k1: float = 1.2, b: float = 0.75, max_expansions: int = 50):
+        self.k1, self.b, self.max_expansions = k1, b, max_expansions
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.vocab: List[str] = []                       # 有序，供前缀二分
+        self.docs: Dict[int, SearchDoc] = {}
+        self.doc_ids: Dict[Tuple[str, str, str], int] = {}
+        self.owners: Dict[Tuple[str, str], set] = {}     # (scope, owner) → 文档 id
+        self.total_length = 0
+        self._next_id = 0
+        self._live: Dict[str, TopicSync] = {}            # 会话 id → 已索引的话题版本
+        self._dirty_canvases: set = set()
+        self._dirty_lock = threading.Lock()
+        self._canvases_built = False
+    
+    # 文档增删
+    def upsert(self, key: Tuple[str, str, str], topic: Topic):
+        self.remove(key)
+        fields = {"label": topic.label, "keyphrases": ", ".join(topic.keyphrases),
+                  "summary": topic.summary, "points": "\n".join(topic.points)}
+        terms: Dict[str, int] = {}
+        for name, text in fields.items():
+            weight = SEARCH_FIELD_WEIGHTS[name]
+            for tok in search_tokens(text):
+                terms[tok] = terms.get(tok, 0) + weight
+        if not terms:
+            return
+        doc_id = self._next_id
+        self._next_id += 1
+        doc = SearchDoc(key=key, fields=fields, terms=terms, length=sum(terms.values()))
+        self.docs[doc_id] = doc
+        self.doc_ids[key] = doc_id
+        self.owners.setdefault(key[:2], set()).add(doc_id)
+        self.total_length += doc.length
+        for term, tf in terms.items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = {}
+                bisect.insort(self.vocab, term)
+            posting[doc_id] = tf
+    
+    def remove(self, key: Tuple[str, str, str]):
+        doc_id = self.doc_ids.pop(key, None)
+        if doc_id is None:
+            return
+        doc = self.docs.pop(doc_id)
+        self.owners.get(key[:2], set()).discard(doc_id)
+        self.total_length -= doc.length
+        for term in doc.terms:
+            posting = self.postings.get(term)
+            if posting is None:
                 continue
-            if (t.label or "").strip().lower() == cur_label:
-                # Keep the most recently updated
-                keep = tid if t.last_updated >= cur.last_updated else current_id
-                drop = current_id if keep == tid else tid
-                return merge_topics(keep, drop)
-        return current_id
+            posting.pop(doc_id, None)
+            if not posting:
+                del self.postings[term]
+                i = bisect.bisect_left(self.vocab, term)
+                if i < len(self.vocab) and self.vocab[i] == term:
+                    self.vocab.pop(i)
+    
+    def remove_owner(self, scope: str, owner: str):
+        for doc_id in list(self.owners.pop((scope, owner), ())):
+            doc = self.docs.get(doc_id)
+            if doc is not None:
+                self.remove(doc.key)
+    
+    # 增量同步
+    def sync_session(self, session: "Session"):
+        sync = self._live.get(session.id)
+        if sync is None or sync.store is not session.store:  # 新会话，或会话被淘汰后重建
+            self.remove_owner("live", session.id)
+            sync = self._live[session.id] = TopicSync(session.store)
+        upserts, removed = sync.changes()
+        for tid in removed:
+            self.remove(("live", session.id, tid))
+        for t in upserts:
+            self.upsert(("live", session.id, t.id), t)
+    
+    def prune_sessions(self, live_ids: set):
+        for sid in [sid for sid in self._live if sid not in live_ids]:
+            self._live.pop(sid, None)
+            self.remove_owner("live", sid)
+    
+    def mark_canvas(self, canvas_id: str):
+        with self._dirty_lock:
+            self._dirty_canvases.add(canvas_id)
+    
+    def sync_canvases(self, store: CanvasStore):
+        """首次调用时索引全部画布，之后只重建被标脏的画布（可在线程池中运行）"""
+        if not self._canvases_built:
+            store.watch(self.mark_canvas)
+            with self._dirty_lock:
+                self._dirty_canvases.update(store.ids())
+            self._canvases_built = True
+        with self._dirty_lock:
+            dirty, self._dirty_canvases = self._dirty_canvases, set()
+        for cid in dirty:
+            self.remove_owner("canvas", cid)
+            canvas = store.peek(cid)
+            if canvas is not None:
+                for t in list(canvas.topics.values()):
+                    self.upsert(("canvas", cid, t.id), t)
+    
+    # 查询
+    def _expand(self, token: str, prefix: bool) -> List[Tuple[str, float]]:
+        """查询词 → (索引词, 权重)：精确匹配权重 1；前缀匹配（拉丁词）0.8"""
+        out = [(token, 1.0)] if token in self.postings else []
+        if prefix and not _SEARCH_CJK_RE.match(token):
+            i = bisect.bisect_left(self.vocab, token)
+            while i < len(self.vocab) and self.vocab[i].startswith(token) and len(out) < self.max_expansions:
+                if self.vocab[i] != token:
+                    out.append((self.vocab[i], 0.8))
+                i += 1
+        return out
+    
+    def search(self, q: str, limit: int = 20, scopes: Optional[Dict[str, Optional[str]]] = None) -> List[Tuple[float, SearchDoc, List[str]]]:
+        """BM25；最后一个查询词按前缀匹配（边输入边搜），其余词需完整匹配。
+        scopes：{"live": 会话 id, "canvas": None} 表示只查该会话的实时话题与全部画布"""
+        tokens = list(dict.fromkeys(search_tokens(q, query=True)))
+        if not tokens or not self.docs:
+            return []
+        n = len(self.docs)
+        docs = self.docs
+        base = self.k1 * (1 - self.b)                      # BM25 分母：tf + k1 * (1 - b + b * dl / avgdl)
+        per_len = self.k1 * self.b * n / self.total_length
+        scores: Dict[int, float] = {}
+        matched: Dict[int, List[str]] = {}
+        for pos, token in enumerate(tokens):
+            best: Dict[int, Tuple[float, str]] = {}
+            for term, weight in self._expand(token, prefix=pos == len(tokens) - 1 and len(token) >= 2):
+                posting = self.postings[term]
+                scale = weight * (self.k1 + 1) * math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+                for doc_id, tf in posting.items():
+                    s = scale * tf / (tf + base + per_len * docs[doc_id].length)
+                    prev = best.get(doc_id)
+                    if prev is None or s > prev[0]:
+                        best[doc_id] = (s, term)
+            for doc_id, (s, term) in best.items():
+                scores[doc_id] = scores.get(doc_id, 0.0) + s
+                matched.setdefault(doc_id, []).append(term)
+        hits = []
+        for doc_id, score in scores.items():
+            doc = self.docs[doc_id]
+            scope, owner, _ = doc.key
+            if scopes is not None and (scope not in scopes or scopes[scope] not in (None, owner)):
+                continue
+            hits.append((score * len(matched[doc_id]) / len(tokens), doc, matched[doc_id]))  # 命中的查询词越全越靠前
+        hits.sort(key=lambda h: h[0], reverse=True)
+        return hits[:limit]
+
+def search_snippet(doc: SearchDoc, terms: List[str], width: int = 90) -> Tuple[str, List[List[int]]]:
+    """命中最多的字段里、第一个命中附近的一段原文，以及片段内命中位置 [[start, end], ...]"""
+    def find_all(text: str) -> List[Tuple[int, int]]:
+        low = text.lower()
+        spans = []
+        for term in terms:
+            start = low.find(term)
+            while start >= 0:
+                spans.append((start, start + len(term)))
+                start = low.find(term, start + 1)
+        return sorted(spans)
+    best_text, best_spans = doc.fields.get("summary") or doc.fields.get("label", ""), []
+    for name in ("points", "summary", "keyphrases", "label"):
+        spans = find_all(doc.fields.get(name, ""))
+        if len(spans) > len(best_spans):
+            best_text, best_spans = doc.fields[name], spans
+    if not best_spans:
+        return best_text[:width], []
+    # 要点字段：取命中所在的那一条
+    first = best_spans[0][0]
+    line_start = best_text.rfind("\n", 0, first) + 1
+    line_end = best_text.find("\n", first)
+    start, end = line_start, (len(best_text) if line_end < 0 else line_end)
+    if end - start > width:
+        start = max(start, first - width // 3)
+        end = min(end, start + width)
+    snippet = best_text[start:end]
+    highlights = [[a - start, b - start] for a, b in best_spans if a >= start and b <= end]
+    merged: List[List[int]] = []
+    for a, b in highlights:
+        if merged and a <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], b)
+        else:
+            merged.append([a, b])
+    return snippet, merged
+
+search_index = SearchIndex()
+SEARCH_LOCK = asyncio.Lock()  # 同步与查询串行执行
+
+# ---------------------
+# 启动生命周期：后台预加载 + 就绪探针
+# ---------------------
+@dataclass
+class ComponentState:
+    warm: bool = False
+    error: Optional[str] = None
+    seconds: Optional[float] = None
 
-    # 节点3：压缩（关键词/总结/修正标签）
-    async def compress_node(state: Dict[str, Any]):
-        tid = state.get("topic_id")
-        if not tid or tid not in store.topics:
-            return {}
-        t = store.topics[tid]
-        recent = "\n- " + "\n- ".join(t.points[-MAX_POINTS_PER_TOPIC:])
-        resp = await ollama_generate(compress_prompt(recent, t.label), temperature=0.2, max_tokens=220)
+COMPONENTS: Dict[str, ComponentState] = {
+    name: ComponentState() for name in ("graph", "canvas", "asr", "llm")
+}
+
+def mark_warm(name: str):
+    """组件首次被实际加载 / 调用成功（不论是否经过预热）即视为就绪"""
+    state = COMPONENTS[name]
+    if not state.warm:
+        state.warm, state.error = True, None
+        print(f"[startup] {name} ready")
+
+async def warm_component(name: str, fn, retry_max_s: float = 60.0):
+    """运行预热函数（同步函数放到线程池），记录耗时与错误；失败后退避重试，直到预热成功或已被按需加载"""
+    state = COMPONENTS[name]
+    delay = 2.0
+    while not state.warm:
+        t0 = time.time()
         try:
-            data = json.loads(one_line_json(resp))
-            if isinstance(data.get("keyphrases"), list) and data["keyphrases"]:
-                t.keyphrases = normalize_keyphrases(data["keyphrases"])
-            if isinstance(data.get("summary"), str):
-                t.summary = data["summary"].strip()
-            if isinstance(data.get("label"), str) and data["label"].strip():
-                t.label = normalize_label(data["label"])
-            t.last_updated = time.time()
-            # Deduplicate topics that ended up with the same label
-            kept = dedup_by_label(tid)
-            return {"changed": True, "topic_id": kept}
-        except Exception:
-            pass
-        return {"changed": True, "topic_id": tid}
+            if asyncio.iscoroutinefunction(fn):
+                await fn()
+            else:
+                await asyncio.get_running_loop().run_in_executor(None, fn)
+            state.warm, state.error = True, None
+            state.seconds = round(time.time() - t0, 2)
+            print(f"[startup] {name} warm in {state.seconds:.2f}s")
+        except Exception as e:
+            state.seconds = round(time.time() - t0, 2)
+            if state.warm:
+                break
+            state.error = str(e)
+            print(f"[startup] {name} warm-up failed, retrying in {delay:.0f}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, retry_max_s)
 
-    g.add_node("router", route_node)
-    g.add_node("exec", exec_node)
-    g.add_node("compress", compress_node)
-    g.add_edge(START, "router")
-    g.add_edge("router", "exec")
-    g.add_edge("exec", "compress")
-    g.add_edge("compress", END)
-    return g.compile()
+async def warm_llm():
+    # 一次最短生成：把模型载入 Ollama 内存，并预填路由指令前缀的 KV 缓存
+    await ollama_generate(router_prompt("", "[]"), temperature=0.0, max_tokens=1, cache=False)
+
+async def preload_components():
+    """服务启动后在后台预热，互不阻塞；失败只记录，不影响存活"""
+    await asyncio.gather(
+        warm_component("graph", get_graph),
+        warm_component("canvas", get_canvas_store),
+        warm_component("asr", asr_scheduler.warm),
+        warm_component("llm", warm_llm),
+    )
 
-graph = build_graph()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await llm.start()
+    warm_task = asyncio.create_task(preload_components()) if PRELOAD_MODELS else None
+    sweep_task = asyncio.create_task(session_sweeper())
+    poll_task = asyncio.create_task(state_poller()) if get_state_backend().shared else None
+    yield
+    if warm_task is not None:
+        warm_task.cancel()
+    sweep_task.cancel()
+    if poll_task is not None:
+        poll_task.cancel()
+    asr_scheduler.shutdown()
+    await llm.aclose()
+    if _CANVAS_STORE is not None:
+        await asyncio.get_running_loop().run_in_executor(None, _CANVAS_STORE.close)  # 写完延迟的画布变更
+    get_state_backend().close()
 
 # ---------------------
 # FastAPI
 # ---------------------
-app = FastAPI(title="RippleNote (single-folder)")
+app = FastAPI(title="RippleNote (single-folder)", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -645,49 +3620,202 @@ app.add_middleware(
 
 # API 路由（必须在静态文件挂载之前定义）
 @app.get("/health")
+@app.get("/health/live")
 def health():
+    """存活探针：进程能响应即可"""
     return {"ok": True}
 
+@app.get("/health/ready")
+def health_ready():
+    """就绪探针：ASR / LLM / 图 / 画布历史都已预热（或已按需加载）才返回 200；
+    PRELOAD_MODELS=0 时组件在首次使用时加载，只要没有报错即视为就绪"""
+    components = {name: vars(state) for name, state in COMPONENTS.items()}
+    ready = all(state.warm or (not PRELOAD_MODELS and state.error is None) for state in COMPONENTS.values())
+    return JSONResponse({"ready": ready, "components": components}, status_code=200 if ready else 503)
+
+@app.get("/stats/asr")
+def asr_stats():
+    """ASR 调度与语音门限统计"""
+    return {
+        "scheduler": {**asr_scheduler.stats, "backlog": asr_scheduler.backlog, "workers": asr_scheduler.workers},
+        "vad": {"mode": ASR_VAD, **GATE_TOTALS},
+    }
+
+@app.get("/stats/llm")
+def llm_stats():
+    """LLM 调用统计：次数、重试、熔断、延迟与 token 数，以及各会话后台压缩的合并情况（累计）"""
+    compress: Dict[str, int] = {"pending": 0}
+    for session in sessions:
+        for k, v in session.compressor.stats.items():
+            compress[k] = compress.get(k, 0) + v
+        compress["pending"] += len(session.compressor.pending)
+    return {**llm.snapshot(), "compress": compress}
+
+@app.get("/stats/router")
+def router_stats():
+    """路由统计（全部会话累计）：嵌入快速路由命中 / 回退 / 出错与阈值，以及 LLM 批量路由的合并情况"""
+    index: Dict[str, int] = {"topics_indexed": 0}
+    batching: Dict[str, int] = {"waiting": 0}
+    for session in sessions:
+        for k, v in session.index.stats.items():
+            index[k] = index.get(k, 0) + v
+        for k, v in session.batcher.stats.items():
+            batching[k] = batching.get(k, 0) + v
+        index["topics_indexed"] += len(session.index.centroids)
+        batching["waiting"] += len(session.batcher.waiting)
+    return {
+        **index, "enabled": ROUTER_EMBED, "model": OLLAMA_EMBED_MODEL,
+        "min_sim": ROUTER_EMBED_MIN_SIM, "margin": ROUTER_EMBED_MARGIN,
+        "llm_batching": batching, "pipeline": PIPELINE_TOTALS,
+    }
+
+@app.get("/stats/sessions")
+def session_stats():
+    """会话统计：内存中的会话、连接数、话题数与近似大小，以及淘汰 / 溢写 / 恢复次数"""
+    return sessions.snapshot()
+
 @app.get("/topics")
-def get_topics():
-    env = TopicsEnvelope(topics=store.as_payload(MAX_POINTS_PER_TOPIC))
-    return json.loads(env.model_dump_json())
+async def get_topics(request: Request):
+    return json.loads((await request_session(request)).store.payload_json(MAX_POINTS_PER_TOPIC))
+
+@app.get("/search")
+async def search(request: Request, q: str = "", limit: int = 20, scope: str = "all"):
+    """全文检索：当前会话（?session= / X-Session-Id）的实时话题与全部画布历史；
+    scope = all | live | canvas。BM25 排序，最后一个词按前缀匹配，返回命中片段与高亮位置"""
+    q = q.strip()[:200]
+    if not q:
+        return {"query": q, "results": []}
+    t0 = time.perf_counter()
+    session = await request_session(request)
+    scopes: Dict[str, Optional[str]] = {}
+    if scope in ("all", "live"):
+        scopes["live"] = session.id
+    if scope in ("all", "canvas"):
+        scopes["canvas"] = None
+    async with SEARCH_LOCK:
+        if "canvas" in scopes:
+            await asyncio.get_running_loop().run_in_executor(None, search_index.sync_canvases, get_canvas_store())
+        search_index.prune_sessions({s.id for s in sessions})
+        if "live" in scopes:
+            search_index.sync_session(session)
+        hits = search_index.search(q, min(100, max(1, limit)), scopes)
+    results = []
+    for score, doc, terms in hits:
+        kind, owner, tid = doc.key
+        snippet, highlights = search_snippet(doc, terms)
+        item = {"scope": kind, "topic_id": tid, "label": doc.fields["label"], "score": round(float(score), 4),
+                "snippet": snippet, "highlights": highlights}
+        if kind == "canvas":
+            summary = get_canvas_store().summary(owner) or {}
+            item.update(canvas_id=owner, canvas_title=summary.get("title", ""), created_at=summary.get("created_at"))
+        else:
+            item["session"] = owner
+        results.append(item)
+    return {"query": q, "results": results, "docs": len(search_index.docs),
+            "took_ms": round((time.perf_counter() - t0) * 1000, 2)}
 
 @app.post("/maintenance/dedup_all")
-def dedup_all():
-    """Normalize keyphrases/labels and merge duplicate topics (live + history)."""
-    live_stats = dedup_topics_map(store.topics)
-    history_stats = {"canvases": 0, "merged": 0, "normalized": 0}
-    for canvas in canvas_store.canvases:
-        res = dedup_topics_map(canvas.topics)
+async def dedup_all(dry_run: bool = False, min_sim: Optional[float] = None):
+    """Normalize keyphrases/labels and merge duplicate / near-duplicate topics (live sessions + history).
+    dry_run=1 只返回将被合并的话题对与相似度，不做任何修改；min_sim 临时覆盖 DEDUP_MIN_SIM"""
+    live_stats = {"merged": 0, "normalized": 0, "pairs": []}
+    for session in sessions:
+        res = dedup_store(session.store, min_sim, dry_run, session.index)
+        live_stats["pairs"].extend(dict(p, session=session.id) for p in res["pairs"])
+        if dry_run:
+            continue
+        session.index.prune(session.store.topics)
+        await session.notify()
+        live_stats["merged"] += res["merged"]
+        live_stats["normalized"] += res["normalized"]
+    history_stats = {"canvases": 0, "merged": 0, "normalized": 0, "pairs": []}
+    changed = []
+    for canvas in get_canvas_store().iter_canvases():
+        res = dedup_topics_map(canvas.topics, min_sim, dry_run)
         history_stats["canvases"] += 1
         history_stats["merged"] += res["merged"]
         history_stats["normalized"] += res["normalized"]
+        history_stats["pairs"].extend(dict(p, canvas_id=canvas.id) for p in res["pairs"])
+        if res["merged"] or res["normalized"]:
+            changed.append(canvas)
+    if dry_run:
+        return {"ok": True, "dry_run": True, "live": live_stats, "history": history_stats}
     # Persist history changes
     try:
-        canvas_store._save()
+        get_canvas_store().update(*changed)
     except Exception as e:
         print(f"[maintenance] failed to save canvas history after dedup: {e}")
     return {"ok": True, "live": live_stats, "history": history_stats}
 
 @app.post("/demo/clear")
-async def demo_clear():
-    """清空所有话题（用于演示）"""
-    store.topics.clear()
+async def demo_clear(request: Request):
+    """清空当前会话的所有话题（用于演示）"""
+    session = await request_session(request)
+    session.compressor.reset()
+    session.store.clear()
+    await session.notify()
     return {"ok": True}
 
 # ---------------------
 # Canvas API Endpoints
 # ---------------------
+CANVAS_BODY_FIELDS = ("positions", "topics")
+
+def project_canvas(item: Dict[str, Any], fields: Optional[List[str]]) -> Dict[str, Any]:
+    """列表项投影：摘要列直接取自索引；positions / topics 需要读画布正文（不进缓存）"""
+    if not fields:
+        return item
+    out = {k: item[k] for k in fields if k in item}
+    if any(k in CANVAS_BODY_FIELDS for k in fields):
+        canvas = get_canvas_store().peek(item['id'])
+        if canvas is not None:
+            if "positions" in fields:
+                out["positions"] = canvas.positions
+            if "topics" in fields:
+                out["topics"] = {tid: topic_to_dict(t) for tid, t in canvas.topics.items()}
+    return out
+
 @app.get("/canvas/history")
-def get_canvas_history():
-    """Get list of saved canvases"""
-    return {"canvases": canvas_store.get_list()}
+def get_canvas_history(limit: Optional[int] = None, cursor: Optional[str] = None,
+                       fields: Optional[str] = None, format: str = "json"):
+    """List saved canvases, newest first, one page per request.
+    `cursor` comes from the previous page's next_cursor; `fields` is a comma list of
+    id/title/summary/created_at/topic_count/positions/topics. `format=ndjson` streams
+    every canvas after `cursor` as one JSON object per line (export)."""
+    store = get_canvas_store()
+    wanted = None
+    if fields:
+        wanted = ["id"] + [f for f in (x.strip() for x in fields.split(","))
+                           if f != "id" and (f in CANVAS_SUMMARY_COLUMNS or f in CANVAS_BODY_FIELDS)]
+    try:
+        store.decode_cursor(cursor) if cursor else None
+    except Exception:
+        return JSONResponse({"error": "Invalid cursor"}, status_code=400)
+    
+    if format == "ndjson":
+        def stream():
+            # 按页推进游标：导出过程中增删画布不会打乱顺序
+            nonlocal cursor
+            remaining = limit if limit and limit > 0 else None
+            while remaining is None or remaining > 0:
+                size = 200 if remaining is None else min(200, remaining)
+                items, cursor = store.page(size, cursor)
+                for item in items:
+                    yield json.dumps(project_canvas(item, wanted), ensure_ascii=False) + "\n"
+                if remaining is not None:
+                    remaining -= len(items)
+                if cursor is None:
+                    break
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+    
+    size = min(500, max(1, limit if limit is not None else CANVAS_PAGE_SIZE))
+    items, next_cursor = store.page(size, cursor)
+    return {"canvases": [project_canvas(item, wanted) for item in items], "next_cursor": next_cursor, "total": len(store)}
 
 @app.get("/canvas/{canvas_id}")
 def get_canvas(canvas_id: str):
     """Get a specific canvas by ID"""
-    canvas = canvas_store.get_by_id(canvas_id)
+    canvas = get_canvas_store().get_by_id(canvas_id)
     if not canvas:
         return {"error": "Canvas not found"}
     
@@ -714,110 +3842,125 @@ def get_canvas(canvas_id: str):
 @app.delete("/canvas/{canvas_id}")
 def delete_canvas(canvas_id: str):
     """Delete a canvas by ID"""
-    deleted = canvas_store.delete(canvas_id)
+    deleted = get_canvas_store().delete(canvas_id)
     if not deleted:
         return {"error": "Canvas not found"}
     return {"ok": True, "deleted": canvas_id}
 
 @app.patch("/canvas/{canvas_id}/positions")
 async def update_canvas_positions(canvas_id: str, request: Request):
-    """Update stored positions for an existing canvas"""
-    canvas = canvas_store.get_by_id(canvas_id)
+    """Update stored positions for an existing canvas.
+    Body is either {"positions": {...}} (full map) or {"moved": {...}, "removed": [...]} (only changed nodes).
+    Changes are merged in memory and written by the background flusher."""
+    canvas = get_canvas_store().get_by_id(canvas_id)
     if not canvas:
         return {"error": "Canvas not found"}
     try:
         payload = await request.json()
     except Exception:
         payload = {}
+    if not isinstance(payload, dict):
+        payload = {}
+    if "moved" in payload or "removed" in payload:
+        moved = sanitize_positions(payload.get("moved") or {})
+        removed = [str(tid) for tid in payload.get("removed") or [] if isinstance(tid, str)]
+        positions = get_canvas_store().patch_positions(canvas, moved, removed)
+        return {"ok": True, "updated": len(moved), "removed": len(removed), "total": len(positions)}
     positions = sanitize_positions(payload.get("positions", {}))
-    canvas.positions = positions
-    canvas_store._save()
+    get_canvas_store().set_positions(canvas, positions)
     return {"ok": True, "positions": positions}
 
 @app.post("/canvas/new")
 async def create_new_canvas(request: Request):
     """Save current topics as a canvas and start fresh"""
-    # Filter out empty topics (no points)
-    valid_topics = {tid: t for tid, t in store.topics.items() if t.points}
-    # If no valid topics, do not save
-    if not valid_topics:
-        return {"ok": True, "message": "No topics to save"}
-
-    # Optional positions payload from frontend
-    positions_payload = {}
-    try:
-        payload = await request.json()
-        if isinstance(payload, dict):
-            positions_payload = payload.get("positions") or {}
-    except Exception:
+    session = await request_session(request)
+    with session.hold():  # 跨越 LLM 调用期间不被淘汰
+        store = session.store
+        await session.compressor.flush()  # 保存前补齐尚未压缩的标签/总结
+        # Filter out empty topics (no points)
+        valid_topics = {tid: t for tid, t in store.topics.items() if t.points}
+        # If no valid topics, do not save
+        if not valid_topics:
+            return {"ok": True, "message": "No topics to save"}
+        
+        # Optional positions payload from frontend
         positions_payload = {}
-    
-    # Generate title and summary using LLM
-    topics_info = []
-    for t in valid_topics.values():
-        topics_info.append(f"- {t.label}: {t.summary or ', '.join(t.keyphrases[:3])}")
-    topics_str = "\n".join(topics_info)
-    
-    try:
-        resp = await ollama_generate(canvas_summary_prompt(topics_str), temperature=0.3, max_tokens=150)
-        data = json.loads(one_line_json(resp))
-        title = data.get("title", "Brainstorm Session")
-        summary = data.get("summary", "")
-    except Exception as e:
-        print(f"[canvas] summary generation error: {e}")
-        # Fallback: use first topic label as title
-        first_topic = list(store.topics.values())[0] if store.topics else None
-        title = first_topic.label if first_topic else "Brainstorm Session"
-        summary = f"{len(store.topics)} topics discussed"
-    
-    # Create canvas (deep copy topics so future mutations won't affect history)
-    topics_copy = {}
-    for tid, t in valid_topics.items():
-        topics_copy[tid] = Topic(
-            id=t.id,
-            label=t.label,
-            keyphrases=list(t.keyphrases),
-            points=list(t.points),
-            summary=t.summary,
-            last_updated=t.last_updated
+        try:
+            payload = await request.json()
+            if isinstance(payload, dict):
+                positions_payload = payload.get("positions") or {}
+        except Exception:
+            positions_payload = {}
+        
+        # Generate title and summary using LLM
+        topics_info = []
+        for t in valid_topics.values():
+            topics_info.append(f"- {t.label}: {t.summary or ', '.join(t.keyphrases[:3])}")
+        topics_str = "\n".join(topics_info)
+        
+        try:
+            data = await ollama_generate_json(canvas_summary_prompt(topics_str), temperature=0.3, max_tokens=150,
+                                              schema=CANVAS_SUMMARY_SCHEMA)
+            title = data.get("title", "Brainstorm Session")
+            summary = data.get("summary", "")
+        except Exception as e:
+            print(f"[canvas] summary generation error: {e}")
+            # Fallback: use first topic label as title
+            first_topic = list(store.topics.values())[0] if store.topics else None
+            title = first_topic.label if first_topic else "Brainstorm Session"
+            summary = f"{len(store.topics)} topics discussed"
+        
+        # Create canvas (deep copy topics so future mutations won't affect history)
+        topics_copy = {}
+        for tid, t in valid_topics.items():
+            topics_copy[tid] = Topic(
+                id=t.id,
+                label=t.label,
+                keyphrases=list(t.keyphrases),
+                points=list(t.points),
+                summary=t.summary,
+                last_updated=t.last_updated
+            )
+        
+        # Create canvas
+        canvas_positions = sanitize_positions(positions_payload)
+        
+        canvas = Canvas(
+            id=str(uuid.uuid4())[:8],
+            title=title,
+            summary=summary,
+            topics=topics_copy,
+            created_at=datetime.now().isoformat(),
+            positions=canvas_positions
         )
-
-    # Create canvas
-    canvas_positions = sanitize_positions(positions_payload)
-
-    canvas = Canvas(
-        id=str(uuid.uuid4())[:8],
-        title=title,
-        summary=summary,
-        topics=topics_copy,
-        created_at=datetime.now().isoformat(),
-        positions=canvas_positions
-    )
-    
-    # Save to history
-    canvas_store.add(canvas)
-    
-    # Clear current topics
-    store.topics.clear()
-    
-    return {
-        "ok": True,
-        "canvas_id": canvas.id,
-        "title": title,
-        "summary": summary
-    }
+        
+        # Save to history
+        get_canvas_store().add(canvas)
+        
+        # Clear current topics
+        session.compressor.reset()
+        store.clear()
+        await session.notify()
+        
+        return {
+            "ok": True,
+            "canvas_id": canvas.id,
+            "title": title,
+            "summary": summary
+        }
 
 @app.post("/canvas/load/{canvas_id}")
-async def load_canvas(canvas_id: str):
+async def load_canvas(canvas_id: str, request: Request):
     """Load a canvas from history into current session"""
-    canvas = canvas_store.get_by_id(canvas_id)
+    canvas = get_canvas_store().get_by_id(canvas_id)
     if not canvas:
         return {"error": "Canvas not found"}
     
     # Replace current topics with canvas topics
-    store.topics.clear()
-    for tid, topic in canvas.topics.items():
-        store.topics[tid] = Topic(
+    session = await request_session(request)
+    session.compressor.reset()
+    session.store.load([
+        Topic(
             id=topic.id,
             label=topic.label,
             keyphrases=list(topic.keyphrases),
@@ -825,6 +3968,9 @@ async def load_canvas(canvas_id: str):
             summary=topic.summary,
             last_updated=topic.last_updated
         )
+        for topic in canvas.topics.values()
+    ])
+    await session.notify()
     
     # Return positions (if any) so frontend can reuse layout
     positions = canvas.positions if isinstance(canvas.positions, dict) else {}
@@ -832,84 +3978,178 @@ async def load_canvas(canvas_id: str):
     return {"ok": True, "loaded": canvas_id, "positions": positions}
 
 @app.post("/demo/process")
-async def demo_process(request: dict):
+async def demo_process(request: Request):
     """演示模式：处理单句文本"""
-    text = request.get("text", "").strip()
+    try:
+        body = await request.json()
+    except Exception:
+        body = {}
+    text = str(body.get("text", "") if isinstance(body, dict) else "").strip()
     if not text:
         return {"error": "Empty text"}
     
-    try:
-        # 记录旧的话题状态
-        old_topic_ids = set(store.topics.keys())
-        old_topics_snapshot = {
-            tid: len(t.points) for tid, t in store.topics.items()
-        }
-        
-        # 处理文本
-        await graph.ainvoke({"utterance": text})
-        
-        # 检测变化
-        new_topic_ids = set(store.topics.keys())
-        new_topics = list(new_topic_ids - old_topic_ids)
-        updated_topics = [
-            tid for tid in old_topic_ids
-            if tid in store.topics and len(store.topics[tid].points) > old_topics_snapshot.get(tid, 0)
-        ]
-        
-        # 返回结果
-        env = TopicsEnvelope(topics=store.as_payload(MAX_POINTS_PER_TOPIC))
-        result = json.loads(env.model_dump_json())
-        result["new_topics"] = new_topics
-        result["updated_topics"] = updated_topics
-        return result
-    except Exception as e:
-        print(f"[demo] error: {e}")
-        return {"error": str(e)}
+    session = await request_session(request)
+    with session.hold():  # 跨越 LLM 调用期间不被淘汰
+        store = session.store
+        try:
+            # 记录旧的话题状态
+            old_topic_ids = set(store.topics.keys())
+            old_topics_snapshot = {
+                tid: len(t.points) for tid, t in store.topics.items()
+            }
+            
+            # 处理文本；演示接口没有推送通道，直接等本话题的压缩结果
+            out = await get_graph().ainvoke({"utterance": text, "session": session.id})
+            await session.compressor.flush([out["topic_id"]] if out.get("topic_id") else None)
+            await session.notify(out.get("topic_id"))
+            
+            # 检测变化
+            new_topic_ids = set(store.topics.keys())
+            new_topics = list(new_topic_ids - old_topic_ids)
+            updated_topics = [
+                tid for tid in old_topic_ids
+                if tid in store.topics and len(store.topics[tid].points) > old_topics_snapshot.get(tid, 0)
+            ]
+            
+            # 返回结果
+            result = json.loads(store.payload_json(MAX_POINTS_PER_TOPIC))
+            result["new_topics"] = new_topics
+            result["updated_topics"] = updated_topics
+            return result
+        except Exception as e:
+            print(f"[demo] error: {e}")
+            return {"error": str(e)}
 
 @app.websocket("/ws")
 async def ws_endpoint(ws: WebSocket):
     await ws.accept()
-    print("[ws] client connected")
+    session = await sessions.acquire(ws.query_params.get("session"))
+    session.connections += 1
+    print(f"[ws] client connected to session {session.id} ({session.connections} connections)")
+    loop = asyncio.get_running_loop()
+    
+    # 解码线程切出的语音段 → 会话级有界队列 → 本协程按顺序提交给 ASR 调度器
+    segments = SegmentQueue()
+    busy = False
     
-    async def process_audio_chunk(data: bytes):
-        """异步处理单个音频块：ASR + LLM"""
+    async def send_busy(env: BusyEnvelope):
         try:
-            # 1) ASR 转写（在线程池中执行，避免阻塞事件循环）
-            loop = asyncio.get_event_loop()
-            text = await loop.run_in_executor(None, transcribe_chunk, data)
-            
-            print(f"[asr] text: {text[:80] if text else '(empty)'}")
-            
-            if text:
-                # 2) 立即回传转写结果（前端字幕）
-                await ws.send_text(TranscriptEnvelope(text=text).model_dump_json())
-                
-                # 3) 后台异步处理 LLM
-                async def run_llm_and_push(t: str):
-                    t0 = time.time()
-                    try:
-                        await graph.ainvoke({"utterance": t})
-                        print(f"[llm] graph done in {time.time()-t0:.2f}s")
-                        env = TopicsEnvelope(topics=store.as_payload(MAX_POINTS_PER_TOPIC))
-                        await ws.send_text(env.model_dump_json())
-                    except Exception as e:
-                        print(f"[llm] error: {e}")
-                
-                asyncio.create_task(run_llm_and_push(text))
-        except Exception as e:
-            print(f"[process_audio] error: {e}")
+            await ws.send_text(env.model_dump_json())
+        except Exception:
+            pass
+    
+    def set_busy(flag: bool):
+        """繁忙状态变化时通知客户端"""
+        nonlocal busy
+        if flag != busy:
+            busy = flag
+            print(f"[asr] session {'saturated' if flag else 'recovered'} (dropped {segments.dropped})")
+            asyncio.create_task(send_busy(BusyEnvelope(busy=flag, dropped=segments.dropped)))
+    
+    def push_segment(seg: np.ndarray):
+        ok = segments.put(seg)
+        if not ok or asr_scheduler.saturated:
+            set_busy(True)
+    
+    gate = VoiceGate()
+    asr_state = AsrSessionState()
+    
+    def on_segment(seg: np.ndarray):
+        # 在解码线程内完成门限判断，静音段不进入 ASR 队列
+        if gate.admit(seg):
+            loop.call_soon_threadsafe(push_segment, seg)
+    
+    stream = AudioStream(on_segment=on_segment)
+    
+    # 话题推送：只发增量（topics_patch），客户端版本断档时发 {"event":"resync"} 取全量
+    topic_sync = TopicSync(session.store)
+    push_lock = asyncio.Lock()
     
+    async def push_topics(_tid: Optional[str] = None, full: bool = False):
+        async with push_lock:  # 计算与发送保持同序，版本基线才连续
+            msg = topic_sync.full() if full else topic_sync.patch()
+            if msg is not None:
+                await ws.send_text(msg)
+    
+    # 转写结果进入会话的有序流水线；执行应用后与后台压缩完成后（标签/总结/关键词更新）都推送增量
+    session.subscribe(push_topics)
+    
+    async def transcribe_segments():
+        """逐段转写：同一会话同时只有一段在 ASR 中，转写结果立即回传，LLM 后台处理"""
+        while True:
+            seg = await segments.get()
+            try:
+                t0 = time.time()
+                result = await asr_scheduler.transcribe(seg, asr_state.language, asr_state.prompt)
+                text = asr_state.accept(result)
+                print(f"[asr] {len(seg) / ASR_SAMPLE_RATE:.1f}s segment in {time.time()-t0:.2f}s: {text[:80] if text else '(empty)'}")
+                if text:
+                    await ws.send_text(TranscriptEnvelope(text=text).model_dump_json())
+                    session.pipeline.submit(text)
+            except Exception as e:
+                print(f"[asr] transcription error: {e}")
+            if busy and len(segments) <= segments.maxsize // 2 and not asr_scheduler.saturated:
+                set_busy(False)
+    
+    async def emit_partials():
+        """流式字幕：定期重解码未结束的语音段，按局部一致策略提交稳定前缀（不进入 LLM）"""
+        agreement, seg_index, last_size = LocalAgreement(), None, 0
+        while True:
+            await asyncio.sleep(STREAM_PARTIAL_INTERVAL_S)
+            snap = stream.open_segment()
+            if snap is None:
+                continue
+            index, audio = snap
+            if index != seg_index:
+                agreement, seg_index, last_size = LocalAgreement(), index, 0
+            # 音频没有增长，或 ASR 有积压时让位给最终结果
+            if audio.size <= last_size or busy or len(segments) or asr_scheduler.saturated:
+                continue
+            last_size = audio.size
+            try:
+                result = await asr_scheduler.transcribe(audio, asr_state.language, asr_state.prompt)
+                text = strip_seam_overlap(asr_state.tail, result.text)
+            except Exception as e:
+                print(f"[asr] partial error: {e}")
+                continue
+            cur = stream.open_segment()
+            if not text or cur is None or cur[0] != index:
+                continue  # 该段已结束，以最终结果为准
+            committed, tentative = agreement.update(text)
+            await ws.send_text(PartialTranscriptEnvelope(committed=committed, tentative=tentative).model_dump_json())
+    
+    asr_task = asyncio.create_task(transcribe_segments())
+    partial_task = asyncio.create_task(emit_partials()) if STREAM_PARTIALS else None
     try:
         while True:
-            # 接收音频数据（每10秒一个音频块）
-            data = await ws.receive_bytes()
-            print(f"[ws] received bytes: {len(data)}")
-            
-            # 后台异步处理，不阻塞接收下一个音频块
-            asyncio.create_task(process_audio_chunk(data))
-            
+            # 连续 WebM 流：首帧带头部，后续为小帧；文本消息为控制指令
+            msg = await ws.receive()
+            if msg["type"] == "websocket.disconnect":
+                break
+            if msg.get("bytes"):
+                stream.feed(msg["bytes"])
+            elif msg.get("text"):
+                try:
+                    ctrl = json.loads(msg["text"])
+                except Exception:
+                    continue
+                if ctrl.get("event") == "stream_end":
+                    # 录音停止：结束当前流，切出最后一段
+                    await loop.run_in_executor(None, stream.close)
+                elif ctrl.get("event") == "resync":
+                    await push_topics(full=True)
     except WebSocketDisconnect:
-        print("[ws] disconnected")
+        pass
+    finally:
+        print(f"[ws] disconnected; vad skipped {gate.stats['skipped']}/{gate.stats['segments']} segments "
+              f"({gate.stats['skipped_seconds']:.1f}s of {gate.stats['seconds']:.1f}s)")
+        session.unsubscribe(push_topics)
+        session.connections -= 1
+        session.last_active = time.time()
+        asr_task.cancel()
+        if partial_task is not None:
+            partial_task.cancel()
+        await loop.run_in_executor(None, stream.close)
 
 # 专用演示入口，仅在用户直接访问 /demo 时暴露
 @app.get("/demo", include_in_schema=False)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark: in-memory PyAV decode vs ffmpeg subprocess decode
+Compares per-chunk latency and Python-side allocations of the two ASR decode paths.
+
+Usage:
+    python bench_decode.py                 # synthesize a 10 s WebM/Opus chunk
+    python bench_decode.py chunk.webm 50   # use a recorded chunk, 50 iterations
+"""
+
+import io
+import sys
+import time
+import statistics
+import tracemalloc
+
+import numpy as np
+
+from app import decode_webm_pcm, ffmpeg_decode_pcm
+
+
+def synth_webm(seconds: float = 10.0, sample_rate: int = 48000) -> bytes:
+    """Encode a tone+noise signal as WebM/Opus, like one MediaRecorder blob"""
+    import av
+    buf = io.BytesIO()
+    out = av.open(buf, "w", format="webm")
+    stream = out.add_stream("libopus", rate=sample_rate)
+    stream.layout = "mono"
+    t = np.arange(int(sample_rate * seconds)) / sample_rate
+    rng = np.random.default_rng(0)
+    sig = (0.3 * np.sin(2 * np.pi * 220 * t) + 0.02 * rng.standard_normal(t.size)).astype(np.float32)
+    frame_size = 960  # 20 ms
+    for i in range(0, sig.size, frame_size):
+        frame = av.AudioFrame.from_ndarray(sig[i:i + frame_size].reshape(1, -1), format="flt", layout="mono")
+        frame.sample_rate = sample_rate
+        frame.pts = i
+        for packet in stream.encode(frame):
+            out.mux(packet)
+    for packet in stream.encode(None):
+        out.mux(packet)
+    out.close()
+    return buf.getvalue()
+
+
+def measure(fn, data: bytes, iterations: int):
+    """Return (latencies in ms, peak traced allocation in bytes, output samples)"""
+    fn(data)  # warm-up
+    latencies = []
+    for _ in range(iterations):
+        t0 = time.perf_counter()
+        pcm = fn(data)
+        latencies.append((time.perf_counter() - t0) * 1000)
+    # tracemalloc slows Python code down, so allocations are measured in a separate pass
+    tracemalloc.start()
+    fn(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return latencies, peak, pcm.size
+
+
+def report(name: str, latencies, peak: int, samples: int):
+    lat = sorted(latencies)
+    p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+    print(f"{name:<8} mean {statistics.mean(lat):7.2f} ms | median {statistics.median(lat):7.2f} ms | "
+          f"p95 {p95:7.2f} ms | peak alloc {peak / 1024:8.1f} KiB | samples {samples}")
+
+
+def main():
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], "rb") as f:
+            data = f.read()
+    else:
+        data = synth_webm()
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    print("=" * 80)
+    print(f"🎧 Decode benchmark: {len(data)} bytes WebM, {iterations} iterations")
+    print("=" * 80)
+
+    lat, peak, samples = measure(decode_webm_pcm, data, iterations)
+    report("pyav", lat, peak, samples)
+    try:
+        lat, peak, samples = measure(ffmpeg_decode_pcm, data, iterations)
+        report("ffmpeg", lat, peak, samples)
+        print("(ffmpeg peak alloc covers this process only; the forked ffmpeg and temp files are extra)")
+    except Exception as e:
+        print(f"ffmpeg   unavailable: {e}")
+
+
+if __name__ == "__main__":
+    main()
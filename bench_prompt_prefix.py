@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark: prompt-prefix reuse in Ollama
+Replays TEST_SENTENCES through the router prompt in two layouts and compares prefill cost
+(prompt_eval_count / prompt_eval_duration reported by Ollama):
+  legacy  - Snapshot(existing_topics) before the static rule block (old router_prompt)
+  prefix  - static rule block first, snapshot + utterance last (current router_prompt)
+
+Usage:
+    python bench_prompt_prefix.py          # requires a running Ollama (OLLAMA_URL / OLLAMA_MODEL)
+    python bench_prompt_prefix.py 3        # repeat the sentence list 3 times
+"""
+
+import sys
+import json
+import statistics
+
+import httpx
+
+from app import OLLAMA_URL, ROUTER_INSTRUCTIONS, router_prompt, llm
+from test_classification import TEST_SENTENCES
+
+
+def legacy_router_prompt(utter: str, snapshot: str) -> str:
+    """Old layout: volatile snapshot and utterance ahead of the rules"""
+    head, rules = ROUTER_INSTRUCTIONS.split("\nRULES:", 1)
+    return f"""{head}
+Snapshot(existing_topics): {snapshot}
+
+Utterance: \"\"\"{utter}\"\"\"
+
+RULES:{rules}"""
+
+
+def synthetic_snapshots(sentences):
+    """Grow a fake topic snapshot the way the router sees it: one new point per utterance"""
+    topics = []
+    for i, s in enumerate(sentences):
+        if i % 5 == 0:
+            topics.insert(0, {"id": f"t{i}", "label": f"Topic {i // 5 + 1}", "summary": "",
+                              "keyphrases": [], "recent_points": []})
+        topics[0]["recent_points"] = (topics[0]["recent_points"] + [s[:60]])[-3:]
+        yield s, json.dumps(topics, ensure_ascii=False)
+
+
+def run(client: httpx.Client, build, sentences):
+    """Prefill only (num_predict=1); returns per-call (prompt tokens evaluated, prefill ms)"""
+    client.post("/api/generate", json=llm._body(build("", "[]"), 0.0, 1, stream=False)).raise_for_status()  # warm-up
+    rows = []
+    for utter, snap in synthetic_snapshots(sentences):
+        r = client.post("/api/generate", json=llm._body(build(utter, snap), 0.0, 1, stream=False))
+        r.raise_for_status()
+        data = r.json()
+        rows.append((data.get("prompt_eval_count", 0) or 0, (data.get("prompt_eval_duration", 0) or 0) / 1e6))
+    return rows
+
+
+def report(name: str, rows):
+    tokens = [t for t, _ in rows]
+    ms = [d for _, d in rows]
+    print(f"{name:<7} calls {len(rows):3d} | prompt tokens evaluated: mean {statistics.mean(tokens):7.1f} | "
+          f"prefill mean {statistics.mean(ms):8.1f} ms | median {statistics.median(ms):8.1f} ms | total {sum(ms):9.1f} ms")
+    return sum(ms), sum(tokens)
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    sentences = TEST_SENTENCES * repeat
+
+    print("=" * 80)
+    print(f"🧠 Prompt-prefix benchmark: {llm.model} @ {OLLAMA_URL}, {len(sentences)} router calls per layout")
+    print("=" * 80)
+
+    with httpx.Client(base_url=OLLAMA_URL, timeout=120) as client:
+        legacy_ms, legacy_tok = report("legacy", run(client, legacy_router_prompt, sentences))
+        prefix_ms, prefix_tok = report("prefix", run(client, router_prompt, sentences))
+
+    if legacy_ms > 0:
+        print(f"\nprefill time saved: {legacy_ms - prefix_ms:.1f} ms ({(1 - prefix_ms / legacy_ms) * 100:.1f}%), "
+              f"prompt tokens re-evaluated: {legacy_tok} → {prefix_tok}")
+
+
+if __name__ == "__main__":
+    main()
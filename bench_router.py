@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Report: embedding fast-path router vs LLM router
+Runs TEST_SENTENCES through the graph with the LLM router deciding every utterance, while the
+embedding index scores each utterance in shadow mode. For each (min_sim, margin) pair it reports:
+  hit    - fast path would have answered (no LLM call)
+  miss   - ambiguous, falls back to the LLM router
+  agree  - hit that appends to the same topic the LLM chose
+
+Usage:
+    python bench_router.py                                  # thresholds from env (ROUTER_EMBED_*)
+    python bench_router.py --min-sim 0.6 0.65 0.7 --margin 0.05 0.08 0.12
+"""
+
+import argparse
+import asyncio
+
+from app import get_graph, store, topic_index, OLLAMA_EMBED_MODEL
+from test_classification import TEST_SENTENCES
+
+
+async def collect():
+    """Return one row per sentence: (ranked embedding scores, LLM target topic id or None for create)"""
+    graph = get_graph()
+    store.clear()
+    topic_index.fast_path = False  # keep indexing after exec, but let the LLM decide
+    rows = []
+    for i, sentence in enumerate(TEST_SENTENCES, 1):
+        before = set(store.topics)
+        ranked = await topic_index.score(sentence, store.topics)
+        result = await graph.ainvoke({"utterance": sentence})
+        await topic_index.settle()  # centroids refresh in the background after exec
+        target = result.get("topic_id") if result.get("topic_id") in before else None
+        rows.append((ranked, target))
+        best = f"{ranked[0][0]} {ranked[0][1]:.3f}" if ranked else "-"
+        print(f"{i:2d}. llm → {target or 'NEW':<8} | embed best {best:<16} | {sentence[:50]}")
+    return rows
+
+
+def evaluate(rows, min_sim: float, margin: float):
+    topic_index.min_sim, topic_index.margin = min_sim, margin
+    hits = agree = 0
+    for ranked, target in rows:
+        tid = topic_index.decide(ranked)
+        if tid is not None:
+            hits += 1
+            agree += tid == target
+    return hits, len(rows) - hits, agree
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--min-sim", type=float, nargs="+", default=[topic_index.min_sim])
+    parser.add_argument("--margin", type=float, nargs="+", default=[topic_index.margin])
+    args = parser.parse_args()
+
+    print("=" * 80)
+    print(f"🧭 Router report: embed={OLLAMA_EMBED_MODEL}, {len(TEST_SENTENCES)} sentences")
+    print("=" * 80)
+    rows = asyncio.run(collect())
+
+    print(f"\n{'min_sim':>7} {'margin':>7} | {'hit':>4} {'miss':>4} {'agree':>5} | {'hit rate':>8} {'agreement':>9}")
+    for min_sim in args.min_sim:
+        for margin in args.margin:
+            hits, misses, agree = evaluate(rows, min_sim, margin)
+            rate = hits / len(rows) if rows else 0.0
+            agreement = f"{agree / hits:9.0%}" if hits else f"{'-':>9}"
+            print(f"{min_sim:7.2f} {margin:7.2f} | {hits:4d} {misses:4d} {agree:5d} | {rate:8.0%} {agreement}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,35 @@
 // -*- coding: utf-8 -*-
-// 无打包 React 前端：录音 5s 切片 -> WebSocket -> 显示 Circles 与摘要
+// 无打包 React 前端：连续录音（小帧流式发送）-> WebSocket -> 显示 Circles 与摘要
 
 const { useEffect, useRef, useState, useMemo } = React
 
+// 会话（房间）id：URL ?session= 优先，否则沿用本标签页的 id，再否则随机生成；话题存储按会话隔离
+const SESSION_ID = (() => {
+  const fromUrl = new URLSearchParams(window.location.search).get('session')
+  const id = fromUrl || sessionStorage.getItem('ripple-session') || Math.random().toString(36).slice(2, 10)
+  sessionStorage.setItem('ripple-session', id)
+  return id
+})()
+
+// 作用于当前会话的请求带上 X-Session-Id
+const sessionFetch = (url, options = {}) =>
+  fetch(url, { ...options, headers: { ...(options.headers || {}), 'X-Session-Id': SESSION_ID } })
+
 function App() {
   const [ws, setWs] = useState(null)
   const [recording, setRecording] = useState(false)
   const mediaRef = useRef(null)
   const recRef = useRef(null)
-  const timerRef = useRef(null)
+  const sendChainRef = useRef(Promise.resolve())
 
   const [topics, setTopics] = useState([])
+  // 服务端话题版本：topics_patch 的 base_version 必须与之一致，否则请求全量 resync
+  const topicsVersionRef = useRef(0)
+  const resyncPendingRef = useRef(false)
   const [activeId, setActiveId] = useState(null)
   const [liveText, setLiveText] = useState('')
+  const [serverBusy, setServerBusy] = useState(false)
+  const [caption, setCaption] = useState({ committed: '', tentative: '' })
   const [demoRunning, setDemoRunning] = useState(false)
   const [newTopicIds, setNewTopicIds] = useState([])
   const [updatedTopicIds, setUpdatedTopicIds] = useState([])
@@ -25,6 +42,8 @@ function App() {
   const [historyOpen, setHistoryOpen] = useState(false)
   const [historyList, setHistoryList] = useState([])
   const [loadingHistory, setLoadingHistory] = useState(false)
+  const [historyCursor, setHistoryCursor] = useState(null)
+  const [loadingMoreHistory, setLoadingMoreHistory] = useState(false)
   
   // Ripple 位置状态
   const [ripplePositions, setRipplePositions] = useState({})
@@ -143,19 +162,33 @@ function App() {
     return payload
   }
 
+  // 上次保存到后端的每个节点位置（序列化后比较），保存时只发送移动过的节点
+  const savedPositionsRef = useRef({})
+
   const savePositionsToBackend = async () => {
     if (!currentCanvasId) return
     try {
-      const payload = { positions: buildPositionsPayload() }
+      const positions = buildPositionsPayload()
+      const saved = savedPositionsRef.current
+      const moved = {}
+      Object.keys(positions).forEach(id => {
+        const serialized = JSON.stringify(positions[id])
+        if (saved[id] !== serialized) moved[id] = positions[id]
+      })
+      const removed = Object.keys(saved).filter(id => !(id in positions))
+      if (Object.keys(moved).length === 0 && removed.length === 0) return
       const resp = await fetch(`/canvas/${currentCanvasId}/positions`, {
         method: 'PATCH',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(payload)
+        body: JSON.stringify({ moved, removed })
       })
       const data = await resp.json()
       if (data.ok) {
+        const nextSaved = {}
+        Object.keys(positions).forEach(id => { nextSaved[id] = JSON.stringify(positions[id]) })
+        savedPositionsRef.current = nextSaved
         const nextHistory = historyList.map(item =>
-          item.id === currentCanvasId ? { ...item, positions: payload.positions } : item
+          item.id === currentCanvasId ? { ...item, positions } : item
         )
         setHistoryList(nextHistory)
         saveHistoryCache(nextHistory)
@@ -387,6 +420,9 @@ const TOPIC_COLORS = [
   'rgba(255, 255, 255, 0.5)'
 ]
 
+// 录音帧长度：越小首字延迟越低，服务端负责按停顿切段
+const STREAM_TIMESLICE_MS = 250
+
 // Layout paddings - ripples can appear anywhere on the page
 const RIPPLE_LEFT_PADDING = 0
 const RIPPLE_RIGHT_PADDING = 0
@@ -771,16 +807,41 @@ const buildDynamicGradientSnapshot = (time = 0) => {
 
   const connect = () => {
     const proto = location.protocol === 'https:' ? 'wss:' : 'ws:'
-    const sock = new WebSocket(`${proto}//${location.host}/ws`)
+    const sock = new WebSocket(`${proto}//${location.host}/ws?session=${encodeURIComponent(SESSION_ID)}`)
     sock.onmessage = (ev) => {
       try {
         const data = JSON.parse(ev.data)
         if (data.event === 'transcript') {
           console.log('[ui] transcript:', data.text)
           setLiveText(data.text)
+          setCaption({ committed: data.text, tentative: '' })
+        } else if (data.event === 'partial') {
+          // 中间字幕：committed 不会再变，tentative 可能被下一次结果改写
+          setCaption({ committed: data.committed || '', tentative: data.tentative || '' })
         } else if (data.event === 'topics') {
           console.log('[ui] topics update:', data.topics?.length, 'topics')
           setTopics(data.topics || [])
+          topicsVersionRef.current = data.version || 0
+          resyncPendingRef.current = false
+        } else if (data.event === 'topics_patch') {
+          if (resyncPendingRef.current) return
+          if (data.base_version !== topicsVersionRef.current) {
+            // 版本断档（漏掉了中间的增量）：丢弃本地增量，取一次全量
+            console.warn('[ws] topics gap:', topicsVersionRef.current, '->', data.base_version, ', resyncing')
+            resyncPendingRef.current = true
+            sock.send(JSON.stringify({ event: 'resync' }))
+            return
+          }
+          topicsVersionRef.current = data.version
+          const removed = new Set(data.removed || [])
+          const upserts = data.upserts || []
+          const upsertIds = new Set(upserts.map(t => t.id))
+          // 变更的话题是最近更新的，放在最前面；其余保持原顺序
+          setTopics(prev => upserts.concat(prev.filter(t => !upsertIds.has(t.id) && !removed.has(t.id))))
+        } else if (data.event === 'busy') {
+          // 服务端 ASR 饱和：积压的语音段会被丢弃/合并
+          console.warn('[ws] server busy:', data.busy, 'dropped:', data.dropped)
+          setServerBusy(data.busy !== false)
         }
       } catch (e) {}
     }
@@ -861,55 +922,36 @@ const buildDynamicGradientSnapshot = (time = 0) => {
 
       const opts = pickType()
       
-      // 创建录音循环函数：定时停止并重启，确保每个切片都有完整的 WebM 头部
-      const startRecordingCycle = () => {
-        if (!mediaRef.current) return
-        
-        const rec = new MediaRecorder(mediaRef.current, opts)
-        
-        rec.ondataavailable = e => {
-          console.log('[recorder] blob size:', e.data?.size, 'type:', e.data?.type, 'ws state:', ws?.readyState)
-          if (ws && ws.readyState === 1 && e.data && e.data.size > 0) {
-            // 检查数据大小
-            if (e.data.size < 1000) {
-              console.warn('[recorder] data too small, skipping:', e.data.size)
-              return
-            }
-            e.data.arrayBuffer().then(buf => {
-              console.log('[recorder] sending', buf.byteLength, 'bytes')
-              ws.send(buf)
-            })
-          } else {
-            console.warn('[recorder] cannot send: ws not ready or no data')
-          }
-        }
-        
-        rec.onerror = (ev) => console.error('[recorder] error:', ev.error)
-        
-        rec.onstop = () => {
-          console.log('[recorder] chunk completed, restarting...')
-          // 如果还在录音状态，立即开始下一个循环
-          if (recRef.current) {
-            startRecordingCycle()
-          }
-        }
-        
-        // 不使用 timeslice，直接 start()，然后 10 秒后手动 stop
-        rec.start()
-        recRef.current = rec
-        
-        // 10 秒后停止（会触发 onstop，然后自动重启）
-        timerRef.current = setTimeout(() => {
-          if (rec.state === 'recording') {
-            rec.stop()
-          }
-        }, 10000)
+      // 连续录音：timeslice 切成小帧持续发送，服务端长连接解码并按停顿自动分段
+      // 只有第一帧带 WebM 头部，因此发送必须保持顺序
+      const rec = new MediaRecorder(stream, opts)
+      sendChainRef.current = Promise.resolve()
+      
+      rec.ondataavailable = e => {
+        if (!e.data || e.data.size === 0) return
+        const blob = e.data
+        sendChainRef.current = sendChainRef.current
+          .then(() => blob.arrayBuffer())
+          .then(buf => {
+            if (ws && ws.readyState === 1) ws.send(buf)
+            else console.warn('[recorder] cannot send: ws not ready')
+          })
       }
       
-      // 开始第一个录音循环
-      startRecordingCycle()
+      rec.onerror = (ev) => console.error('[recorder] error:', ev.error)
+      
+      rec.onstop = () => {
+        // 通知服务端流结束，让它切出最后一段
+        sendChainRef.current = sendChainRef.current.then(() => {
+          if (ws && ws.readyState === 1) ws.send(JSON.stringify({ event: 'stream_end' }))
+        })
+        console.log('[recorder] stream ended')
+      }
+      
+      rec.start(STREAM_TIMESLICE_MS)
+      recRef.current = rec
       setRecording(true)
-      console.log('[recorder] started with 10s auto-restart cycle')
+      console.log(`[recorder] streaming with ${STREAM_TIMESLICE_MS}ms timeslice`)
       
     } catch (err) {
       console.error('[mic] getUserMedia failed:', err)
@@ -921,18 +963,15 @@ const buildDynamicGradientSnapshot = (time = 0) => {
     // 停止录音器
     if (recRef.current) {
       recRef.current.stop()
-      recRef.current = null  // 清空引用，防止 onstop 中自动重启
-    }
-    // 停止定时器
-    if (timerRef.current) {
-      clearTimeout(timerRef.current)
-      timerRef.current = null
+      recRef.current = null
     }
     // 停止媒体流
     mediaRef.current?.getTracks().forEach(t => t.stop())
     mediaRef.current = null
     
     setRecording(false)
+    setServerBusy(false)
+    setCaption({ committed: '', tentative: '' })
     setLiveText('')
     console.log('[recorder] stopped')
   }
@@ -943,7 +982,7 @@ const buildDynamicGradientSnapshot = (time = 0) => {
     if (recording) return
     
     try {
-      const response = await fetch('/canvas/new', {
+      const response = await sessionFetch('/canvas/new', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ positions: positionsRef.current || {} })
@@ -951,6 +990,7 @@ const buildDynamicGradientSnapshot = (time = 0) => {
       const data = await response.json()
       
       if (data.ok) {
+        savedPositionsRef.current = {}
         setCurrentCanvasId(data.canvas_id || null)
         // Clear current state
         setTopics([])
@@ -964,14 +1004,16 @@ const buildDynamicGradientSnapshot = (time = 0) => {
     }
   }
   
-  // Load history list
+  // Load history list (first page; older canvases via "Load more")
+  const HISTORY_FIELDS = 'id,title,summary,created_at,topic_count'
   const loadHistoryList = async () => {
     setLoadingHistory(true)
     try {
-      const response = await fetch('/canvas/history')
+      const response = await fetch(`/canvas/history?limit=30&fields=${HISTORY_FIELDS}`)
       const data = await response.json()
       const list = data.canvases || []
       setHistoryList(list)
+      setHistoryCursor(data.next_cursor || null)
       saveHistoryCache(list)
     } catch (err) {
       console.error('[canvas] Error loading history:', err)
@@ -981,6 +1023,25 @@ const buildDynamicGradientSnapshot = (time = 0) => {
     setLoadingHistory(false)
   }
   
+  const loadMoreHistory = async () => {
+    if (!historyCursor || loadingMoreHistory) return
+    setLoadingMoreHistory(true)
+    try {
+      const response = await fetch(`/canvas/history?limit=30&fields=${HISTORY_FIELDS}&cursor=${encodeURIComponent(historyCursor)}`)
+      const data = await response.json()
+      setHistoryList(prev => {
+        const seen = new Set(prev.map(item => item.id))
+        const next = prev.concat((data.canvases || []).filter(item => !seen.has(item.id)))
+        saveHistoryCache(next)
+        return next
+      })
+      setHistoryCursor(data.next_cursor || null)
+    } catch (err) {
+      console.error('[canvas] Error loading more history:', err)
+    }
+    setLoadingMoreHistory(false)
+  }
+  
   // Delete a canvas from history (state + local storage)
   const deleteHistoryItem = async (canvasId, event) => {
     if (event && event.stopPropagation) {
@@ -1014,12 +1075,12 @@ const buildDynamicGradientSnapshot = (time = 0) => {
   // Load a specific canvas from history
   const loadCanvas = async (canvasId) => {
     try {
-      const response = await fetch(`/canvas/load/${canvasId}`, { method: 'POST' })
+      const response = await sessionFetch(`/canvas/load/${canvasId}`, { method: 'POST' })
       const data = await response.json()
       
       if (data.ok) {
         // Fetch the updated topics
-        const topicsResponse = await fetch('/topics')
+        const topicsResponse = await sessionFetch('/topics')
         const topicsData = await topicsResponse.json()
         const loadedTopics = topicsData.topics || []
 
@@ -1053,6 +1114,9 @@ const buildDynamicGradientSnapshot = (time = 0) => {
         })
 
         positionsRef.current = nextPositionsRef
+        const nextSaved = {}
+        Object.keys(incomingPositions).forEach(id => { nextSaved[id] = JSON.stringify(incomingPositions[id]) })
+        savedPositionsRef.current = nextSaved
         setRipplePositions(rippleMap)
         setTopics(loadedTopics)
         setCurrentCanvasId(canvasId)
@@ -1078,7 +1142,7 @@ const buildDynamicGradientSnapshot = (time = 0) => {
     
     // 清空后端的话题数据
     try {
-      await fetch('/demo/clear', { method: 'POST' })
+      await sessionFetch('/demo/clear', { method: 'POST' })
     } catch (err) {
       console.error('[demo] clear error:', err)
     }
@@ -1095,7 +1159,7 @@ const buildDynamicGradientSnapshot = (time = 0) => {
       
       try {
         // 发送到后端处理
-        const response = await fetch('/demo/process', {
+        const response = await sessionFetch('/demo/process', {
           method: 'POST',
           headers: {'Content-Type': 'application/json'},
           body: JSON.stringify({text: sentence})
@@ -2144,7 +2208,14 @@ const buildDynamicGradientSnapshot = (time = 0) => {
                     `${canvas.topic_count} topics • ${new Date(canvas.created_at).toLocaleDateString()}`
                   )
                 )
-              )
+              ).concat(historyCursor ? [
+                React.createElement('button', {
+                  key: '__more',
+                  className: 'history-more-btn',
+                  disabled: loadingMoreHistory,
+                  onClick: loadMoreHistory
+                }, loadingMoreHistory ? 'Loading...' : 'Load more')
+              ] : [])
       )
     )
   )
@@ -2186,7 +2257,11 @@ const buildDynamicGradientSnapshot = (time = 0) => {
         )
       ),
       React.createElement('p', {className: 'recording-hint'},
-        recording ? 'Listening...' : 'Tap to start brainstorming'
+        recording ? (serverBusy ? 'Server busy, catching up...' : 'Listening...') : 'Tap to start brainstorming'
+      ),
+      recording && (caption.committed || caption.tentative) && React.createElement('p', {className: 'recording-caption'},
+        caption.committed,
+        React.createElement('span', {className: 'tentative'}, caption.tentative)
       )
     )
   )
@@ -8,7 +8,7 @@ import asyncio
 import sys
 
 # Import components
-from app import graph, store, MAX_POINTS_PER_TOPIC
+from app import graph, store, compressor, MAX_POINTS_PER_TOPIC
 
 # Test sentences (English, approx 20 words each)
 TEST_SENTENCES = [
@@ -35,7 +35,7 @@ async def test_classification():
     print("=" * 80)
     print(f"\n📝 Testing {len(TEST_SENTENCES)} sentences\n")
     
-    store.topics.clear()
+    store.clear()
     
     for i, sentence in enumerate(TEST_SENTENCES, 1):
         print(f"\n{'─' * 80}")
@@ -53,6 +53,9 @@ async def test_classification():
         except Exception as e:
             print(f"❌ Failed: {e}")
     
+    # 压缩在后台去抖执行，统计前先跑完所有待处理的话题
+    await compressor.flush()
+    
     print(f"\n{'=' * 80}")
     print("📊 Final Results")
     print("=" * 80)
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+"""单元测试只覆盖纯内存组件：不预加载模型，状态文件写到临时目录，不碰仓库里的画布库"""
+import os
+import sys
+import tempfile
+
+_TMP = tempfile.mkdtemp(prefix="ripplenote-tests-")
+os.environ.setdefault("PRELOAD_MODELS", "0")
+os.environ.setdefault("CANVAS_DB_PATH", os.path.join(_TMP, "canvas.sqlite3"))
+os.environ.setdefault("STATE_DB_PATH", os.path.join(_TMP, "state.sqlite3"))
+os.environ.setdefault("SESSION_SPILL_DIR", os.path.join(_TMP, "sessions"))
+os.environ.setdefault("LLM_CACHE_PATH", "")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import asyncio
+
+import numpy as np
+
+from app import LocalAgreement, SegmentQueue, strip_seam_overlap
+
+
+def test_local_agreement_commits_common_prefix_only():
+    la = LocalAgreement()
+    assert la.update("hello world") == ("", "hello world")
+    committed, tentative = la.update("hello world how are")
+    assert committed == "hello world" and tentative.strip() == "how are"
+    # 已提交部分不会被后来的改写推翻
+    committed, _ = la.update("yellow world how are you")
+    assert committed == "hello world"
+
+
+def test_strip_seam_overlap_drops_repeated_words():
+    assert strip_seam_overlap("we should book the", "book the flights") == "flights"
+    assert strip_seam_overlap("we should book", "nothing shared here") == "nothing shared here"
+
+
+def test_segment_queue_drop_oldest():
+    q = SegmentQueue(maxsize=2, policy="drop_oldest")
+    segs = [np.full(10, i, dtype=np.float32) for i in range(3)]
+    assert q.put(segs[0]) and q.put(segs[1])
+    assert not q.put(segs[2])
+    assert q.dropped == 1 and len(q) == 2
+    first = asyncio.run(q.get())
+    assert first[0] == 1
+
+
+def test_segment_queue_merge_keeps_audio():
+    q = SegmentQueue(maxsize=2, policy="merge", max_merge_samples=100)
+    for i in range(3):
+        q.put(np.full(10, i, dtype=np.float32))
+    assert len(q) == 2 and q.dropped == 1
+    merged = asyncio.run(q.get())
+    assert merged.size == 20 and merged[0] == 0 and merged[-1] == 1
+
+
+def test_segment_queue_merge_falls_back_to_drop_when_too_long():
+    q = SegmentQueue(maxsize=1, policy="merge", max_merge_samples=15)
+    q.put(np.zeros(10, dtype=np.float32))
+    q.put(np.ones(10, dtype=np.float32))
+    assert len(q) == 1
+    assert asyncio.run(q.get())[0] == 1
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import types
+
+import numpy as np
+
+from app import MemoryStore, NearDuplicateIndex, Topic, TopicSync, dedup_by_label, dedup_stem, dedup_store
+
+
+def make_topic(tid: str, label: str, keyphrases=(), points=(), last_updated: float = 0.0) -> Topic:
+    return Topic(id=tid, label=label, keyphrases=list(keyphrases), points=list(points), last_updated=last_updated)
+
+
+def test_stem_folds_simple_inflections():
+    assert dedup_stem("plans") == dedup_stem("planning") == dedup_stem("planned") == "plan"
+    assert dedup_stem("class") == "class"
+    assert dedup_stem("旅行") == "旅行"
+
+
+def test_index_matches_inflected_labels_but_not_unrelated_ones():
+    index = NearDuplicateIndex(min_sim=0.6)
+    for t in (make_topic("a", "Trip Planning"), make_topic("b", "Trip Plans"), make_topic("c", "Camera Gear")):
+        index.upsert(t)
+    assert [m[0] for m in index.matches("a")] == ["b"]
+    assert index.matches("c") == []
+
+
+def test_index_sync_follows_store_versions():
+    store = MemoryStore()
+    index = NearDuplicateIndex(min_sim=0.6)
+    store.add(make_topic("a", "Trip Planning"))
+    store.add(make_topic("b", "Camera Gear"))
+    index.sync(store)
+    assert index.matches("a") == []
+    store.topics["b"].label = "Trip Plans"
+    store.touch("b")
+    index.sync(store)
+    assert [m[0] for m in index.matches("a")] == ["b"]
+    store.remove("b")
+    index.sync(store)
+    assert "b" not in index.features and index.matches("a") == []
+
+
+def test_embedding_neighbours_catch_synonymous_labels():
+    index = NearDuplicateIndex(min_sim=0.6, embed_min_sim=0.9)
+    index.upsert(make_topic("a", "Trip Plan"))
+    index.upsert(make_topic("b", "Travel Itinerary"))
+    index.upsert(make_topic("c", "Camera Gear"))
+    v = np.array([1.0, 0.0], dtype=np.float32)
+    embeddings = types.SimpleNamespace(centroids={
+        "a": v, "b": np.array([0.99, 0.141], dtype=np.float32), "c": np.array([0.0, 1.0], dtype=np.float32)})
+    assert index.matches("a") == []
+    assert [m[0] for m in index.matches("a", embeddings=embeddings)] == ["b"]
+
+
+def test_dedup_by_label_keeps_the_most_recent_topic():
+    store = MemoryStore()
+    store.add(make_topic("old", "Trip Plans", points=["book flights"], last_updated=1.0))
+    store.add(make_topic("new", "Trip Planning", points=["pack bags"], last_updated=2.0))
+    kept = dedup_by_label(store, "old")
+    assert kept == "new"
+    assert set(store.topics) == {"new"}
+    assert store.topics["new"].points == ["pack bags", "book flights"]
+    assert store.resolve("old") == "new"
+
+
+def test_dedup_store_patches_only_changed_topics_and_leaves_aliases():
+    store = MemoryStore()
+    store.add(make_topic("a", "Trip Plans", last_updated=1.0))
+    store.add(make_topic("b", "Trip Planning", last_updated=2.0))
+    store.add(make_topic("c", "Camera Gear", last_updated=3.0))
+    sync = TopicSync(store)
+    sync.mark()
+    res = dedup_store(store)
+    assert res["merged"] == 1
+    assert [(p["keep"], p["drop"]) for p in res["pairs"]] == [("b", "a")]
+    upserts, removed = sync.changes()
+    assert [t.id for t in upserts] == ["b"] and removed == ["a"]  # c 没变：不进增量
+    assert store.resolve("a") == "b"
+
+
+def test_dedup_store_dry_run_leaves_store_untouched():
+    store = MemoryStore()
+    store.add(make_topic("a", "Trip Plans", last_updated=1.0))
+    store.add(make_topic("b", "Trip Planning", last_updated=2.0))
+    version = store.version
+    res = dedup_store(store, dry_run=True)
+    assert res["merged"] == 0 and len(res["pairs"]) == 1
+    assert store.version == version and set(store.topics) == {"a", "b"}
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import json
+
+import httpx
+import pytest
+
+from app import CircuitBreaker, JsonObjectScanner, LLMCache, LLMStreamError, LLMUnavailable, OllamaClient
+
+
+# ---------------------
+# CircuitBreaker：半开状态只放行一次探测
+# ---------------------
+def test_breaker_opens_after_max_failures():
+    breaker = CircuitBreaker(max_failures=2, cooldown_s=60)
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.allow()
+
+
+def test_half_open_allows_a_single_probe():
+    breaker = CircuitBreaker(max_failures=1, cooldown_s=0)
+    breaker.record_failure()
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_release_probe_reopens_instead_of_sticking_half_open():
+    breaker = CircuitBreaker(max_failures=1, cooldown_s=0)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.release_probe()  # 探测被取消 / 非瞬时错误
+    assert breaker.allow()   # 下一次冷却后可以再探测
+
+
+def test_release_probe_is_a_noop_without_a_probe():
+    breaker = CircuitBreaker(max_failures=1, cooldown_s=60)
+    breaker.release_probe()
+    assert breaker.failures == 0 and breaker.state == "closed"
+
+
+# ---------------------
+# JsonObjectScanner
+# ---------------------
+def test_scanner_closes_on_first_top_level_object_across_chunks():
+    scanner = JsonObjectScanner()
+    assert scanner.feed('Sure: {"a": "}{", ') is None
+    assert scanner.feed('"b": {"c": "\\"x"}') is None
+    assert scanner.feed('} trailing {"d": 1}') == '{"a": "}{", "b": {"c": "\\"x"}}'
+    assert json.loads(scanner.result)["b"]["c"] == '"x'
+
+
+# ---------------------
+# OllamaClient：流式 NDJSON
+# ---------------------
+def run_stream(lines, retries: int = 0):
+    async def handler(request):
+        return httpx.Response(200, content="".join(lines).encode("utf-8"))
+    client = OllamaClient(base_url="http://ollama", retries=retries)
+    client.cache = LLMCache(max_entries=0, path="")
+
+    async def main():
+        client._client = httpx.AsyncClient(base_url="http://ollama", transport=httpx.MockTransport(handler))
+        client._sem = asyncio.Semaphore(1)
+        try:
+            return await client.generate_json("prompt", cache=False)
+        finally:
+            await client._client.aclose()
+    return client, main
+
+
+def test_stream_skips_undecodable_lines():
+    client, main = run_stream([
+        json.dumps({"response": '{"label": '}) + "\n",
+        '{"response": "trunc\n',
+        "[1, 2]\n",
+        json.dumps({"response": '"Travel"}', "done": True}) + "\n",
+    ])
+    assert asyncio.run(main()) == {"label": "Travel"}
+    assert client.stats["bad_lines"] == 2
+
+
+def test_stream_error_chunk_counts_as_breaker_failure():
+    client, main = run_stream([json.dumps({"error": "model runner has unexpectedly stopped"}) + "\n"])
+    client.breaker = CircuitBreaker(max_failures=1, cooldown_s=60)
+    with pytest.raises(LLMStreamError):
+        asyncio.run(main())
+    assert client.breaker.state == "open"
+    with pytest.raises(LLMUnavailable):
+        asyncio.run(main())
+
+
+# ---------------------
+# LLMCache：后台批量写入
+# ---------------------
+def test_cache_writes_are_deferred_and_reload(tmp_path):
+    path = str(tmp_path / "llm.jsonl")
+    cache = LLMCache(max_entries=3, path=path, flush_s=3600)
+    for i in range(2):
+        cache.put(f"k{i}", f"v{i}")
+    assert not (tmp_path / "llm.jsonl").exists()  # put 不碰文件
+    cache.close()
+    assert LLMCache(max_entries=3, path=path).get("k1") == "v1"
+
+
+def test_cache_compaction_rewrites_current_entries(tmp_path):
+    path = str(tmp_path / "llm.jsonl")
+    cache = LLMCache(max_entries=3, path=path, flush_s=3600)
+    for i in range(10):
+        cache.put(f"k{i}", f"v{i}")
+    cache.close()
+    lines = (tmp_path / "llm.jsonl").read_text(encoding="utf-8").splitlines()
+    assert len(lines) <= 2 * 3
+    reloaded = LLMCache(max_entries=3, path=path)
+    assert reloaded.get("k9") == "v9" and reloaded.get("k0") is None
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+import app
+from app import Canvas, CanvasStore, MemoryStore, StateBackend, SQLiteDatabase, Topic, TopicSync
+
+
+def make_topic(tid: str, label: str = "Topic", **kw) -> Topic:
+    return Topic(id=tid, label=label, **kw)
+
+
+# ---------------------
+# MemoryStore / TopicSync：增量推送的版本基线
+# ---------------------
+def test_changes_only_returns_topics_touched_since_last_push():
+    store = MemoryStore()
+    sync = TopicSync(store)
+    store.add(make_topic("a"))
+    store.add(make_topic("b"))
+    upserts, removed = sync.changes()
+    assert {t.id for t in upserts} == {"a", "b"} and removed == []
+
+    store.touch("a")
+    upserts, removed = sync.changes()
+    assert [t.id for t in upserts] == ["a"] and removed == []
+    assert sync.changes() == ([], [])
+
+
+def test_changes_reports_removed_topics_once():
+    store = MemoryStore()
+    sync = TopicSync(store)
+    store.add(make_topic("a"))
+    store.add(make_topic("b"))
+    sync.mark()
+    store.remove("a", alias_to="b")
+    assert sync.changes() == ([], ["a"])
+    assert sync.changes() == ([], [])
+    assert store.resolve("a") == "b"
+
+
+def test_mark_topics_keeps_other_pending_changes():
+    store = MemoryStore()
+    sync = TopicSync(store)
+    store.add(make_topic("a"))
+    store.add(make_topic("b"))
+    sync.mark()
+    store.touch("a")
+    store.touch("b")
+    # 另一个 worker 写入的 a 已经推送过：只把 a 记为已同步，b 的本地变更仍要推送
+    sync.mark_topics(["a"])
+    upserts, _ = sync.changes()
+    assert [t.id for t in upserts] == ["b"]
+
+
+def test_mark_topics_drops_removed_ids():
+    store = MemoryStore()
+    sync = TopicSync(store)
+    store.add(make_topic("a"))
+    sync.mark()
+    store.remove("a")
+    sync.mark_topics([], removed=["a"])
+    assert sync.changes() == ([], [])
+
+
+def test_patch_carries_base_version():
+    store = MemoryStore()
+    sync = TopicSync(store)
+    store.add(make_topic("a", "Travel"))
+    base = json.loads(sync.full())["version"]
+    store.touch("a")
+    patch = json.loads(sync.patch())
+    assert patch["base_version"] == base
+    assert patch["version"] == store.version
+    assert [t["id"] for t in patch["upserts"]] == ["a"]
+    assert sync.patch() is None
+
+
+def test_payload_json_tracks_in_place_edits_after_touch():
+    store = MemoryStore()
+    t = store.add(make_topic("a", "Travel"))
+    assert json.loads(store.payload_json())["topics"][0]["label"] == "Travel"
+    t.label = "Trip"
+    store.touch("a")
+    assert json.loads(store.payload_json())["topics"][0]["label"] == "Trip"
+
+
+# ---------------------
+# CanvasStore：游标分页与删除
+# ---------------------
+@pytest.fixture
+def canvas_store(tmp_path):
+    backend = StateBackend(SQLiteDatabase(str(tmp_path / "canvas.sqlite3"), app.CANVAS_SCHEMA), legacy_json="")
+    store = CanvasStore(backend, cache_size=2, flush_s=0)
+    yield store
+    store.close()
+    backend.close()
+
+
+def make_canvas(cid: str, created_at: str) -> Canvas:
+    return Canvas(id=cid, title=cid.upper(), summary="", created_at=created_at,
+                  topics={"t": make_topic("t", "Travel")}, positions={})
+
+
+def test_page_walks_newest_to_oldest_without_gaps(canvas_store):
+    # 同一时间戳的画布按 id 排序，游标必须能跨过并列项
+    for i in range(7):
+        canvas_store.add(make_canvas(f"c{i}", f"2024-01-0{1 + i // 2}T00:00:00"))
+    seen, cursor = [], None
+    while True:
+        items, cursor = canvas_store.page(3, cursor)
+        seen += [item["id"] for item in items]
+        if cursor is None:
+            break
+    assert seen == canvas_store.ids()
+    assert len(seen) == len(set(seen)) == 7
+
+
+def test_page_cursor_survives_deleting_the_cursor_row(canvas_store):
+    for i in range(5):
+        canvas_store.add(make_canvas(f"c{i}", f"2024-01-0{i + 1}T00:00:00"))
+    items, cursor = canvas_store.page(2)
+    assert [item["id"] for item in items] == ["c4", "c3"]
+    assert canvas_store.delete("c3")
+    items, cursor = canvas_store.page(2, cursor)
+    assert [item["id"] for item in items] == ["c2", "c1"]
+    items, cursor = canvas_store.page(2, cursor)
+    assert [item["id"] for item in items] == ["c0"] and cursor is None
+
+
+def test_delete_removes_canvas_from_index_cache_and_backend(canvas_store):
+    canvas_store.add(make_canvas("a", "2024-01-01T00:00:00"))
+    canvas_store.add(make_canvas("b", "2024-01-02T00:00:00"))
+    assert canvas_store.get_by_id("a") is not None
+    assert canvas_store.delete("a")
+    assert not canvas_store.delete("a")
+    assert canvas_store.get_by_id("a") is None
+    assert canvas_store.ids() == ["b"]
+    assert [s["id"] for s in canvas_store.backend.canvas_summaries()] == ["b"]
+
+
+def test_reads_fall_back_to_backend_after_cache_eviction(canvas_store):
+    for i in range(3):
+        canvas_store.add(make_canvas(f"c{i}", f"2024-01-0{i + 1}T00:00:00"))
+    assert "c0" not in canvas_store._cache  # cache_size=2
+    canvas = canvas_store.get_by_id("c0")
+    assert canvas is not None and canvas.topics["t"].label == "Travel"
+
+
+def test_apply_remote_prefers_local_pending_changes(tmp_path):
+    backend = StateBackend(SQLiteDatabase(str(tmp_path / "canvas.sqlite3"), app.CANVAS_SCHEMA), legacy_json="")
+    store = CanvasStore(backend, flush_s=3600)
+    try:
+        store.add(make_canvas("local", "2024-01-01T00:00:00"))
+        # 另一个 worker 删掉了 local、新增了 remote；local 还有未写入的变更，以本地为准
+        remote = {"id": "remote", "title": "R", "summary": "", "created_at": "2024-01-02T00:00:00", "topic_count": 0}
+        store.apply_remote(["remote"], ["local"], [remote])
+        assert store.ids() == ["remote", "local"]
+    finally:
+        store.close()
+        backend.close()